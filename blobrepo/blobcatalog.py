@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The blob catalog lists every raw blob and recipe in the repository,
+together with the size of its file and the revision that added it
+(if known). It makes it possible to enumerate the blobs of a large
+repository without walking the blobs and recipes directories.
+
+The catalog also remembers the mtime of every shard directory (such
+as "blobs/b5") at the time it was last listed. The repository uses
+that to find shards that have been changed behind the back of the
+catalog, and lists only those again. See Repo.get_blob_catalog().
+
+The catalog also keeps a reference count for every blob: the number
+of times it is listed in the bloblists of the snapshots that have not
+been erased, plus the number of recipes that use it as a piece
+source. The references from snapshots are also counted separately,
+so that the blobs that are user files can be told from the blobs
+that are only pieces of recipes. The snapshots and recipes that have
+been counted are
+recorded, so that the counts can be brought up to date incrementally
+when a snapshot or recipe is added or erased. Every cataloged blob
+has a count, so that orphan blobs can be found by looking up the
+blobs with a count of zero. See Repo.get_orphan_blobs().
+
+The catalog is derived data, and can be deleted at any time. It will
+then be rebuilt from the filesystem and the snapshots.
+"""
+
+import os
+import sqlite3
+
+from common import *
+from boar_exceptions import SoftCorruptionError, UserError
+
+KIND_RAW = "raw"
+KIND_RECIPE = "recipe"
+
+class BlobCatalog:
+    def __init__(self, dbpath):
+        assert dbpath == ":memory:" or os.path.isabs(dbpath)
+        self.dbpath = dbpath
+        try:
+            self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (blob CHAR(32) NOT NULL, kind TEXT NOT NULL, size INT NOT NULL, revision INT, PRIMARY KEY (blob, kind))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS shards (kind TEXT NOT NULL, shard CHAR(2) NOT NULL, mtime REAL NOT NULL, PRIMARY KEY (kind, shard))")
+            has_refcounts = self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'refcounts'").fetchone()[0]
+            self.conn.execute("CREATE TABLE IF NOT EXISTS refcounts (blob CHAR(32) PRIMARY KEY, refs INT NOT NULL, user_refs INT NOT NULL DEFAULT 0)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS refcounts_refs ON refcounts (refs)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS counted_snapshots (revision INT PRIMARY KEY)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS counted_recipes (blob CHAR(32) PRIMARY KEY)")
+            if not has_refcounts:
+                # Catalogs from before reference counting
+                self.conn.execute("INSERT OR IGNORE INTO refcounts (blob, refs) SELECT blob, 0 FROM blobs")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(refcounts)")]
+            if "user_refs" not in columns:
+                # Catalogs from before user references were counted. All
+                # references will be counted again.
+                self.conn.execute("ALTER TABLE refcounts ADD COLUMN user_refs INT NOT NULL DEFAULT 0")
+                self.conn.execute("UPDATE refcounts SET refs = 0")
+                self.conn.execute("DELETE FROM counted_snapshots")
+                self.conn.execute("DELETE FROM counted_recipes")
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            # For instance "database is locked", which is not corruption
+            raise UserError("Blob catalog could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Blob catalog is corrupt: %s" % e)
+
+    def __query(self, sql, args = ()):
+        try:
+            return self.conn.execute(sql, args).fetchall()
+        except sqlite3.OperationalError, e:
+            raise UserError("Blob catalog could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Blob catalog is corrupt: %s" % e)
+
+    def __update(self, sql, rows):
+        try:
+            self.conn.executemany(sql, rows)
+        except sqlite3.OperationalError, e:
+            raise UserError("Blob catalog could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Blob catalog is corrupt: %s" % e)
+
+    def get_blobs(self, kind):
+        """Returns a list of all blobs of the given kind."""
+        return [str(blob) for blob, in self.__query("SELECT blob FROM blobs WHERE kind = ?", (kind,))]
+
+    def get_entries(self):
+        """Returns a list of (blob, kind, size, revision) tuples for
+        all blobs in the catalog."""
+        return [(str(blob), str(kind), size, revision) for blob, kind, size, revision in
+                self.__query("SELECT blob, kind, size, revision FROM blobs")]
+
+    def get_total_size(self, kind):
+        total, = self.__query("SELECT SUM(size) FROM blobs WHERE kind = ?", (kind,))[0]
+        return total or 0
+
+    def get_shard_blobs(self, kind, shard):
+        """Returns the set of all blobs of the given kind whose names
+        start with the given two hex digits."""
+        # "g" sorts after all hex digits, so this is a prefix match that can use the index
+        rows = self.__query("SELECT blob FROM blobs WHERE kind = ? AND blob >= ? AND blob < ?",
+                            (kind, shard, shard + "g"))
+        return set([str(blob) for blob, in rows])
+
+    def get_shards(self, kind):
+        """Returns a dict shard -> mtime for all known shards of the
+        given kind."""
+        return dict([(str(shard), mtime) for shard, mtime in
+                     self.__query("SELECT shard, mtime FROM shards WHERE kind = ?", (kind,))])
+
+    def add(self, kind, entries):
+        """Adds the given list of (blob, size, revision) tuples. The
+        revision may be None if it is unknown."""
+        for blob, size, revision in entries:
+            assert is_md5sum(blob)
+        self.__update("REPLACE INTO blobs (blob, kind, size, revision) VALUES (?, ?, ?, ?)",
+                      [(blob, kind, size, revision) for blob, size, revision in entries])
+        self.__update("INSERT OR IGNORE INTO refcounts (blob, refs) VALUES (?, 0)",
+                      [(blob,) for blob, size, revision in entries])
+
+    def remove(self, kind, blobs):
+        self.__update("DELETE FROM blobs WHERE blob = ? AND kind = ?", [(blob, kind) for blob in blobs])
+        # Counts for referenced blobs are kept even if the blob is missing
+        self.__update("DELETE FROM refcounts WHERE blob = ? AND refs = 0 AND "
+                      "NOT EXISTS (SELECT 1 FROM blobs WHERE blobs.blob = refcounts.blob)", [(blob,) for blob in blobs])
+
+    def set_revisions(self, revisions):
+        """Sets the owning revision of the blobs in the given dict
+        blob -> revision."""
+        self.__update("UPDATE blobs SET revision = ? WHERE blob = ?",
+                      [(revision, blob) for blob, revision in revisions.iteritems()])
+
+    def set_shard(self, kind, shard, mtime):
+        if mtime == None:
+            self.__update("DELETE FROM shards WHERE kind = ? AND shard = ?", [(kind, shard)])
+        else:
+            self.__update("REPLACE INTO shards (kind, shard, mtime) VALUES (?, ?, ?)", [(kind, shard, mtime)])
+
+    def add_refs(self, counts, user = False):
+        """Adds the given dict blob -> count to the reference
+        counts. If user is True, the references are from snapshots,
+        and are added to the user reference counts as well."""
+        self.__update("INSERT OR IGNORE INTO refcounts (blob, refs) VALUES (?, 0)",
+                      [(blob,) for blob in counts.keys()])
+        if user:
+            self.__update("UPDATE refcounts SET refs = refs + ?, user_refs = user_refs + ? WHERE blob = ?",
+                          [(count, count, blob) for blob, count in counts.iteritems()])
+        else:
+            self.__update("UPDATE refcounts SET refs = refs + ? WHERE blob = ?",
+                          [(count, blob) for blob, count in counts.iteritems()])
+
+    def remove_refs(self, counts, user = False):
+        """Subtracts the given dict blob -> count from the reference
+        counts."""
+        self.add_refs(dict([(blob, -count) for blob, count in counts.iteritems()]), user)
+
+    def get_refs(self, blobs):
+        """Returns a dict blob -> count for the given blobs."""
+        result = {}
+        for blob in blobs:
+            rows = self.__query("SELECT refs FROM refcounts WHERE blob = ?", (blob,))
+            result[blob] = rows[0][0] if rows else 0
+        return result
+
+    def get_user_refs(self, blobs):
+        """Returns a dict blob -> count of the references from
+        snapshots for the given blobs."""
+        result = {}
+        for blob in blobs:
+            rows = self.__query("SELECT user_refs FROM refcounts WHERE blob = ?", (blob,))
+            result[blob] = rows[0][0] if rows else 0
+        return result
+
+    def get_all_refs(self):
+        """Returns a dict blob -> count for all blobs with a count."""
+        return dict([(str(blob), refs) for blob, refs in self.__query("SELECT blob, refs FROM refcounts")])
+
+    def get_unreferenced(self):
+        """Returns a list of (blob, kind) tuples for all cataloged blobs
+        with a reference count of zero."""
+        rows = self.__query("SELECT refcounts.blob, blobs.kind FROM refcounts, blobs "
+                            "WHERE refcounts.refs = 0 AND blobs.blob = refcounts.blob")
+        return [(str(blob), str(kind)) for blob, kind in rows]
+
+    def get_counted_snapshots(self):
+        return set([revision for revision, in self.__query("SELECT revision FROM counted_snapshots")])
+
+    def set_snapshot_counted(self, revision, counted):
+        if counted:
+            self.__update("INSERT OR IGNORE INTO counted_snapshots (revision) VALUES (?)", [(revision,)])
+        else:
+            self.__update("DELETE FROM counted_snapshots WHERE revision = ?", [(revision,)])
+
+    def get_uncounted_recipes(self):
+        """Returns a list of cataloged recipes whose pieces have not
+        been counted."""
+        rows = self.__query("SELECT blob FROM blobs WHERE kind = ? AND blob NOT IN (SELECT blob FROM counted_recipes)",
+                            (KIND_RECIPE,))
+        return [str(blob) for blob, in rows]
+
+    def get_vanished_recipes(self):
+        """Returns a list of counted recipes that are no longer in the
+        catalog."""
+        rows = self.__query("SELECT blob FROM counted_recipes WHERE blob NOT IN (SELECT blob FROM blobs WHERE kind = ?)",
+                            (KIND_RECIPE,))
+        return [str(blob) for blob, in rows]
+
+    def is_recipe_counted(self, blob):
+        return bool(self.__query("SELECT 1 FROM counted_recipes WHERE blob = ?", (blob,)))
+
+    def set_recipe_counted(self, blob, counted):
+        if counted:
+            self.__update("INSERT OR IGNORE INTO counted_recipes (blob) VALUES (?)", [(blob,)])
+        else:
+            self.__update("DELETE FROM counted_recipes WHERE blob = ?", [(blob,)])
+
+    def clear_refs(self):
+        """Resets all reference counts to zero, and forgets all counted
+        snapshots and recipes."""
+        self.__update("DELETE FROM refcounts WHERE blob NOT IN (SELECT blob FROM blobs)", [()])
+        self.__update("UPDATE refcounts SET refs = 0, user_refs = 0", [()])
+        self.__update("DELETE FROM counted_snapshots", [()])
+        self.__update("DELETE FROM counted_recipes", [()])
+
+    def clear(self):
+        self.__update("DELETE FROM blobs", [()])
+        self.__update("DELETE FROM shards", [()])
+        self.__update("DELETE FROM refcounts", [()])
+        self.__update("DELETE FROM counted_snapshots", [()])
+        self.__update("DELETE FROM counted_recipes", [()])
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def commit(self):
+        try:
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            raise UserError("Blob catalog could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Blob catalog is corrupt: %s" % e)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The bloblist cache stores the fully expanded bloblist of a snapshot
+in a compact binary form, so that it does not have to be recreated
+by applying every delta in the base snapshot chain each time it is
+needed. The cache is derived data. Any entry that fails validation is
+simply ignored, and it can be thrown away at any time.
+
+Each cache file consists of a header line, the md5sum of the payload
+and the payload itself. The payload is a marshalled tuple (snapshot
+fingerprint, load stats, list of blobinfos).
+"""
+
+import os
+import marshal
+import tempfile
+import hashlib
+
+from common import *
+
+CACHE_HEADER = "BOAR_BLOBLIST_CACHE_1\n"
+CACHE_SUFFIX = ".bloblist"
+
+# The number of expanded bloblists to keep. A full bloblist is stored
+# for every cached snapshot, so this must be kept small.
+MAX_CACHED_BLOBLISTS = 20
+
+class BloblistCache:
+    def __init__(self, cache_dir, writable = True):
+        assert isinstance(cache_dir, unicode)
+        self.cache_dir = cache_dir
+        self.writable = writable
+
+    def __get_path(self, session_id):
+        assert isinstance(session_id, int) and session_id > 0
+        return os.path.join(self.cache_dir, str(session_id) + CACHE_SUFFIX)
+
+    def get(self, session_id, fingerprint):
+        """Returns a tuple (bloblist, load_stats) for the given
+        snapshot, or None if there is no valid cached bloblist."""
+        assert is_md5sum(fingerprint)
+        path = self.__get_path(session_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        header_size = len(CACHE_HEADER) + 33
+        if not data.startswith(CACHE_HEADER) or len(data) < header_size:
+            return None
+        expected_md5 = data[len(CACHE_HEADER):header_size - 1]
+        payload = data[header_size:]
+        if hashlib.md5(payload).hexdigest() != expected_md5:
+            warn("Ignoring corrupt bloblist cache entry for snapshot %s" % session_id)
+            return None
+        try:
+            cached_fingerprint, load_stats, bloblist = marshal.loads(payload)
+        except (ValueError, EOFError, TypeError):
+            return None
+        if cached_fingerprint != fingerprint:
+            return None
+        if load_stats.get('total_count', None) != len(bloblist):
+            return None
+        return bloblist, load_stats
+
+    def put(self, session_id, fingerprint, bloblist, load_stats):
+        """Stores the given full bloblist for the given snapshot. Any
+        errors are silently ignored, the cache is only an
+        optimization."""
+        assert is_md5sum(fingerprint)
+        assert load_stats['total_count'] == len(bloblist)
+        if not self.writable:
+            return
+        path = self.__get_path(session_id)
+        payload = marshal.dumps((fingerprint, load_stats, list(bloblist)), 2)
+        data = CACHE_HEADER + hashlib.md5(payload).hexdigest() + "\n" + payload
+        try:
+            if not dir_exists(self.cache_dir):
+                os.mkdir(self.cache_dir)
+            fd, tmppath = tempfile.mkstemp(prefix = "tmp_", suffix = CACHE_SUFFIX, dir = self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if os.path.exists(path):
+                os.remove(path) # For windows
+            os.rename(tmppath, path)
+            self.__trim()
+        except (OSError, IOError):
+            pass
+
+    def invalidate(self, session_id):
+        path = self.__get_path(session_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        if not dir_exists(self.cache_dir):
+            return
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith(CACHE_SUFFIX):
+                os.remove(os.path.join(self.cache_dir, fn))
+
+    def __trim(self):
+        """Removes the least recently written entries until at most
+        MAX_CACHED_BLOBLISTS remains."""
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith(CACHE_SUFFIX) and not fn.startswith("tmp_"):
+                path = os.path.join(self.cache_dir, fn)
+                entries.append((os.path.getmtime(path), path))
+        entries.sort()
+        for mtime, path in entries[:-MAX_CACHED_BLOBLISTS]:
+            os.remove(path)
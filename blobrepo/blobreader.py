@@ -2,7 +2,10 @@ from common import *
 from jsonrpc import DataSource
 import deduplication
 import boar_exceptions
-from copy import copy
+import array
+import bisect
+import io
+from ordered_dict import OrderedDict
 
 """ A recipe has the following format:
 
@@ -23,6 +26,95 @@ from copy import copy
 
 """
 
+MAX_OPEN_BLOBS = 8
+MAX_READ_BUFFER_SIZE = 2**24
+
+try:
+    memoryview
+    have_memoryview = True
+except NameError:
+    # Python 2.6
+    have_memoryview = False
+
+# Recipe positions may exceed 4GB, which does not fit in an unsigned
+# long on all platforms. A double holds integers exactly up to 2**53.
+if array.array("L").itemsize >= 8:
+    POSITION_TYPECODE = "L"
+else:
+    POSITION_TYPECODE = "d"
+
+class PieceTable:
+    """A compact representation of the pieces of a recipe. Repeated
+    pieces are stored only once, and the piece data is kept in
+    parallel arrays, so that the memory needed depends on the number
+    of pieces in the recipe, not on how many times they are repeated.
+
+    Adjacent pieces that continue exactly where the previous piece
+    ended in the same blob are merged, so that they can be read with
+    a single read operation. Empty pieces are dropped."""
+
+    def __init__(self):
+        self.blobs = [] # Source blob ids, indexed by self.sources
+        self.blob_indexes = {} # Source blob id -> index in self.blobs
+        self.sources = array.array("i")
+        self.offsets = array.array(POSITION_TYPECODE)
+        self.sizes = array.array(POSITION_TYPECODE)
+        self.repeats = array.array(POSITION_TYPECODE)
+        self.starts = array.array(POSITION_TYPECODE) # Position in recipe
+        self.total_size = 0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, source, offset, size, repeat = 1):
+        assert offset >= 0 and size >= 0 and repeat >= 1
+        if size == 0:
+            return
+        if source not in self.blob_indexes:
+            self.blob_indexes[source] = len(self.blobs)
+            self.blobs.append(source)
+        source_index = self.blob_indexes[source]
+        if self.sources and self.sources[-1] == source_index:
+            last_offset, last_size, last_repeat = int(self.offsets[-1]), int(self.sizes[-1]), int(self.repeats[-1])
+            if last_offset == offset and last_size == size:
+                self.repeats[-1] = last_repeat + repeat
+                self.total_size += size * repeat
+                return
+            if last_repeat == 1 and repeat == 1 and last_offset + last_size == offset:
+                self.sizes[-1] = last_size + size
+                self.total_size += size
+                return
+        self.sources.append(source_index)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.repeats.append(repeat)
+        self.starts.append(self.total_size)
+        self.total_size += size * repeat
+
+    def contains(self, index, pos):
+        """Returns True if the recipe position is within the piece
+        with the given index."""
+        start = self.starts[index]
+        return start <= pos < start + self.sizes[index] * self.repeats[index]
+
+    def find(self, pos):
+        """Returns the index of the piece that contains the given
+        recipe position."""
+        assert 0 <= pos < self.total_size, pos
+        index = bisect.bisect_right(self.starts, pos) - 1
+        assert 0 <= index < len(self)
+        return index
+
+    def get_read(self, index, pos, max_size):
+        """Returns a tuple (blob, blob position, size) for the longest
+        read from the blob of the given piece that starts at the given
+        recipe position, but not longer than max_size."""
+        size = int(self.sizes[index])
+        piece_pos = (pos - int(self.starts[index])) % size
+        return self.blobs[self.sources[index]], \
+            int(self.offsets[index]) + piece_pos, \
+            min(size - piece_pos, max_size)
+
 def create_blob_reader(recipe, repo):
     assert recipe
     return RecipeReader(recipe, repo)
@@ -38,20 +130,16 @@ class RecipeReader(DataSource):
         self.local_path = local_path
         self.progress_callback = lambda x: None
 
-        self.pieces = []
+        self.pieces = PieceTable()
         self.blob_paths = {} # Blob id -> blob path
-        self.file_handles = {} # blob -> handle
+        self.file_handles = OrderedDict() # blob path -> handle, least recently used first
+        self.read_buffer = bytearray()
 
-        # Expand repeated pieces
-        piece_size_sum = 0
         for piece in recipe['pieces']:
-            repeat = piece.get('repeat', 1)
-            for n in xrange(0, repeat):
-                piece_to_add = copy(piece)
-                piece_to_add['position_in_recipe'] = piece_size_sum
-                piece_size_sum += piece['size']
-                self.pieces.append(piece_to_add)
+            self.pieces.add(piece['source'], piece['offset'], piece['size'], piece.get('repeat', 1))
             blob = piece['source']
+            if blob in self.blob_paths:
+                continue
             blobpath = None
             if self.local_path:
                 blobpath =  os.path.join(self.local_path, blob)
@@ -61,7 +149,7 @@ class RecipeReader(DataSource):
                 raise boar_exceptions.CorruptionError("A recipe (%s) refers to a missing blob (%s)" % (recipe['md5sum'], blob))
             self.blob_paths[piece['source']] = blobpath
 
-        if piece_size_sum != recipe['size']:
+        if self.pieces.total_size != recipe['size']:
             raise boar_exceptions.CorruptionError("Recipe is internally inconsistent: %s" % recipe['md5sum'])
 
         self.recipe_size = recipe['size']
@@ -80,42 +168,74 @@ class RecipeReader(DataSource):
     def bytes_left(self):
         return self.bytes_left_in_segment
 
+    def seek(self, pos):
+        """Moves the read position to the given position, relative to
+        the start of the segment."""
+        assert 0 <= pos <= self.segment_size
+        self.bytes_left_in_segment = self.segment_size - pos
+
     def __del__(self):
         for f in self.file_handles.values():
             f.close()
         del self.file_handles
 
-    def __read_from_blob(self, blob, position, size):
+    def __get_file_handle(self, blob):
         blobpath = self.blob_paths[blob]
-        if blobpath not in self.file_handles:
-            for f in self.file_handles.values():
-                f.close()
-            self.file_handles.clear()
-            self.file_handles[blobpath] = open(blobpath, "rb")
-        f = self.file_handles[blobpath]
+        f = self.file_handles.pop(blobpath, None)
+        if not f:
+            if len(self.file_handles) >= MAX_OPEN_BLOBS:
+                oldest_path, oldest_f = self.file_handles.popitem(last = False)
+                oldest_f.close()
+            f = io.open(blobpath, "rb", buffering = 0)
+        self.file_handles[blobpath] = f
+        return f
+
+    def __read_from_blob(self, blob, position, size):
+        f = self.__get_file_handle(blob)
         f.seek(position)
         data = f.read(size)
-        #print "read_from_blob(blob=%s, position=%s, size=%s) => '%s'" % (blob, position, size, data)
+        if len(data) != size:
+            raise boar_exceptions.CorruptionError("Blob is truncated: %s" % blob)
         return data
 
-    def __search_forward(self, pos, start_index = 0):
-        index = start_index
-        while True:
-            piece = self.pieces[index]
-            piece_start = piece['position_in_recipe']
-            piece_end = piece_start + piece['size']
-            if piece_start <= pos < piece_end:
-                break
-            index += 1
-        #print "search_forward(%s, %s) => %s" % (pos, start_index, index)
-        return index
+    def __readinto_from_blob(self, blob, position, view):
+        """Fills the given memoryview with data from the given blob,
+        starting at the given position."""
+        f = self.__get_file_handle(blob)
+        f.seek(position)
+        done = 0
+        while done < len(view):
+            n = f.readinto(view[done:])
+            if not n:
+                raise boar_exceptions.CorruptionError("Blob is truncated: %s" % blob)
+            done += n
 
-    def __read_piece_data(self, piece, recipe_pos, max_size):
-        piece_pos = recipe_pos - piece['position_in_recipe']
-        blob_pos = piece['offset'] + piece_pos
-        available_blob_data_size = piece['size'] - piece_pos
-        blob_read_size = min(available_blob_data_size, max_size)
-        return self.__read_from_blob(piece['source'], blob_pos, blob_read_size)
+    def __next_read(self, max_size):
+        """Returns a tuple (blob, blob position, size) describing the
+        longest read from a single blob that can be made at the
+        current position, and advances the current position past
+        it."""
+        current_recipe_read_position = self.segment_start_in_recipe + (self.segment_size - self.bytes_left_in_segment)
+        if not self.pieces.contains(self.current_piece_index, current_recipe_read_position):
+            self.current_piece_index = self.pieces.find(current_recipe_read_position)
+        blob, blob_pos, size = self.pieces.get_read(self.current_piece_index, current_recipe_read_position, max_size)
+        self.bytes_left_in_segment -= size
+        return blob, blob_pos, size
+
+    def readinto(self, buf):
+        """Reads data into the given writable buffer (such as a
+        bytearray) and returns the number of bytes read. Fewer bytes
+        than the size of the buffer are read only at the end of the
+        data. Requires python 2.7 or later."""
+        view = memoryview(buf)
+        readsize = min(len(view), self.bytes_left_in_segment)
+        done = 0
+        while done < readsize:
+            blob, blob_pos, size = self.__next_read(readsize - done)
+            self.__readinto_from_blob(blob, blob_pos, view[done:done+size])
+            done += size
+        self.progress_callback(calculate_progress(self.segment_size, self.segment_size - self.bytes_left_in_segment))
+        return readsize
 
     @overrides(DataSource)
     def read(self, readsize = None):
@@ -124,18 +244,25 @@ class RecipeReader(DataSource):
             readsize = self.bytes_left_in_segment
         readsize = min(self.bytes_left_in_segment, readsize)
         assert readsize >= 0
-
-        result = ""
-        while len(result) < readsize:
-            #print self.segment_start_in_recipe, self.segment_size, self.bytes_left_in_segment
-            current_recipe_read_position = self.segment_start_in_recipe + (self.segment_size - self.bytes_left_in_segment)
-            self.current_piece_index = self.__search_forward(current_recipe_read_position, start_index = self.current_piece_index)
-            remaining = readsize - len(result)
-            data = self.__read_piece_data(self.pieces[self.current_piece_index], current_recipe_read_position, remaining)
-            result += data
-            self.bytes_left_in_segment -= len(data)
+        if have_memoryview:
+            # Reuse the read buffer between calls, the data is
+            # copied only once into the returned string.
+            if readsize > MAX_READ_BUFFER_SIZE:
+                view = memoryview(bytearray(readsize))
+            else:
+                if len(self.read_buffer) < readsize:
+                    self.read_buffer = bytearray(readsize)
+                view = memoryview(self.read_buffer)[:readsize]
+            self.readinto(view)
+            return view.tobytes()
+        chunks = []
+        remaining = readsize
+        while remaining:
+            blob, blob_pos, size = self.__next_read(remaining)
+            chunks.append(self.__read_from_blob(blob, blob_pos, size))
+            remaining -= size
         self.progress_callback(calculate_progress(self.segment_size, self.segment_size - self.bytes_left_in_segment))
-        return result
+        return "".join(chunks)
 
     def set_progress_callback(self, progress_callback):
         assert callable(progress_callback)
@@ -167,6 +294,16 @@ def benchmark():
     sw = StopWatch()
     reader.read()
     sw.mark("Read complete")
+    reader = RecipeReader(recipe, FakeRepo())
+    buf = bytearray(2**20)
+    while reader.readinto(buf):
+        pass
+    sw.mark("Readinto complete")
+    recipe['pieces'][0]['repeat'] = recipe['size'] = 2**30
+    recipe['pieces'][0]['size'] = 1
+    reader = RecipeReader(recipe, FakeRepo(), offset = 2**29, size = 4096)
+    reader.read()
+    sw.mark("Random access read in a recipe with 2**30 pieces")
     """
     62 Mbytes
     SW: Read complete 0.33 (total 0.33)
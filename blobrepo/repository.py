@@ -32,6 +32,11 @@ import random, time
 from common import *
 from boar_common import *
 import blobreader
+import bloblistcache
+import sessionindex
+import verifyledger
+import blobcatalog
+import snapshotstats
 from jsonrpc import FileDataSource
 from boar_exceptions import *
 from blobreader import create_blob_reader
@@ -50,7 +55,15 @@ TMP_DIR = "tmp"
 DERIVED_DIR = "derived"
 DERIVED_SHA256_DIR = os.path.join(DERIVED_DIR, "sha256")
 DERIVED_BLOCKS_DIR = os.path.join(DERIVED_DIR, "blocks")
-DERIVED_BLOCKS_DB = os.path.join(DERIVED_BLOCKS_DIR, "blocks.db")
+DERIVED_BLOCKS_DB = os.path.join(DERIVED_BLOCKS_DIR, "blocks.db") # Replaced by the shards, see migrate_blocksdb()
+DERIVED_BLOCKS_SHARDS_DIR = os.path.join(DERIVED_BLOCKS_DIR, "shards")
+DERIVED_ROLLING_FILTER = os.path.join(DERIVED_BLOCKS_DIR, "rolling.filter")
+DERIVED_CHUNKS_DB = os.path.join(DERIVED_BLOCKS_DIR, "chunks.db")
+DERIVED_BLOBLISTS_DIR = os.path.join(DERIVED_DIR, "bloblists")
+DERIVED_SESSION_INDEX = os.path.join(DERIVED_DIR, "sessionindex.json")
+DERIVED_VERIFY_LEDGER = os.path.join(DERIVED_DIR, "verifyledger.db")
+DERIVED_BLOB_CATALOG = os.path.join(DERIVED_DIR, "blobcatalog.db")
+DERIVED_SNAPSHOT_STATS = os.path.join(DERIVED_DIR, "snapshotstats.db")
 DELETE_MARKER = "deleted.json"
 
 REPO_DIRS_V0 = (QUEUE_DIR, BLOB_DIR, SESSIONS_DIR, TMP_DIR)
@@ -66,6 +79,23 @@ REPO_DIRS_V5 = (QUEUE_DIR, BLOB_DIR, SESSIONS_DIR, TMP_DIR,\
     DERIVED_DIR, DERIVED_BLOCKS_DIR, RECIPES_DIR)
 
 DEDUP_BLOCK_SIZE = 2**16
+DEDUP_AVG_CHUNK_SIZE = 2**16
+
+# Fixed size blocks found anywhere by a rolling checksum
+DEDUP_METHOD_FIXED = "fixed"
+# Content defined chunks
+DEDUP_METHOD_CDC = "cdc"
+VERIFY_READ_SIZE = 2**20
+
+# Blob shards queried for at least this many checksums at once are
+# listed instead of probed one checksum at a time.
+MIN_SUMS_FOR_SHARD_LISTING = 4
+
+# The blob catalog only trusts the mtime of a shard directory if the
+# directory had not been modified for this many seconds when it was
+# listed. Otherwise, a change within the timestamp resolution of the
+# file system could go unnoticed.
+BLOB_CATALOG_MARGIN = 5.0
 
 recoverytext = """Repository format v%s
 
@@ -141,7 +171,8 @@ def integrity_assert(test, errormsg = None):
     if not test:
         raise CorruptionError(errormsg)
 
-def create_repository(repopath, enable_deduplication = False):
+def create_repository(repopath, enable_deduplication = False, dedup_method = DEDUP_METHOD_FIXED):
+    assert dedup_method in (DEDUP_METHOD_FIXED, DEDUP_METHOD_CDC)
     if enable_deduplication and not deduplication.dedup_available:
         # Ok, we COULD create a deduplicated repo without the module,
         # but the user is likely to be confused when he cannot use it.
@@ -153,8 +184,10 @@ def create_repository(repopath, enable_deduplication = False):
     create_file(os.path.join(repopath, "recovery.txt"), recoverytext)
     create_file(os.path.join(repopath, REPOID_FILE), generate_random_repoid())
     if enable_deduplication:
-        with open(os.path.join(repopath, "ENABLE_DEDUPLICATION"), "wb"):
-            pass
+        with open(os.path.join(repopath, "ENABLE_DEDUPLICATION"), "wb") as f:
+            # An empty file means fixed size blocks, for compatibility
+            if dedup_method != DEDUP_METHOD_FIXED:
+                f.write(dedup_method)
 
 def looks_like_repo(repo_path):
     """Superficial check to see if the given path contains anything
@@ -170,6 +203,10 @@ def has_pending_operations(repo_path):
     dirpath = os.path.join(repo_path, QUEUE_DIR)
     return len(os.listdir(dirpath)) != 0
 
+def get_recipe_sources(recipe):
+    """Returns the set of raw blobs that the given recipe uses."""
+    return set([piece['source'] for piece in recipe['pieces']])
+
 def get_recipe_md5(recipe_filename):
     md5 = recipe_filename.split(".")[0]
     assert is_md5sum(md5)
@@ -177,7 +214,7 @@ def get_recipe_md5(recipe_filename):
 
 BlocksDB = deduplication.FakeBlocksDB
 if deduplication.dedup_available:
-    BlocksDB = deduplication.BlocksDB
+    BlocksDB = deduplication.ShardedBlocksDB
 
 class Repo:
     def __init__(self, repopath):
@@ -192,7 +229,11 @@ class Repo:
         if self.__get_repo_version() > LATEST_REPO_FORMAT:
             raise UserError("Repo is from a future boar version. Upgrade your boar.")
         self.session_readers = {}
+        self.verify_ledger = None
+        self.blob_catalog = None
+        self.snapshot_stats = None
         self.scanners = ()
+        self.chunksdb = None
         self.repo_mutex = FileMutex(os.path.join(repopath, TMP_DIR), "__REPOLOCK__")
         misuse_assert(os.path.exists(self.repopath), "No such directory: %s" % (self.repopath))
         self.readonly = os.path.exists(os.path.join(repopath, "READONLY"))
@@ -209,13 +250,25 @@ class Repo:
             self.readonly = True
             notice("This repository requires the native deduplication module for writing - only read operations can be performed.")
 
+        self.bloblist_cache = bloblistcache.BloblistCache(
+            os.path.join(self.repopath, DERIVED_BLOBLISTS_DIR), writable = not self.readonly)
+        self.session_index = sessionindex.SessionIndex(
+            self, os.path.join(self.repopath, DERIVED_SESSION_INDEX), os.path.join(self.repopath, SESSIONS_DIR))
+
         if not self.readonly:
             self.repo_mutex.lock_with_timeout(60)
             try:
                 self.__upgrade_repo()
                 self.__quick_check()
-                self.blocksdb = BlocksDB(os.path.join(self.repopath, DERIVED_BLOCKS_DB), DEDUP_BLOCK_SIZE)
+                if self.get_dedup_method() == DEDUP_METHOD_CDC:
+                    # The chunks db takes the place of the blocks db
+                    self.blocksdb = deduplication.FakeBlocksDB(None, DEDUP_BLOCK_SIZE)
+                    self.chunksdb = self.__open_chunksdb()
+                else:
+                    self.blocksdb = self.__open_blocksdb()
                 self.process_queue()
+                self.open_rolling_filter()
+                self.session_index.sync()
             finally:
                 self.repo_mutex.release()
 
@@ -252,6 +305,17 @@ class Repo:
     def deduplication_enabled(self):
         return os.path.exists(os.path.join(self.repopath, "ENABLE_DEDUPLICATION"))
 
+    def get_dedup_method(self):
+        """Returns DEDUP_METHOD_FIXED or DEDUP_METHOD_CDC, or None if
+        deduplication is not enabled."""
+        if not self.deduplication_enabled():
+            return None
+        with open(os.path.join(self.repopath, "ENABLE_DEDUPLICATION"), "rb") as f:
+            method = f.read().strip() or DEDUP_METHOD_FIXED
+        if method not in (DEDUP_METHOD_FIXED, DEDUP_METHOD_CDC):
+            raise UserError("Repository uses an unknown deduplication method: %s" % method)
+        return method
+
     def __upgrade_repo(self):
         assert not self.readonly, "Repo is read only, cannot upgrade"
         assert self.repo_mutex.is_locked()
@@ -470,6 +534,176 @@ class Repo:
         assert is_md5sum(sum), "Was: %s" % (sum)
         return os.path.join(self.repopath, BLOB_DIR, sum[0:2], sum)
 
+    def __open_blocksdb(self):
+        """Opens the sharded blocks database. A blocks database from an
+        earlier version of boar is used as it is until it is moved into
+        shards by migrate_blocksdb(), since that may take a long
+        time."""
+        assert self.repo_mutex.is_locked()
+        shards_dir = os.path.join(self.repopath, DERIVED_BLOCKS_SHARDS_DIR)
+        legacy_db = os.path.join(self.repopath, DERIVED_BLOCKS_DB)
+        if deduplication.dedup_available and not os.path.exists(shards_dir):
+            if os.path.exists(legacy_db):
+                notice("The blocks database is in an old format. Run 'boar rebuildblocks --migrate' to upgrade it.")
+                return deduplication.BlocksDB(legacy_db, DEDUP_BLOCK_SIZE)
+            if os.path.exists(os.path.join(self.repopath, DERIVED_ROLLING_FILTER)):
+                # A filter for some earlier blocks db must not be mistaken for being in sync
+                safe_delete_file(os.path.join(self.repopath, DERIVED_ROLLING_FILTER))
+        if os.path.exists(shards_dir) and os.path.exists(legacy_db):
+            # Left behind if we were interrupted after the migration
+            safe_delete_file(legacy_db)
+        return BlocksDB(shards_dir, DEDUP_BLOCK_SIZE)
+
+    def __open_chunksdb(self):
+        return deduplication.ChunksDB(os.path.join(self.repopath, DERIVED_CHUNKS_DB), DEDUP_AVG_CHUNK_SIZE)
+
+    def __replace_blocksdb(self, fill_function):
+        """Creates a new sharded blocks database in the tmp dir, lets
+        the given function fill it, and then replaces the current
+        blocks database with it. The caller must not hold any
+        reference to the current database."""
+        assert self.repo_mutex.is_locked()
+        shards_dir = os.path.join(self.repopath, DERIVED_BLOCKS_SHARDS_DIR)
+        new_shards_dir = tempfile.mkdtemp(prefix = "tmp_blocksdb_", dir = self.get_path(TMP_DIR))
+        try:
+            new_db = deduplication.ShardedBlocksDB(new_shards_dir, DEDUP_BLOCK_SIZE)
+            fill_function(new_db)
+            new_db = None # Close the shards before moving them
+        except:
+            shutil.rmtree(new_shards_dir, ignore_errors = True)
+            raise
+        # The modcount of the new database may coincide with the one
+        # the filter was synced with
+        if os.path.exists(os.path.join(self.repopath, DERIVED_ROLLING_FILTER)):
+            safe_delete_file(os.path.join(self.repopath, DERIVED_ROLLING_FILTER))
+        if os.path.exists(shards_dir):
+            trashdir = tempfile.mkdtemp(prefix = "TRASH_blocksdb_", dir = self.get_path(TMP_DIR))
+            os.rename(shards_dir, os.path.join(trashdir, "shards"))
+            shutil.rmtree(trashdir, ignore_errors = True)
+        os.rename(new_shards_dir, shards_dir)
+
+    def needs_blocksdb_migration(self):
+        """Returns True if the blocks database is in the format of an
+        earlier version of boar."""
+        return deduplication.dedup_available and \
+            self.get_dedup_method() != DEDUP_METHOD_CDC and \
+            not os.path.exists(os.path.join(self.repopath, DERIVED_BLOCKS_SHARDS_DIR)) and \
+            os.path.exists(os.path.join(self.repopath, DERIVED_BLOCKS_DB))
+
+    def migrate_blocksdb(self):
+        """Moves the contents of a blocks database from an earlier
+        version of boar into a new sharded blocks database. Nothing is
+        done if there is nothing to migrate."""
+        assert self.repo_mutex.is_locked()
+        misuse_assert(not self.readonly, "Cannot migrate the blocks database of a write protected repo")
+        if not self.needs_blocksdb_migration():
+            return
+        legacy_db = os.path.join(self.repopath, DERIVED_BLOCKS_DB)
+        self.blocksdb = None
+        try:
+            self.__replace_blocksdb(lambda new_db: deduplication.copy_blocksdb(
+                    deduplication.BlocksDB(legacy_db, DEDUP_BLOCK_SIZE), new_db))
+        finally:
+            self.blocksdb = self.__open_blocksdb()
+        self.open_rolling_filter()
+
+    def rebuild_blocksdb(self, progress_callback = lambda f: None):
+        """Recreates the blocks database, or the chunks database for a
+        repository with content defined chunks, from the raw blobs in
+        the repository."""
+        assert self.repo_mutex.is_locked()
+        misuse_assert(not self.readonly, "Cannot rebuild the blocks database of a write protected repo")
+        misuse_assert(deduplication.dedup_available, "The deduplication module is not available")
+        blobs = self.get_raw_blob_names()
+        if self.get_dedup_method() == DEDUP_METHOD_CDC:
+            self.__rebuild_chunksdb(blobs, progress_callback)
+            return
+        def fill(new_db):
+            new_db.begin()
+            for n, blob in enumerate(blobs):
+                progress_callback(1.0 * n / len(blobs))
+                reader = self.get_blob_reader(blob)
+                bc = deduplication.BlockChecksum(DEDUP_BLOCK_SIZE)
+                while reader.bytes_left():
+                    bc.feed_string(reader.read(DEDUP_BLOCK_SIZE * 16))
+                    blocks = bc.harvest()
+                    new_db.add_blocks([(blob, offset, md5) for offset, rolling, md5 in blocks])
+                    new_db.add_rollings([rolling for offset, rolling, md5 in blocks])
+            new_db.commit()
+            progress_callback(1.0)
+        self.blocksdb = None
+        try:
+            self.__replace_blocksdb(fill)
+        finally:
+            self.blocksdb = self.__open_blocksdb()
+        self.open_rolling_filter()
+
+    def __rebuild_chunksdb(self, blobs, progress_callback):
+        new_db_dir = tempfile.mkdtemp(prefix = "tmp_chunksdb_", dir = self.get_path(TMP_DIR))
+        try:
+            new_db = deduplication.ChunksDB(os.path.join(new_db_dir, "chunks.db"), DEDUP_AVG_CHUNK_SIZE)
+            new_db.begin()
+            for n, blob in enumerate(blobs):
+                progress_callback(1.0 * n / len(blobs))
+                reader = self.get_blob_reader(blob)
+                cc = deduplication.ChunkChecksum(DEDUP_AVG_CHUNK_SIZE)
+                while reader.bytes_left():
+                    cc.feed_string(reader.read(DEDUP_AVG_CHUNK_SIZE * 16))
+                for offset, size, md5 in cc.harvest():
+                    new_db.add_chunk(blob, offset, size, md5)
+            new_db.commit()
+            new_db = None # Close the database before moving it
+        except:
+            shutil.rmtree(new_db_dir, ignore_errors = True)
+            raise
+        self.chunksdb = None
+        try:
+            chunksdb_path = os.path.join(self.repopath, DERIVED_CHUNKS_DB)
+            if os.path.exists(chunksdb_path):
+                trashdir = tempfile.mkdtemp(prefix = "TRASH_chunksdb_", dir = self.get_path(TMP_DIR))
+                os.rename(chunksdb_path, os.path.join(trashdir, "chunks.db"))
+                shutil.rmtree(trashdir, ignore_errors = True)
+            os.rename(os.path.join(new_db_dir, "chunks.db"), chunksdb_path)
+            shutil.rmtree(new_db_dir, ignore_errors = True)
+        finally:
+            self.chunksdb = self.__open_chunksdb()
+        progress_callback(1.0)
+
+    def open_rolling_filter(self):
+        """Returns a writable RollingFilterFile that is in sync with
+        the blocks database, rebuilding it if necessary. Returns None
+        if the deduplication module is not available, or if the
+        repository uses content defined chunks."""
+        assert self.repo_mutex.is_locked()
+        assert not self.readonly
+        if not deduplication.dedup_available or self.get_dedup_method() == DEDUP_METHOD_CDC:
+            return None
+        path = os.path.join(self.repopath, DERIVED_ROLLING_FILTER)
+        modcount = self.blocksdb.get_modcount()
+        rolling_filter = deduplication.RollingFilterFile(path, writable = True)
+        if not rolling_filter.is_valid() or rolling_filter.get_modcount() != modcount or rolling_filter.is_full():
+            rolling_filter = None # Release the old mapping before replacing the file
+            rolling_filter = deduplication.create_rolling_filter(
+                path, self.blocksdb.get_rolling_count(), self.blocksdb.get_rolling_pages(), modcount)
+        return rolling_filter
+
+    def get_rolling_set(self):
+        """Returns an IntegerSet containing the rolling checksums of
+        all blocks in the repository, suitable for use with the
+        RecipeFinder class. It may also contain some other values. The
+        returned set can be added to without affecting the
+        repository."""
+        if not deduplication.dedup_available or self.get_dedup_method() == DEDUP_METHOD_CDC:
+            return deduplication.CreateIntegerSet([])
+        rolling_filter = deduplication.RollingFilterFile(os.path.join(self.repopath, DERIVED_ROLLING_FILTER))
+        if not rolling_filter.is_valid():
+            # Possibly deleted by someone. A slightly stale filter is
+            # fine, but a missing one would prevent all deduplication.
+            return deduplication.CreateIntegerSet(self.blocksdb.get_all_rolling())
+        rolling_set = deduplication.CreateIntegerSet([])
+        rolling_set.set_filter(rolling_filter.filter)
+        return rolling_set
+
     def has_block(self, sha):
         return self.blocksdb.has_block(sha)
 
@@ -500,6 +734,30 @@ class Repo:
         recpath = self.get_recipe_path(sum)
         return os.path.exists(blobpath) or os.path.exists(recpath)
 
+    def get_missing_blobs(self, sums):
+        """Returns the set of the given checksums that there is no
+        blob (raw or recipe-based) for. Shards that are queried for
+        many checksums are listed once instead of testing every
+        checksum separately."""
+        sums_by_shard = {}
+        for sum in sums:
+            assert is_md5sum(sum), "Was: %s" % (sum)
+            sums_by_shard.setdefault(sum[0:2], set()).add(sum)
+        missing = set()
+        for shard, shard_sums in sums_by_shard.iteritems():
+            if len(shard_sums) < MIN_SUMS_FOR_SHARD_LISTING:
+                missing.update([sum for sum in shard_sums if not self.has_blob(sum)])
+                continue
+            present = set()
+            blob_shard_dir = os.path.join(self.repopath, BLOB_DIR, shard)
+            if os.path.isdir(blob_shard_dir):
+                present.update(os.listdir(blob_shard_dir))
+            recipe_shard_dir = os.path.join(self.repopath, RECIPES_DIR, shard)
+            if os.path.isdir(recipe_shard_dir):
+                present.update([get_recipe_md5(fn) for fn in os.listdir(recipe_shard_dir) if is_recipe_filename(fn)])
+            missing.update(shard_sums - present)
+        return missing
+
     def get_recipe(self, sum):
         recpath = self.get_recipe_path(sum)
         if not os.path.exists(recpath):
@@ -555,11 +813,7 @@ class Repo:
         return self.get_session(rev).is_deleted()
 
     def get_deleted_snapshots(self):
-        result = []
-        for sid in self.get_all_sessions():
-            if self.get_session(sid).is_deleted():
-                result.append(sid)
-        return result
+        return self.session_index.get_deleted_snapshots()
 
     def get_highest_used_revision(self):
         """ Returns the highest used revision id in the
@@ -589,7 +843,7 @@ class Repo:
         assert isinstance(id, int)
         misuse_assert(self.has_snapshot(id), "There is no snapshot with id %s" % id)
         if id not in self.session_readers:
-            self.session_readers[id] = sessions.SessionReader(self, self.get_session_path(id))
+            self.session_readers[id] = sessions.SessionReader(self, self.get_session_path(id), session_id = id)
         return self.session_readers[id]
 
     def create_snapshot(self, session_name, base_session = None, session_id = None, force_base_snapshot = False):
@@ -607,50 +861,183 @@ class Repo:
         """ Returns the id of the latest snapshot in the specified
         session. Returns None if there is no such session. """
         assert isinstance(session_name, unicode)
-        all_sids = self.get_all_sessions()
-        all_sids.sort()
-        all_sids.reverse()
-        for sid in all_sids:
-            session = self.get_session(sid)
-            name = session.get_client_value("name")
-            if name == session_name:
-                return sid
-        return None
+        return self.session_index.find_last_revision(session_name)
+
+    def get_session_revisions(self, session_name):
+        """ Returns a sorted list of the ids of all snapshots in the
+        specified session. """
+        return self.session_index.get_revisions(session_name)
+
+    def get_session_names(self):
+        """ Returns a list of the names of all sessions that has at
+        least one snapshot in the repository. """
+        return self.session_index.get_session_names()
 
     def find_next_session_id(self):
         return self.get_highest_used_revision() + 1
 
     def get_raw_blob_names(self):
-        blobpattern = re.compile("/([0-9a-f]{32})$")
-        assert blobpattern.search("b5/b5fb453aeaaef8343353cc1b641644f9")
-        tree = get_tree(os.path.join(self.repopath, BLOB_DIR), sep="/")
-        matches = set()
-        for f in tree:
-            m = blobpattern.search(f)
-            if m:
-                matches.add(m.group(1))
-        return list(matches)
-
+        return self.get_blob_catalog().get_blobs(blobcatalog.KIND_RAW)
 
     def get_recipe_names(self):
-        recipepattern = re.compile("([0-9a-f]{32})([.]recipe)$")
-        assert recipepattern.search("b5fb453aeaaef8343353cc1b641644f9.recipe")
-        tree = get_tree(os.path.join(self.repopath, RECIPES_DIR), sep="/")
-        matches = set()
-        for f in tree:
-            m = recipepattern.search(f)
-            if m:
-                matches.add(m.group(1))
-        return list(matches)
+        return self.get_blob_catalog().get_blobs(blobcatalog.KIND_RECIPE)
+
+    def __get_shard_dir(self, kind, shard = ""):
+        kind_dir = {blobcatalog.KIND_RAW: BLOB_DIR, blobcatalog.KIND_RECIPE: RECIPES_DIR}[kind]
+        return os.path.join(self.repopath, kind_dir, shard)
+
+    def __get_shard_mtimes(self, kind):
+        """Returns a dict shard -> mtime for all the shard directories
+        of the given kind that exist in the repository."""
+        result = {}
+        kind_dir = self.__get_shard_dir(kind)
+        if not os.path.isdir(kind_dir):
+            return result
+        for shard in os.listdir(kind_dir):
+            shard = str(shard)
+            if re.match("^[0-9a-f]{2}$", shard):
+                result[shard] = os.stat(os.path.join(kind_dir, shard)).st_mtime
+        return result
+
+    def __scan_shard(self, catalog, kind, shard, mtime):
+        """Makes the catalog entries for the given shard match the
+        files in the shard directory. The mtime must have been read
+        before the directory is listed, so that any change made during
+        the listing will be detected the next time. A shard that was
+        modified too recently is listed again the next time as well,
+        see BLOB_CATALOG_MARGIN."""
+        listing_time = time.time()
+        found = set()
+        if mtime != None:
+            for fn in os.listdir(self.__get_shard_dir(kind, shard)):
+                fn = str(fn)
+                if kind == blobcatalog.KIND_RECIPE and is_recipe_filename(fn):
+                    found.add(get_recipe_md5(fn))
+                elif kind == blobcatalog.KIND_RAW and is_md5sum(fn):
+                    found.add(fn)
+        found = set([blob for blob in found if blob.startswith(shard)])
+        known = catalog.get_shard_blobs(kind, shard)
+        catalog.remove(kind, known - found)
+        catalog.add(kind, [(blob, self.__get_catalog_file_size(kind, blob), None) for blob in found - known])
+        if mtime != None and listing_time - mtime < BLOB_CATALOG_MARGIN:
+            mtime = None
+        catalog.set_shard(kind, shard, mtime)
+
+    def __get_catalog_file_size(self, kind, blob):
+        if kind == blobcatalog.KIND_RAW:
+            return os.path.getsize(self.get_blob_path(blob))
+        return os.path.getsize(self.get_recipe_path(blob))
+
+    def __update_catalog_shards(self, kind, shards):
+        """Records the current mtimes of the given shards. Must only be
+        called for shards whose catalog entries are known to be up to
+        date. Shards that were modified too recently are forgotten
+        instead, so that they will be listed again."""
+        now = time.time()
+        mtimes = self.__get_shard_mtimes(kind)
+        for shard in shards:
+            mtime = mtimes.get(shard, None)
+            if mtime != None and now - mtime < BLOB_CATALOG_MARGIN:
+                mtime = None
+            self.blob_catalog.set_shard(kind, shard, mtime)
+
+    def get_blob_catalog(self):
+        """Returns the blob catalog. Any shard directory that has been
+        modified since the catalog last saw it is listed again before
+        the catalog is returned, so the catalog can be trusted to
+        match the repository."""
+        if not self.blob_catalog:
+            if self.readonly:
+                dbpath = ":memory:"
+            else:
+                dbpath = os.path.join(self.repopath, DERIVED_BLOB_CATALOG)
+            self.blob_catalog = blobcatalog.BlobCatalog(dbpath)
+        try:
+            for kind in (blobcatalog.KIND_RAW, blobcatalog.KIND_RECIPE):
+                known_mtimes = self.blob_catalog.get_shards(kind)
+                current_mtimes = self.__get_shard_mtimes(kind)
+                for shard in set(known_mtimes.keys()) | set(current_mtimes.keys()):
+                    if known_mtimes.get(shard, None) != current_mtimes.get(shard, None):
+                        self.__scan_shard(self.blob_catalog, kind, shard, current_mtimes.get(shard, None))
+        except:
+            self.blob_catalog.rollback()
+            raise
+        self.blob_catalog.commit()
+        return self.blob_catalog
+
+    def check_blob_catalog(self):
+        """Compares the blob catalog to the files in the repository,
+        and returns a list of descriptions of any differences."""
+        catalog = self.get_blob_catalog()
+        actual = blobcatalog.BlobCatalog(":memory:")
+        for kind in (blobcatalog.KIND_RAW, blobcatalog.KIND_RECIPE):
+            for shard, mtime in self.__get_shard_mtimes(kind).items():
+                self.__scan_shard(actual, kind, shard, mtime)
+        cataloged = dict([((blob, kind), size) for blob, kind, size, revision in catalog.get_entries()])
+        existing = dict([((blob, kind), size) for blob, kind, size, revision in actual.get_entries()])
+        problems = []
+        for blob, kind in sorted(set(cataloged.keys()) | set(existing.keys())):
+            if (blob, kind) not in existing:
+                problems.append("Cataloged %s blob does not exist: %s" % (kind, blob))
+            elif (blob, kind) not in cataloged:
+                problems.append("Existing %s blob is not cataloged: %s" % (kind, blob))
+            elif cataloged[(blob, kind)] != existing[(blob, kind)]:
+                problems.append("Cataloged %s blob has wrong size: %s" % (kind, blob))
+        return problems
+
+    def rebuild_blob_catalog(self):
+        """Recreates the blob catalog from the files in the
+        repository. The owning revision of every blob is found by
+        reading all snapshots and recipes."""
+        assert self.repo_mutex.is_locked()
+        catalog = self.get_blob_catalog()
+        catalog.clear()
+        catalog = self.get_blob_catalog()
+        revisions = {}
+        for sid in sorted(self.get_all_sessions()):
+            for blobinfo in self.get_session(sid).get_raw_bloblist():
+                if 'md5sum' in blobinfo and blobinfo.get("action", None) == None:
+                    revisions.setdefault(blobinfo['md5sum'], sid)
+        for recipe_blob in catalog.get_blobs(blobcatalog.KIND_RECIPE):
+            if recipe_blob not in revisions:
+                continue
+            try:
+                recipe = self.get_recipe(recipe_blob)
+            except CorruptionError:
+                continue # Will be reported by verify
+            for piece in recipe['pieces']:
+                revisions[piece['source']] = min(revisions[recipe_blob],
+                                                 revisions.get(piece['source'], revisions[recipe_blob]))
+        catalog.set_revisions(revisions)
+        catalog.commit()
+        self.__sync_blob_refcounts()
+
+    def _add_to_blob_catalog(self, moved_files, revision):
+        """Adds the given list of (kind, blob) tuples, that have been
+        moved into the repository as part of the given revision, to the
+        blob catalog."""
+        assert self.repo_mutex.is_locked()
+        catalog = self.blob_catalog
+        for kind in (blobcatalog.KIND_RAW, blobcatalog.KIND_RECIPE):
+            blobs = [blob for blob_kind, blob in moved_files if blob_kind == kind]
+            catalog.add(kind, [(blob, self.__get_catalog_file_size(kind, blob), revision) for blob in blobs])
+            self.__update_catalog_shards(kind, set([blob[0:2] for blob in blobs]))
+        catalog.commit()
 
     def get_stats(self):
+        """Returns a list of (name, value) tuples with statistics about
+        the repository. The number of user files and the virtual size
+        are the sums of the files introduced by every snapshot, as
+        recorded in the snapshot statistics. That is the number and
+        total size of the distinct files in all snapshots."""
+        snapshot_stats = self.get_snapshot_stats().values()
         result = []
         result.append(('number_of_snapshots', len(self.get_all_sessions())))
-        result.append(('number_of_user_files', len(self.get_all_level_1_blobs())))
+        result.append(('number_of_user_files', sum([row[2] for row in snapshot_stats])))
         result.append(('number_of_raw_blobs', len(self.get_raw_blob_names())))
         result.append(('number_of_recipes', len(self.get_recipe_names())))
-        virtual_size = sum([self.get_blob_size(md5) for md5 in self.get_all_level_1_blobs()])
-        actual_size = sum([self.get_blob_size(md5) for md5 in self.get_raw_blob_names()])
+        virtual_size = sum([row[3] for row in snapshot_stats])
+        actual_size = self.get_blob_catalog().get_total_size(blobcatalog.KIND_RAW)
         result.append(('virtual_size', virtual_size))
         result.append(('actual_size', actual_size))
         try:
@@ -660,12 +1047,105 @@ class Repo:
             result.append(('dedup_removed_percentage', None))
 
         try:
-            result.append(('dedup_blocksdb_size', os.path.getsize(os.path.join(self.repopath, DERIVED_BLOCKS_DB))))
+            if self.get_dedup_method() == DEDUP_METHOD_CDC:
+                blocksdb_size = os.path.getsize(os.path.join(self.repopath, DERIVED_CHUNKS_DB))
+            else:
+                shards_dir = os.path.join(self.repopath, DERIVED_BLOCKS_SHARDS_DIR)
+                blocksdb_size = sum([os.path.getsize(os.path.join(shards_dir, fn)) for fn in os.listdir(shards_dir)])
+            result.append(('dedup_blocksdb_size', blocksdb_size))
         except:
             result.append(('dedup_blocksdb_size', None))
 
         return result
 
+    def get_session_stats(self):
+        """Returns a list of (session_name, number_of_snapshots,
+        introduced_files, introduced_bytes, stored_bytes) tuples, one
+        for every session, sorted by session name. Deleted snapshots
+        are not counted."""
+        sessions = {}
+        for session_name, deleted, introduced_files, introduced_bytes, stored_bytes in self.get_snapshot_stats().values():
+            if deleted:
+                continue
+            totals = sessions.setdefault(session_name, [0, 0, 0, 0])
+            for n, value in enumerate((1, introduced_files, introduced_bytes, stored_bytes)):
+                totals[n] += value
+        return [tuple([name] + sessions[name]) for name in sorted(sessions.keys())]
+
+    def get_snapshot_stats(self):
+        """Returns a dict on the form revision -> (session_name,
+        deleted, introduced_files, introduced_bytes, stored_bytes) for
+        all snapshots. The statistics are normally recorded at commit,
+        but are recalculated from scratch if they do not match the
+        existing snapshots (for instance after snapshots have been
+        erased, or if the repo has been written by an older version of
+        boar)."""
+        all_stats = self.__open_snapshot_stats().get_all()
+        all_sids = set(self.get_all_sessions())
+        deleted_sids = set(self.get_deleted_snapshots())
+        # A commit in progress may already have recorded its statistics
+        unexpected_sids = set(all_stats.keys()) - all_sids - set([self.get_queued_session_id()])
+        if not all_sids.issubset(all_stats.keys()) or unexpected_sids or \
+                deleted_sids != set([sid for sid in all_sids if all_stats[sid][1]]):
+            self.__recalculate_snapshot_stats()
+            all_stats = self.snapshot_stats.get_all()
+        return dict([(sid, all_stats[sid]) for sid in all_sids])
+
+    def __open_snapshot_stats(self):
+        if not self.snapshot_stats:
+            if self.readonly:
+                dbpath = ":memory:"
+            else:
+                dbpath = os.path.join(self.repopath, DERIVED_SNAPSHOT_STATS)
+            self.snapshot_stats = snapshotstats.SnapshotStats(dbpath)
+        return self.snapshot_stats
+
+    def __recalculate_snapshot_stats(self):
+        self.snapshot_stats.clear()
+        seen_raw_blobs = set()
+        entries = []
+        for sid, introduced_blobs in sorted(self.get_introduced_blobs().items()):
+            session = self.get_session(sid)
+            introduced_bytes = 0
+            stored_bytes = 0
+            for blob in introduced_blobs:
+                introduced_bytes += self.get_blob_size(blob)
+                recipe = self.get_recipe(blob)
+                if recipe:
+                    raw_blobs = set([piece['source'] for piece in recipe['pieces']])
+                else:
+                    raw_blobs = set([blob])
+                for raw_blob in raw_blobs - seen_raw_blobs:
+                    stored_bytes += self.get_blob_size(raw_blob)
+                seen_raw_blobs |= raw_blobs
+            entries.append((sid, session.get_name(), session.is_deleted(),
+                            len(introduced_blobs), introduced_bytes, stored_bytes))
+        self.snapshot_stats.set(entries)
+
+    def __record_snapshot_stats(self, session_id, transaction):
+        """Records the statistics of the given transaction before its
+        blobs are moved into the repository. If the statistics already
+        exist, this is a resumed commit, and the transaction may no
+        longer contain all its blobs."""
+        snapshot_stats = self.__open_snapshot_stats()
+        if session_id in snapshot_stats.get_all():
+            return
+        # Blobs that are already referenced by an earlier snapshot are
+        # not introduced by this one, even if they are in the
+        # transaction. Blobs that are only pieces of recipes are.
+        self.__sync_blob_refcounts()
+        own_counts = {}
+        for blobinfo in transaction.session_reader.get_raw_bloblist():
+            if 'md5sum' in blobinfo and blobinfo.get("action", None) == None:
+                own_counts[blobinfo['md5sum']] = own_counts.get(blobinfo['md5sum'], 0) + 1
+        if session_id not in self.blob_catalog.get_counted_snapshots():
+            own_counts = dict([(blob, 0) for blob in own_counts])
+        user_refs = self.blob_catalog.get_user_refs(own_counts.keys())
+        user_blobs = set([blob for blob in own_counts if user_refs[blob] - own_counts[blob] > 0])
+        introduced_files, introduced_bytes, stored_bytes = transaction.get_stats(user_blobs)
+        snapshot_stats.set([(session_id, transaction.session_reader.get_name(), transaction.session_reader.is_deleted(),
+                                  introduced_files, introduced_bytes, stored_bytes)])
+
     def get_all_level_1_blobs(self):
         """Return a set of all blobs and recipes that are directly
         referred to by any snapshot. (This excludes blobs only used in
@@ -704,37 +1184,163 @@ class Repo:
                 assert not (is_recipe_filename(item) or is_md5sum(item)), \
                     "get_orphan_blobs() must not be called while a non-truncate commit is in progress"
 
-        used_blobs = self.get_all_level_1_blobs()
-        for blob in set(used_blobs):
-            recipe = self.get_recipe(blob)
-            if recipe:
-                for piece in recipe['pieces']:
-                    used_blobs.add(piece['source'])
-
-        orphans = set()
-        orphans.update(self.get_raw_blob_names())
-        orphans.update(self.get_recipe_names())
-        orphans -= used_blobs
+        self.__sync_blob_refcounts()
+        unreferenced = self.blob_catalog.get_unreferenced()
+        orphans = set([blob for blob, kind in unreferenced])
+        # Raw blobs that are only used by orphan recipes are orphans as well
+        piece_counts = {}
+        for blob, kind in unreferenced:
+            if kind != blobcatalog.KIND_RECIPE:
+                continue
+            try:
+                recipe = self.get_recipe(blob)
+            except CorruptionError:
+                continue # An unreadable orphan. Its pieces have not been counted.
+            for source in get_recipe_sources(recipe):
+                piece_counts[source] = piece_counts.get(source, 0) + 1
+        refs = self.blob_catalog.get_refs(piece_counts.keys())
+        for source, count in piece_counts.items():
+            if refs[source] == count and self.has_raw_blob(source):
+                orphans.add(source)
         return orphans
 
+    def __count_snapshot_refs(self, sid, raw_bloblist, sign = 1):
+        """Adds (or, if sign is -1, subtracts) the references of the
+        given snapshot bloblist to the reference counts."""
+        counts = {}
+        for blobinfo in raw_bloblist:
+            if 'md5sum' in blobinfo and blobinfo.get("action", None) == None:
+                counts[blobinfo['md5sum']] = counts.get(blobinfo['md5sum'], 0) + sign
+        self.blob_catalog.add_refs(counts, user = True)
+        self.blob_catalog.set_snapshot_counted(sid, sign > 0)
+
+    def __count_recipe_refs(self, recipe_blob, recipe, sign = 1):
+        self.blob_catalog.add_refs(dict([(source, sign) for source in get_recipe_sources(recipe)]))
+        self.blob_catalog.set_recipe_counted(recipe_blob, sign > 0)
+
+    def __sync_blob_refcounts(self):
+        """Makes sure that the reference counts include all existing
+        snapshots (including a queued one) and recipes. If a counted
+        snapshot or recipe has been erased without being subtracted
+        (by an older version of boar, for instance), all references
+        are counted again."""
+        catalog = self.get_blob_catalog()
+        live_sids = set(self.get_all_sessions()) - set(self.get_deleted_snapshots())
+        queued_sid = self.get_queued_session_id()
+        counted_sids = catalog.get_counted_snapshots()
+        if (counted_sids - live_sids - set([queued_sid])) or catalog.get_vanished_recipes():
+            warn("Recounting blob references")
+            catalog.clear_refs()
+            counted_sids = set()
+        for sid in sorted(live_sids - counted_sids):
+            self.__count_snapshot_refs(sid, self.get_session(sid).get_raw_bloblist())
+        if queued_sid and queued_sid not in counted_sids:
+            queued_session = sessions.SessionReader(None, self.get_path(QUEUE_DIR, str(queued_sid)))
+            self.__count_snapshot_refs(queued_sid, queued_session.get_raw_bloblist())
+        for recipe_blob in catalog.get_uncounted_recipes():
+            try:
+                recipe = self.get_recipe(recipe_blob)
+            except CorruptionError:
+                if catalog.get_refs([recipe_blob])[recipe_blob] > 0:
+                    raise
+                continue # An unreadable orphan. There are no pieces to protect.
+            self.__count_recipe_refs(recipe_blob, recipe)
+        catalog.commit()
+
+    def _count_transaction_refs(self, session_id, transaction, moved_files):
+        """Adds the references of a snapshot that is being committed,
+        and of the recipes it has moved into the repository, to the
+        reference counts. Anything that is missed here (if the commit
+        is resumed, for instance) will be found by
+        __sync_blob_refcounts()."""
+        catalog = self.blob_catalog
+        if session_id not in catalog.get_counted_snapshots():
+            self.__count_snapshot_refs(session_id, transaction.session_reader.get_raw_bloblist())
+        for kind, blob in moved_files:
+            if kind == blobcatalog.KIND_RECIPE and not catalog.is_recipe_counted(blob):
+                self.__count_recipe_refs(blob, self.get_recipe(blob))
+        catalog.commit()
+
+    def check_blob_refcounts(self):
+        """Counts all references to all blobs from scratch, and
+        returns a list of descriptions of any differences from the
+        maintained reference counts."""
+        self.__sync_blob_refcounts()
+        counts = {}
+        def add(blob):
+            counts[blob] = counts.get(blob, 0) + 1
+        live_sids = set(self.get_all_sessions()) - set(self.get_deleted_snapshots())
+        for sid in live_sids:
+            for blobinfo in self.get_session(sid).get_raw_bloblist():
+                if 'md5sum' in blobinfo and blobinfo.get("action", None) == None:
+                    add(blobinfo['md5sum'])
+        for recipe_blob in self.get_recipe_names():
+            try:
+                recipe = self.get_recipe(recipe_blob)
+            except CorruptionError:
+                continue
+            for source in get_recipe_sources(recipe):
+                add(source)
+        maintained = self.blob_catalog.get_all_refs()
+        problems = []
+        for blob in sorted(set(counts.keys()) | set(maintained.keys())):
+            if counts.get(blob, 0) != maintained.get(blob, 0):
+                problems.append("Blob %s has a reference count of %s, but is referenced %s times" % \
+                                    (blob, maintained.get(blob, 0), counts.get(blob, 0)))
+        return problems
+
     def verify_blob(self, sum):
         recipe = self.get_recipe(sum)
         md5_summer = hashlib.md5()
         if recipe:
             reader = create_blob_reader(recipe, self)
-            while reader.bytes_left():
-                md5_summer.update(reader.read(4096))
+            if blobreader.have_memoryview:
+                buf = memoryview(bytearray(VERIFY_READ_SIZE))
+                while reader.bytes_left():
+                    md5_summer.update(buf[:reader.readinto(buf)])
+            else:
+                while reader.bytes_left():
+                    md5_summer.update(reader.read(VERIFY_READ_SIZE))
             return sum == md5_summer.hexdigest()
         if not self.has_raw_blob(sum):
             raise ValueError("No such blob or recipe: " + sum)
         path = self.get_blob_path(sum)
         with safe_open(path, "rb") as f:
-            for block in file_reader(f):
+            for block in file_reader(f, blocksize = VERIFY_READ_SIZE):
                 md5_summer.update(block)
             md5 = md5_summer.hexdigest()
             verified_ok = (sum == md5)
         return verified_ok
 
+    def sort_blobs_by_location(self, blobs):
+        """Returns the given blobs and recipes sorted in an order
+        suitable for reading them all from disk. Raw blobs are ordered
+        by inode number, which on most file systems approximates the
+        physical location. Recipes are placed last."""
+        def location_key(blob):
+            if self.has_raw_blob(blob):
+                return 0, os.stat(self.get_blob_path(blob)).st_ino
+            return 1, blob
+        return sorted(blobs, key = location_key)
+
+    def get_blob_file_stat(self, sum):
+        """Returns a tuple (size, mtime) for the file containing the
+        given raw blob or recipe."""
+        path = self.get_blob_path(sum)
+        if not os.path.exists(path):
+            path = self.get_recipe_path(sum)
+        st = os.stat(path)
+        return long(st.st_size), int(st.st_mtime)
+
+    def get_verify_ledger(self):
+        if not self.verify_ledger:
+            if self.readonly:
+                dbpath = ":memory:"
+            else:
+                dbpath = os.path.join(self.repopath, DERIVED_VERIFY_LEDGER)
+            self.verify_ledger = verifyledger.VerificationLedger(dbpath)
+        return self.verify_ledger
+
     def find_redundant_raw_blobs(self):
         all_blobs = self.get_raw_blob_names()
         for blob in all_blobs:
@@ -829,6 +1435,8 @@ class Repo:
             raise MisuseError("Erasing rev %s would create orphan snapshots" % rev)
         if rev in self.session_readers:
             del self.session_readers[rev]
+        self.bloblist_cache.invalidate(rev)
+        self.session_index.invalidate(rev)
 
         session_path = self.get_session_path(rev)
         delete_copy = os.path.join(session_path, "deleted")
@@ -850,7 +1458,15 @@ class Repo:
         writer.delete(deleted_session_name = session_data['client_data']['name'], deleted_fingerprint = session_data['fingerprint'])
         writer.set_fingerprint("d41d8cd98f00b204e9800998ecf8427e")
         writer.commit()
+        catalog = self.get_blob_catalog()
+        if rev in catalog.get_counted_snapshots():
+            self.__count_snapshot_refs(rev, sessions.SessionReader(None, delete_copy).get_raw_bloblist(), -1)
+            catalog.commit()
         os.rename(delete_copy, os.path.join(trashdir, str(rev) + ".deleted"))
+        # Make sure the index reflects the deleted state of the snapshot
+        if rev in self.session_readers:
+            del self.session_readers[rev]
+        self.session_index.invalidate(rev)
 
     def erase_orphan_blobs(self):
         assert self.repo_mutex.is_locked()
@@ -860,18 +1476,32 @@ class Repo:
         orphan_blobs = self.get_orphan_blobs()
         trashdir = tempfile.mkdtemp(prefix = "TRASH_erased_blobs_", dir = self.get_path(TMP_DIR))
 
-        self.blocksdb.begin()
-        self.blocksdb.delete_blocks([blob for blob in orphan_blobs if self.has_raw_blob(blob)])
-        self.blocksdb.commit()
+        for db in (self.blocksdb, self.chunksdb):
+            if db:
+                db.begin()
+                db.delete_blocks([blob for blob in orphan_blobs if self.has_raw_blob(blob)])
+                db.commit()
 
+        erased = {blobcatalog.KIND_RAW: [], blobcatalog.KIND_RECIPE: []}
         for blob in orphan_blobs:
             if self.has_recipe_blob(blob):
                 recipe_path = self.get_recipe_path(blob)
+                if self.blob_catalog.is_recipe_counted(blob):
+                    self.__count_recipe_refs(blob, self.get_recipe(blob), -1)
                 os.rename(recipe_path, os.path.join(trashdir, blob + ".recipe"))
+                erased[blobcatalog.KIND_RECIPE].append(blob)
             elif self.has_raw_blob(blob):
                 os.rename(self.get_blob_path(blob), os.path.join(trashdir, blob))
+                erased[blobcatalog.KIND_RAW].append(blob)
             else:
                 warn("Tried to erase a non-existing blob: %s" % blob)
+        for kind, blobs in erased.items():
+            self.blob_catalog.remove(kind, blobs)
+            self.__update_catalog_shards(kind, set([blob[0:2] for blob in blobs]))
+        self.blob_catalog.commit()
+        # Otherwise the ledger would keep the entries of erased blobs
+        # forever
+        self.get_verify_ledger().forget(erased[blobcatalog.KIND_RAW] + erased[blobcatalog.KIND_RECIPE])
         return len(orphan_blobs)
 
     def process_queue(self, progress_callback = lambda x: None):
@@ -913,7 +1543,11 @@ class Repo:
         sw.mark("Meta check 2")
 
         # Everything seems OK, move the blobs and consolidate the session
-        transaction.integrate_files()
+        self.__record_snapshot_stats(session_id, transaction)
+        self.get_blob_catalog() # Catch up with any changes before the new blobs are added
+        moved_files = transaction.integrate_files()
+        self._add_to_blob_catalog(moved_files, session_id)
+        self._count_transaction_refs(session_id, transaction, moved_files)
         sw.mark("Files integrated")
 
         transaction.integrate_deletions()
@@ -930,6 +1564,7 @@ class Repo:
         self._before_transaction_completion()
         shutil.move(queued_item, session_path)
         assert not self.get_queued_session_id(), "Commit completed, but queue should be empty after processing"
+        self.session_index.sync()
         progress_callback(1.0)
         sw.mark("done")
 
@@ -962,6 +1597,10 @@ class Transaction:
 
 
     def integrate_files(self):
+        """Moves the blobs and recipes of the transaction into the
+        repository. Returns a list of (kind, blob) tuples for the moved
+        files, where kind is one of the blob catalog kinds."""
+        moved_files = []
         for filename in os.listdir(self.path):
             if is_md5sum(filename):
                 # Any redundant blobs should have been trimmed above
@@ -969,14 +1608,17 @@ class Transaction:
                 blob_to_move = os.path.join(self.path, filename)
                 destination_path = self.repo.get_blob_path(filename)
                 move_file(blob_to_move, destination_path, mkdirs = True)
+                moved_files.append((blobcatalog.KIND_RAW, str(filename)))
             elif is_recipe_filename(filename):
                 # Any redundant recipes should have been trimmed above
                 assert not self.repo.has_blob(get_recipe_md5(filename))
                 recipe_to_move = os.path.join(self.path, filename)
                 destination_path = self.repo.get_recipe_path(filename)
                 move_file(recipe_to_move, destination_path, mkdirs = True)
+                moved_files.append((blobcatalog.KIND_RECIPE, str(get_recipe_md5(filename))))
             else:
                 pass # The rest becomes a snapshot definition directory
+        return moved_files
 
 
     def integrate_blocks(self):
@@ -985,21 +1627,65 @@ class Transaction:
         if not os.path.exists(blocks_fname):
             return
         blocks = read_json(blocks_fname)
+        if self.repo.chunksdb:
+            self.__integrate_chunks(blocks)
+            safe_delete_file(blocks_fname)
+            return
+        # Possibly another commit sneaked in a recipe while we
+        # were looking the other way. Let's be lenient for now.
+
+        # assert self.has_raw_blob(blob_md5), "Tried to register a
+        # block for non-existing blob %s" % blob_md5
+        raw_blobs = set([blob_md5 for blob_md5 in set([block_spec[0] for block_spec in blocks])
+                         if self.repo.has_raw_blob(blob_md5)])
+        blocks = [block_spec for block_spec in blocks if block_spec[0] in raw_blobs]
+        rolling_filter = self.repo.open_rolling_filter()
         blocksdb.begin()
-        for block_spec in blocks:
-            blob_md5, offset, rolling, sha256 = block_spec
-            # Possibly another commit sneaked in a recipe while we
-            # were looking the other way. Let's be lenient for now.
-
-            # assert self.has_raw_blob(blob_md5), "Tried to register a
-            # block for non-existing blob %s" % blob_md5
-            if self.repo.has_raw_blob(blob_md5):
-                blocksdb.add_block(blob_md5, offset, sha256)
-                blocksdb.add_rolling(rolling)
+        blocksdb.add_blocks([(blob_md5, offset, sha256) for blob_md5, offset, rolling, sha256 in blocks])
+        blocksdb.add_rollings([rolling for blob_md5, offset, rolling, sha256 in blocks])
         blocksdb.commit()
+        if rolling_filter:
+            for blob_md5, offset, rolling, sha256 in blocks:
+                if not rolling_filter.contains(rolling):
+                    rolling_filter.add(rolling)
+        if rolling_filter:
+            rolling_filter.flush(blocksdb.get_modcount())
         safe_delete_file(blocks_fname)
 
 
+    def __integrate_chunks(self, chunks):
+        chunksdb = self.repo.chunksdb
+        chunksdb.begin()
+        for blob_md5, offset, size, md5 in chunks:
+            if self.repo.has_raw_blob(blob_md5):
+                chunksdb.add_chunk(blob_md5, offset, size, md5)
+        chunksdb.commit()
+
+    def get_stats(self, user_blobs):
+        """Returns a tuple (introduced_files, introduced_bytes,
+        stored_bytes) for the blobs of this transaction. The given set
+        of user_blobs are the blobs that are already referenced by
+        earlier snapshots. Any other blob that this snapshot refers to
+        is introduced by it, whether it is new or already stored in
+        the repository as a recipe piece. See snapshotstats.py."""
+        used_blobs = set([blobinfo['md5sum'] for blobinfo in self.session_reader.get_raw_bloblist()
+                          if 'md5sum' in blobinfo and blobinfo.get("action", None) == None])
+        introduced_blobs = used_blobs - user_blobs
+        raw_blobs = set(self.get_raw_blobs())
+        recipes = set(self.get_recipes())
+        introduced_bytes = 0
+        stored_bytes = 0
+        for blob in raw_blobs:
+            stored_bytes += os.path.getsize(self.get_path(blob))
+        for blob in introduced_blobs:
+            if blob in recipes:
+                introduced_bytes += read_json(self.get_recipe_path(blob))['size']
+            elif blob in raw_blobs:
+                introduced_bytes += os.path.getsize(self.get_path(blob))
+            else:
+                introduced_bytes += self.repo.get_blob_size(blob)
+        return len(introduced_blobs), introduced_bytes, stored_bytes
+
     def get_raw_blobs(self):
         """Returns a list of all raw blobs that are present in the transaction directory"""
         return [fn for fn in os.listdir(self.path) if is_md5sum(fn)]
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The session index keeps track of the session name and deletion state
+of every snapshot in the repository, so that questions such as "what
+is the latest revision of this session?" can be answered without
+reading every session.json in the repository.
+
+The index is derived data. It is only written to disk while the repo
+mutex is held, but it is validated against the sessions directory
+every time it is used. The directory is only listed again if its
+mtime has changed. Snapshots that are not yet in the index are simply
+read and added, and an index file with a bad checksum is ignored and
+rebuilt.
+"""
+
+import os
+import time
+
+from common import *
+
+INDEX_VERSION = 1
+
+# A listing of the sessions directory is only reused if the directory
+# had not been modified for this many seconds when it was
+# listed. Otherwise, a change within the timestamp resolution of the
+# file system could go unnoticed.
+SESSIONS_DIR_MARGIN = 5.0
+
+class SessionIndex:
+    def __init__(self, repo, index_path, sessions_dir):
+        assert isinstance(index_path, unicode)
+        self.repo = repo
+        self.index_path = index_path
+        self.sessions_dir = sessions_dir
+        self.sessions_dir_stat = None # As of the last listing that can be reused
+        self.index_file_stat = None
+        self.snapshots = {} # sid -> (session name, is deleted)
+        self.revisions_by_name = None # session name -> sorted list of sids
+        self.deleted_snapshots = None
+
+    def __stat_index_file(self):
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def __stat_sessions_dir(self):
+        st = os.stat(self.sessions_dir)
+        return st.st_ino, st.st_mtime
+
+    def __load(self):
+        """Loads the index from disk. Returns False if there is no
+        usable index file."""
+        self.index_file_stat = self.__stat_index_file()
+        self.sessions_dir_stat = None
+        self.snapshots = {}
+        if self.index_file_stat == None:
+            return False
+        try:
+            data = read_json(self.index_path)
+            assert data['version'] == INDEX_VERSION
+            snapshots = data['snapshots']
+            assert md5sum(json.dumps(snapshots, sort_keys = True)) == data['checksum']
+        except (ValueError, KeyError, TypeError, AssertionError, IOError):
+            warn("Ignoring invalid session index")
+            return False
+        for sid, (name, deleted) in snapshots.items():
+            self.snapshots[int(sid)] = (name, deleted)
+        return True
+
+    def __read_snapshot(self, sid):
+        session = self.repo.get_session(sid)
+        return session.get_name(), session.is_deleted()
+
+    def __refresh(self):
+        """Makes sure that the in-memory index reflects the current
+        state of the repository. Returns True if the in-memory index
+        differs from what is stored on disk."""
+        dirty = False
+        if self.index_file_stat == None or self.__stat_index_file() != self.index_file_stat:
+            # First use, or somebody else has updated the index file
+            dirty = not self.__load()
+            self.revisions_by_name = None
+        sessions_dir_stat = self.__stat_sessions_dir()
+        if sessions_dir_stat != self.sessions_dir_stat:
+            listing_time = time.time()
+            existing_sids = self.repo.get_all_sessions()
+            if len(existing_sids) != len(self.snapshots) or set(existing_sids) != set(self.snapshots):
+                dirty = True
+                self.revisions_by_name = None
+                for sid in set(self.snapshots) - set(existing_sids):
+                    del self.snapshots[sid]
+                for sid in set(existing_sids) - set(self.snapshots):
+                    self.snapshots[sid] = self.__read_snapshot(sid)
+            if listing_time - sessions_dir_stat[1] >= SESSIONS_DIR_MARGIN:
+                self.sessions_dir_stat = sessions_dir_stat
+            else:
+                self.sessions_dir_stat = None
+        if self.revisions_by_name == None:
+            self.__rebuild_lookup_tables()
+        return dirty
+
+    def __rebuild_lookup_tables(self):
+        self.revisions_by_name = {}
+        self.deleted_snapshots = []
+        for sid in sorted(self.snapshots.keys()):
+            name, deleted = self.snapshots[sid]
+            self.revisions_by_name.setdefault(name, []).append(sid)
+            if deleted:
+                self.deleted_snapshots.append(sid)
+
+    def __save(self):
+        snapshots = dict([(str(sid), value) for sid, value in self.snapshots.items()])
+        data = {'version': INDEX_VERSION,
+                'checksum': md5sum(json.dumps(snapshots, sort_keys = True)),
+                'snapshots': snapshots}
+        replace_file(self.index_path, json.dumps(data))
+        self.index_file_stat = self.__stat_index_file()
+
+    def sync(self):
+        """Brings the index up to date and writes it to disk if
+        needed. Must only be called while holding the repo mutex."""
+        assert self.repo.repo_mutex.is_locked()
+        assert not self.repo.readonly
+        if self.__refresh():
+            self.__save()
+
+    def invalidate(self, sid):
+        """Must be called before an existing snapshot is modified
+        (i.e. erased). The snapshot is removed from the index on disk
+        and will be read again the next time the index is used."""
+        assert self.repo.repo_mutex.is_locked()
+        self.__refresh()
+        del self.snapshots[sid]
+        self.revisions_by_name = None
+        self.sessions_dir_stat = None # So that the snapshot is read again
+        self.__save()
+
+    def find_last_revision(self, session_name):
+        self.__refresh()
+        revisions = self.revisions_by_name.get(session_name, None)
+        if not revisions:
+            return None
+        return revisions[-1]
+
+    def get_revisions(self, session_name):
+        self.__refresh()
+        return list(self.revisions_by_name.get(session_name, []))
+
+    def get_session_names(self):
+        self.__refresh()
+        return self.revisions_by_name.keys()
+
+    def get_deleted_snapshots(self):
+        self.__refresh()
+        return list(self.deleted_snapshots)
@@ -28,12 +28,28 @@ from boar_exceptions import *
 import shutil
 import hashlib
 import types
+import threading
+import Queue
 
 from common import *
 from boar_common import *
 
 import deduplication
 
+# The number of blobs that a session writer may deduplicate at the
+# same time, in worker threads. The rolling checksum scan releases the
+# GIL, so several cores can be used. Blobs that are deduplicated at
+# the same time can not reuse each others blocks, so this is off by
+# default.
+try:
+    DEDUP_THREADS = max(1, int(os.getenv("BOAR_DEDUP_THREADS", "1")))
+except ValueError:
+    DEDUP_THREADS = 1
+
+# The max number of fragments of a blob that may be waiting for its
+# worker thread.
+DEDUP_QUEUE_SIZE = 16
+
 """
 The SessionWriter and SessionReader are together with Repository the
 only classes that directly accesses the repository.
@@ -186,8 +202,11 @@ class _NaiveSessionWriter:
 class PieceHandler(deduplication.OriginalPieceHandler):
     """ A PieceHandler handles all the original data for a single
     uploaded blob. A continous length of original data is called a
-    'piece'."""
-    def __init__(self, session_dir, block_size, tmpdir, BlockifierClass):
+    'piece'. After closing, 'blocks' is a list of (blob, offset,
+    rolling, md5) tuples for the blocks of the stored data. For
+    content defined chunks, the rolling checksum is replaced by the
+    size of the chunk."""
+    def __init__(self, session_dir, block_size, tmpdir, BlockifierClass, amalgam_name = "amalgam"):
         assert os.path.isdir(session_dir)
         assert block_size > 0
         self.block_size = block_size
@@ -198,7 +217,7 @@ class PieceHandler(deduplication.OriginalPieceHandler):
         self.current_index = None
         self.tmpdir = tmpdir
         self.BlockifierClass = BlockifierClass
-        self.filename = os.path.join(self.session_dir, "amalgam")
+        self.filename = os.path.join(self.session_dir, amalgam_name)
         assert not os.path.exists(self.filename)
         self.fileobj = open(self.filename, "wb")
         self.md5summer = hashlib.md5()
@@ -256,6 +275,18 @@ class PieceHandler(deduplication.OriginalPieceHandler):
         assert self.fileobj == None
         return self.final_md5, self.piece_start_offsets[index]
 
+class _DedupJob:
+    """ A blob that is deduplicated by a worker thread. The fragments
+    of the blob are passed to the worker through a queue, ending with
+    None."""
+    def __init__(self, blob_md5, deduplicator):
+        self.blob_md5 = blob_md5
+        self.deduplicator = deduplicator
+        self.fragments = Queue.Queue(DEDUP_QUEUE_SIZE)
+        self.error = None # The exc_info of any exception in the worker
+        self.cancelled = False
+        self.thread = None
+
 class SessionWriter:
     def __init__(self, repo, session_name, base_session = None, session_id = None, force_base_snapshot = False):
         assert session_name and isinstance(session_name, unicode)
@@ -266,6 +297,9 @@ class SessionWriter:
         self.dead = False
         self.repo = repo
         self.tmpblocksdb = deduplication.TmpBlocksDB(self.repo.blocksdb)
+        self.tmpchunksdb = None
+        if self.repo.chunksdb:
+            self.tmpchunksdb = deduplication.TmpChunksDB(self.repo.chunksdb)
         self.session_name = session_name
         self.max_blob_size = None
         self.base_session = base_session
@@ -273,9 +307,11 @@ class SessionWriter:
         self.metadatas = {}
         self.found_uncommitted_blocks = []
         self.blob_deduplicator = {}
+        self.dedup_threads = DEDUP_THREADS
+        self.dedup_slots = None
+        self.dedup_jobs = {} # blob md5 -> _DedupJob
 
-        all_rolling = self.repo.blocksdb.get_all_rolling()
-        self.rolling_set = deduplication.CreateIntegerSet(all_rolling)
+        self.rolling_set = self.repo.get_rolling_set()
 
         self.session_mutex = FileMutex(os.path.join(self.repo.repopath, repository.TMP_DIR), self.session_name)
         self.session_mutex.lock()
@@ -309,8 +345,21 @@ class SessionWriter:
 
     def cancel(self):
         self.dead = True
+        self.__stop_all_jobs()
         self.session_mutex.release()
 
+    def __stop_all_jobs(self):
+        """ Stops all worker threads. The jobs of blobs that have not
+        been finished are cancelled."""
+        for job in self.dedup_jobs.values():
+            if job.blob_md5 in self.blob_deduplicator:
+                # The blob will never be finished
+                job.cancelled = True
+                job.fragments.put(None)
+        for job in self.dedup_jobs.values():
+            job.thread.join()
+        self.dedup_jobs = {}
+
     def deleted_snapshot(self, deleted_name, deleted_fingerprint):
         self.writer.delete(deleted_name, deleted_fingerprint)
 
@@ -325,6 +374,9 @@ class SessionWriter:
         # here. Possibly some other session is uploading, or has
         # uploaded this blob, before we get here. But that is ok.
         assert not self.dead
+        assert blob_md5 not in self.blob_deduplicator
+        # The same blob might still be deduplicated by a worker.
+        self.__wait_for_blob(blob_md5)
         if self.repo.deduplication_enabled():
             assert deduplication.dedup_available, "Deduplication module not available"
             rollingchecksumclass = deduplication.RollingChecksum
@@ -333,43 +385,132 @@ class SessionWriter:
             rollingchecksumclass = deduplication.FakeRollingChecksum
             blockifierclass = deduplication.FakeBlockChecksum
 
-        fname = os.path.join(self.session_path, blob_md5)
-        blobsource = deduplication.UniformBlobGetter(self.repo, self.session_path)
-        self.blob_deduplicator[blob_md5] = \
-            deduplication.RecipeFinder(self.tmpblocksdb,
-                                       repository.DEDUP_BLOCK_SIZE,
-                                       self.rolling_set,
-                                       blobsource,
-                                       PieceHandler(self.session_path, repository.DEDUP_BLOCK_SIZE,
-                                                    tmpdir = self.repo.get_tmpdir(),
-                                                    BlockifierClass = blockifierclass),
-                                       tmpdir = self.repo.get_tmpdir(),
-                                       RollingChecksumClass = rollingchecksumclass)
+        # Several blobs may be in progress at once, so they need
+        # separate amalgam files.
+        amalgam_name = "amalgam_" + blob_md5
+        if self.tmpchunksdb:
+            self.blob_deduplicator[blob_md5] = \
+                deduplication.ChunkRecipeFinder(self.tmpchunksdb,
+                                                PieceHandler(self.session_path, repository.DEDUP_AVG_CHUNK_SIZE,
+                                                             tmpdir = self.repo.get_tmpdir(),
+                                                             BlockifierClass = deduplication.ChunkChecksum,
+                                                             amalgam_name = amalgam_name))
+        else:
+            blobsource = deduplication.UniformBlobGetter(self.repo, self.session_path)
+            self.blob_deduplicator[blob_md5] = \
+                deduplication.RecipeFinder(self.tmpblocksdb,
+                                           repository.DEDUP_BLOCK_SIZE,
+                                           self.rolling_set,
+                                           blobsource,
+                                           PieceHandler(self.session_path, repository.DEDUP_BLOCK_SIZE,
+                                                        tmpdir = self.repo.get_tmpdir(),
+                                                        BlockifierClass = blockifierclass,
+                                                        amalgam_name = amalgam_name),
+                                           tmpdir = self.repo.get_tmpdir(),
+                                           RollingChecksumClass = rollingchecksumclass)
+        if self.dedup_threads > 1:
+            self.__start_dedup_job(blob_md5)
+
+    def __start_dedup_job(self, blob_md5):
+        """ Starts a worker thread that deduplicates the given blob
+        while it is being received. If all worker slots are taken,
+        the blob is deduplicated by the calling thread instead. Waiting
+        for a slot could hang forever, since a slot is only released
+        when the caller has finished its blob."""
+        if self.dedup_slots == None:
+            self.dedup_slots = threading.Semaphore(self.dedup_threads)
+        if not self.dedup_slots.acquire(False):
+            return
+        job = _DedupJob(blob_md5, self.blob_deduplicator[blob_md5])
+        job.thread = threading.Thread(target = self.__dedup_worker, args = (job,))
+        job.thread.setDaemon(True)
+        self.dedup_jobs[blob_md5] = job
+        job.thread.start()
+
+    def __dedup_worker(self, job):
+        """ The worker thread of a job. Any error is saved in the
+        job, to be raised in the calling thread when the job is waited
+        for. The queue is always drained, so that the calling thread
+        never blocks on a failed job."""
+        try:
+            fragment = job.fragments.get()
+            while fragment != None:
+                if not job.error:
+                    try:
+                        job.deduplicator.feed(fragment)
+                    except Exception:
+                        job.error = sys.exc_info()
+                fragment = job.fragments.get()
+            if not job.error and not job.cancelled:
+                self.__finish_blob(job.blob_md5, job.deduplicator)
+        except Exception:
+            job.error = sys.exc_info()
+        finally:
+            self.dedup_slots.release()
+
+    def __wait_for_blob(self, blob_md5):
+        """ Waits until the given blob is no longer being deduplicated
+        by a worker thread. Raises any error that occured in the worker."""
+        job = self.dedup_jobs.pop(blob_md5, None)
+        if job:
+            job.thread.join()
+            if job.error:
+                raise job.error[0], job.error[1], job.error[2]
+
+    def __wait_for_all_blobs(self):
+        if self.blob_deduplicator:
+            # The workers of unfinished blobs would wait forever for
+            # the rest of their data
+            unfinished = sorted(self.blob_deduplicator.keys())
+            self.dead = True
+            self.__stop_all_jobs()
+            raise MisuseError("Tried to commit while blobs are unfinished: %s" % ", ".join(unfinished))
+        for blob_md5 in self.dedup_jobs.keys():
+            self.__wait_for_blob(blob_md5)
 
 
     def add_blob_data(self, blob_md5, fragment):
         """ Adds the given fragment to the end of the new blob with the given checksum."""
         assert is_md5sum(blob_md5)
         assert not self.dead
-        self.blob_deduplicator[blob_md5].feed(fragment)
+        if blob_md5 in self.dedup_jobs:
+            self.dedup_jobs[blob_md5].fragments.put(fragment)
+        else:
+            self.blob_deduplicator[blob_md5].feed(fragment)
 
     def blob_finished(self, blob_md5):
+        """ Must be called when all data for the blob has been
+        added. If the blob is deduplicated by a worker thread, this
+        method returns before the worker is done."""
+        assert not self.dead
+        deduplicator = self.blob_deduplicator.pop(blob_md5)
+        if blob_md5 in self.dedup_jobs:
+            self.dedup_jobs[blob_md5].fragments.put(None)
+        else:
+            self.__finish_blob(blob_md5, deduplicator)
+
+    def __finish_blob(self, blob_md5, deduplicator):
+        """ Closes the deduplicator for the given blob, makes the new
+        blocks visible to the other blobs and writes the recipe, if
+        any. May be called from a worker thread."""
         sw = StopWatch(enabled=False, name="session.blob_finished")
-        self.blob_deduplicator[blob_md5].close()
-        for block in self.blob_deduplicator[blob_md5].original_piece_handler.blocks:
+        deduplicator.close()
+        for block in deduplicator.original_piece_handler.blocks:
             # Let the recipe finder know about these blocks
-            self.rolling_set.add(block[2])
-            self.tmpblocksdb.add_tmp_block(md5 = block[3], blob = block[0], offset = block[1])
+            if self.tmpchunksdb:
+                self.tmpchunksdb.add_tmp_chunk(md5 = block[3], blob = block[0], offset = block[1], size = block[2])
+            else:
+                self.rolling_set.add(block[2])
+                self.tmpblocksdb.add_tmp_block(md5 = block[3], blob = block[0], offset = block[1])
             self.found_uncommitted_blocks.append(block)
 
         sw.mark(1)
-        recipe = self.blob_deduplicator[blob_md5].get_recipe()
+        recipe = deduplicator.get_recipe()
         assert len(recipe['pieces']) > 0
         if len(recipe['pieces']) == 1 and recipe['pieces'][0]['source'] == blob_md5:
             recipe = None
         sw.mark(2)
         if recipe:
-            recipe = self.blob_deduplicator[blob_md5].get_recipe()
             recipe_json = json.dumps(recipe, indent = 4)
             recipe_md5 = md5sum(recipe_json)
             recipe_path = os.path.join(self.session_path, blob_md5 + ".recipe")
@@ -377,10 +518,14 @@ class SessionWriter:
                 with StrictFileWriter(recipe_path, recipe_md5, len(recipe_json)) as recipe_file:
                     recipe_file.write(recipe_json)
         sw.mark(3)
-        del self.blob_deduplicator[blob_md5]
 
     def has_blob(self, csum):
+        """ Returns True if the given blob has been added to this
+        session. A blob that is still being deduplicated by a worker
+        thread counts as added."""
         assert is_md5sum(csum)
+        if csum in self.dedup_jobs and csum not in self.blob_deduplicator:
+            return True
         fname = os.path.join(self.session_path, csum)
         return os.path.exists(fname)
 
@@ -429,6 +574,7 @@ class SessionWriter:
     def __commit(self, sessioninfo, progress_callback = lambda x: None):
         assert not self.dead
         assert self.session_path != None
+        self.__wait_for_all_blobs()
 
         if "name" in sessioninfo:
             assert self.session_name == sessioninfo['name'], \
@@ -468,6 +614,8 @@ class SessionWriter:
         # It is not meant to be 100% safe. That responsibility lies with the lockfile.
         assert self.latest_snapshot == self.repo.find_last_revision(self.session_name), \
             "Session has been updated concurrently (Should not happen. Lockfile problems?) Commit aborted."
+        # Release the mapped rolling filter, the repo will update it
+        self.rolling_set = None
         session_id = self.repo.consolidate_snapshot(self.session_path, self.forced_session_id, progress_callback = progress_callback)
         return session_id
 
@@ -477,13 +625,18 @@ class SessionWriter:
 
 
 class SessionReader:
-    def __init__(self, repo, session_path):
+    def __init__(self, repo, session_path, session_id = None):
         assert session_path, "Session path must be given"
         assert isinstance(session_path, unicode)
+        assert session_id == None or isinstance(session_id, int)
+        # The session id is only given for committed snapshots. It is
+        # used as the key for the bloblist cache.
+        self.session_id = session_id
         if os.path.exists(os.path.join(session_path, "deleted")):
             # If a session is in the middle of being deleted, read all
             # data from the deletion folder instead
             session_path = os.path.join(session_path, "deleted")
+            self.session_id = None
         self.path = session_path
         self.dirname = os.path.basename(self.path)
         self.repo = repo
@@ -567,36 +720,52 @@ class SessionReader:
             except ValueError: # JSON decoding error
                 raise CorruptionError("Bloblist for snapshot %s is mangled" % self.dirname)
 
-    def get_all_blob_infos(self):
-        # Diffucult to optimize this one. Caching the full blob list
-        # is not necessarily faster. Caching the raw bloblists and
-        # reconstructing the full bloblist as needed, seems to be the
-        # way to go until we can cache the bloblist in binary form
-        # somewhere.
+    def __get_cached_bloblist(self):
+        """Returns a tuple (bloblist dict, load stats) from the
+        bloblist cache, or None if this snapshot is not cached."""
+        if self.session_id == None or self.repo == None:
+            return None
+        cached = self.repo.bloblist_cache.get(self.session_id, self.get_fingerprint())
+        if cached == None:
+            return None
+        bloblist, load_stats = cached
+        return bloblist_to_dict(bloblist), load_stats
+
+    def get_all_blob_infos(self, use_cache = True):
+        # The full bloblist is reconstructed by applying the raw
+        # bloblists of the base snapshot chain, starting from the
+        # nearest snapshot that has a valid entry in the bloblist
+        # cache. The result is then cached for this snapshot. The
+        # cache must be bypassed when verifying the repository.
         self.quick_quick_verify()
         session_obj = self
-        all_session_objs = [self]
+        uncached_session_objs = []
         while True:
+            cached = use_cache and session_obj.__get_cached_bloblist()
+            if cached:
+                bloblist, load_stats = cached
+                break
+            uncached_session_objs.insert(0, session_obj)
             base_session_id = session_obj.properties.get("base_session", None)
             if base_session_id == None:
+                bloblist = {}
+                load_stats = { "add_count": 0, "remove_count": 0, "total_count": 0 }
                 break
             try:
                 session_obj = self.repo.get_session(base_session_id)
             except MisuseError:
                 # Missing session here means repo corruption
                 raise CorruptionError("Required base snapshot %s is missing" % base_session_id)
-            all_session_objs.insert(0, session_obj)
-        self.load_stats = { "add_count": 0, "remove_count": 0, "total_count": 0 }
-        bloblist = {}
-        for session_obj in all_session_objs:
+        for session_obj in uncached_session_objs:
             rawbloblist = session_obj.get_raw_bloblist()
             for blobinfo in rawbloblist:
                 if blobinfo.get("action", None) == "remove":
-                    self.load_stats['remove_count'] += 1
+                    load_stats['remove_count'] += 1
                 else:
-                    self.load_stats['add_count'] += 1
+                    load_stats['add_count'] += 1
             apply_delta(bloblist, rawbloblist)
-        self.load_stats['total_count'] = len(bloblist)
+        load_stats['total_count'] = len(bloblist)
+        self.load_stats = copy.copy(load_stats)
+        if use_cache and uncached_session_objs and self.session_id != None:
+            self.repo.bloblist_cache.put(self.session_id, self.get_fingerprint(), bloblist.values(), load_stats)
         return bloblist.values()
-
-
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The snapshot statistics table records, for every snapshot, how many
+new blobs (files with contents not used by any earlier snapshot) it
+introduced, the total size of those blobs, and the number of bytes
+that actually had to be stored for them. The difference between the
+last two is the deduplication savings of the snapshot.
+
+The statistics are recorded when a snapshot is committed, so that the
+statistics of the whole repository can be summed up without reading
+every snapshot and blob. The table is derived data, and can be deleted
+at any time. It will then be recalculated from the snapshots.
+"""
+
+import os
+import sqlite3
+
+from common import *
+from boar_exceptions import SoftCorruptionError, UserError
+
+class SnapshotStats:
+    def __init__(self, dbpath):
+        assert dbpath == ":memory:" or os.path.isabs(dbpath)
+        self.dbpath = dbpath
+        try:
+            self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (revision INT PRIMARY KEY, session_name TEXT NOT NULL, deleted INT NOT NULL, introduced_files INT NOT NULL, introduced_bytes INT NOT NULL, stored_bytes INT NOT NULL)")
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            # For instance "database is locked", which is not corruption
+            raise UserError("Snapshot statistics could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Snapshot statistics are corrupt: %s" % e)
+
+    def get_all(self):
+        """Returns a dict on the form revision -> (session_name,
+        deleted, introduced_files, introduced_bytes, stored_bytes) for
+        all snapshots in the table."""
+        try:
+            rows = self.conn.execute("SELECT revision, session_name, deleted, introduced_files, introduced_bytes, stored_bytes FROM snapshots").fetchall()
+        except sqlite3.OperationalError, e:
+            raise UserError("Snapshot statistics could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Snapshot statistics are corrupt: %s" % e)
+        result = {}
+        for revision, session_name, deleted, introduced_files, introduced_bytes, stored_bytes in rows:
+            result[revision] = (session_name, bool(deleted), introduced_files, introduced_bytes, stored_bytes)
+        return result
+
+    def set(self, entries):
+        """Records the given list of (revision, session_name, deleted,
+        introduced_files, introduced_bytes, stored_bytes) tuples."""
+        try:
+            self.conn.executemany("REPLACE INTO snapshots (revision, session_name, deleted, introduced_files, introduced_bytes, stored_bytes) VALUES (?, ?, ?, ?, ?, ?)", entries)
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            raise UserError("Snapshot statistics could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Snapshot statistics are corrupt: %s" % e)
+
+    def clear(self):
+        try:
+            self.conn.execute("DELETE FROM snapshots")
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            raise UserError("Snapshot statistics could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Snapshot statistics are corrupt: %s" % e)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+import sys, os, unittest, tempfile, shutil
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from blobrepo import blobreader
+from boar_exceptions import CorruptionError
+from common import md5sum
+
+class FakeRepo:
+    def __init__(self, blobdir):
+        self.blobdir = blobdir
+
+    def get_blob_path(self, blob):
+        return os.path.join(self.blobdir, blob)
+
+class TestRecipeReader(unittest.TestCase):
+    def setUp(self):
+        self.blobdir = tempfile.mkdtemp(prefix='boar_test_blobreader_')
+        self.repo = FakeRepo(self.blobdir)
+        self.blobs = {}
+        for n in range(0, blobreader.MAX_OPEN_BLOBS + 2):
+            self.add_blob("".join([chr(ord("a") + n)] * 10) + "0123456789")
+
+    def tearDown(self):
+        shutil.rmtree(self.blobdir, ignore_errors = True)
+
+    def add_blob(self, data):
+        blob = md5sum(data)
+        with open(self.repo.get_blob_path(blob), "wb") as f:
+            f.write(data)
+        self.blobs[blob] = data
+        return blob
+
+    def make_recipe(self, pieces):
+        """Creates a recipe from a list of (blob, offset, size, repeat)
+        tuples. Returns the recipe and the expected data."""
+        data = ""
+        recipe_pieces = []
+        for blob, offset, size, repeat in pieces:
+            recipe_pieces.append({"source": blob, "offset": offset, "size": size, "repeat": repeat})
+            data += self.blobs[blob][offset:offset+size] * repeat
+        recipe = {"method": "concat",
+                  "md5sum": md5sum(data),
+                  "size": len(data),
+                  "pieces": recipe_pieces}
+        return recipe, data
+
+    def test_coalescing(self):
+        blob = self.blobs.keys()[0]
+        recipe, data = self.make_recipe([(blob, 0, 5, 1), (blob, 5, 5, 1), (blob, 10, 0, 1), (blob, 10, 10, 1)])
+        reader = blobreader.RecipeReader(recipe, self.repo)
+        self.assertEqual(len(reader.pieces), 1)
+        self.assertEqual(reader.read(), data)
+
+    def test_repeated_pieces(self):
+        blob1, blob2 = sorted(self.blobs.keys())[0:2]
+        recipe, data = self.make_recipe([(blob1, 2, 4, 1000000), (blob1, 2, 4, 1),
+                                         (blob2, 0, 3, 1), (blob2, 3, 3, 1), (blob2, 6, 3, 5)])
+        reader = blobreader.RecipeReader(recipe, self.repo)
+        self.assertEqual(len(reader.pieces), 3)
+        offset = len(data) - 30
+        reader = blobreader.RecipeReader(recipe, self.repo, offset = offset)
+        self.assertEqual(reader.read(), data[offset:])
+        reader = blobreader.RecipeReader(recipe, self.repo, offset = 11, size = 7)
+        self.assertEqual(reader.read(), data[11:18])
+        reader.seek(2)
+        self.assertEqual(reader.read(3), data[13:16])
+
+    def test_read_and_readinto(self):
+        pieces = []
+        for n, blob in enumerate(sorted(self.blobs.keys())):
+            pieces.append((blob, n % 7, 5 + n % 3, 1 + n % 2))
+        # Revisit the first blob to make sure that evicted handles are reopened
+        pieces.append((sorted(self.blobs.keys())[0], 3, 7, 2))
+        recipe, data = self.make_recipe(pieces)
+        for offset in range(0, len(data), 7):
+            for size in set([0, 1, min(13, len(data) - offset), len(data) - offset]):
+                for readsize in (1, 3, 16, 1000):
+                    reader = blobreader.RecipeReader(recipe, self.repo, offset = offset, size = size)
+                    result = []
+                    while reader.bytes_left():
+                        result.append(reader.read(readsize))
+                    self.assertEqual("".join(result), data[offset:offset+size])
+                    self.assertTrue(len(reader.file_handles) <= blobreader.MAX_OPEN_BLOBS)
+
+                    reader = blobreader.RecipeReader(recipe, self.repo, offset = offset, size = size)
+                    buf = bytearray(readsize)
+                    result = []
+                    while True:
+                        n = reader.readinto(buf)
+                        if n == 0:
+                            break
+                        result.append(str(buf[:n]))
+                    self.assertEqual("".join(result), data[offset:offset+size])
+
+    def test_truncated_blob(self):
+        blob = self.blobs.keys()[0]
+        recipe, data = self.make_recipe([(blob, 0, 20, 1)])
+        with open(self.repo.get_blob_path(blob), "r+b") as f:
+            f.truncate(15)
+        reader = blobreader.RecipeReader(recipe, self.repo)
+        self.assertRaises(CorruptionError, reader.read)
+        reader = blobreader.RecipeReader(recipe, self.repo)
+        self.assertRaises(CorruptionError, reader.readinto, bytearray(20))
+
+if __name__ == '__main__':
+    unittest.main()
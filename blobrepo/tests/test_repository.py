@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, os, unittest, tempfile, shutil
+import sys, os, unittest, tempfile, shutil, sqlite3, time
 from copy import copy
 
 DATA1 = "tjosan"
@@ -32,8 +32,9 @@ SESSION_NAME = u"RepoTestSession"
 if __name__ == '__main__':
     sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-from blobrepo import repository
+from blobrepo import repository, blobcatalog, verifyledger, snapshotstats
 from common import tounicode
+from boar_exceptions import UserError, SoftCorruptionError
 
 class TestBlobRepo(unittest.TestCase):
     def setUp(self):
@@ -146,6 +147,92 @@ class TestBlobRepo(unittest.TestCase):
         blobinfos = list(self.repo.get_session(id2).get_all_blob_infos())
         self.assertEqual(blobinfos, [])
 
+    def test_bloblist_cache(self):
+        writer1 = self.repo.create_snapshot(SESSION_NAME)
+        writer1.init_new_blob(DATA1_MD5, len(DATA1))
+        writer1.add_blob_data(DATA1_MD5, DATA1)
+        writer1.blob_finished(DATA1_MD5)
+        writer1.add(self.fileinfo1)
+        id1 = writer1.commit()
+        writer2 = self.repo.create_snapshot(SESSION_NAME, base_session = id1)
+        writer2.init_new_blob(DATA2_MD5, len(DATA2))
+        writer2.add_blob_data(DATA2_MD5, DATA2)
+        writer2.blob_finished(DATA2_MD5)
+        writer2.add(self.fileinfo2)
+        writer2.remove(self.fileinfo1['filename'])
+        id2 = writer2.commit()
+        cache_path = os.path.join(self.repopath, repository.DERIVED_BLOBLISTS_DIR, "%s.bloblist" % id2)
+        self.assertFalse(os.path.exists(cache_path))
+        reader = self.repo.get_session(id2)
+        self.assertEqual(list(reader.get_all_blob_infos()), [self.fileinfo2])
+        uncached_stats = reader.load_stats
+        self.assertTrue(os.path.exists(cache_path))
+
+        # A fresh repo instance must give the same result from the cache
+        repo = repository.Repo(self.repopath)
+        reader = repo.get_session(id2)
+        self.assertEqual(list(reader.get_all_blob_infos()), [self.fileinfo2])
+        self.assertEqual(reader.load_stats, uncached_stats)
+
+        # A corrupted cache entry must be ignored
+        with open(cache_path, "r+b") as f:
+            f.seek(-5, 2)
+            f.write("XXXXX")
+        repo = repository.Repo(self.repopath)
+        reader = repo.get_session(id2)
+        self.assertEqual(list(reader.get_all_blob_infos()), [self.fileinfo2])
+        self.assertEqual(reader.load_stats, uncached_stats)
+
+    def test_session_index(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        id2 = self.repo.create_snapshot(u"OtherSession").commit({"name": u"OtherSession"})
+        id3 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id3)
+        self.assertEqual(self.repo.get_session_revisions(SESSION_NAME), [id1, id3])
+        self.assertEqual(self.repo.find_last_revision(u"NoSuchSession"), None)
+        index_path = os.path.join(self.repopath, repository.DERIVED_SESSION_INDEX)
+        self.assertTrue(os.path.exists(index_path))
+
+        # Snapshots missing from the index must be found anyway
+        os.remove(index_path)
+        id4 = self.repo.create_snapshot(u"OtherSession").commit({"name": u"OtherSession"})
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.find_last_revision(u"OtherSession"), id4)
+        self.assertEqual(repo.get_session_revisions(u"OtherSession"), [id2, id4])
+
+        # A corrupted index must be ignored
+        with open(index_path, "r+b") as f:
+            f.write("XXXXX")
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.find_last_revision(SESSION_NAME), id3)
+        self.assertEqual(sorted(repo.get_session_names()), [u"OtherSession", SESSION_NAME])
+        self.assertEqual(repo.get_deleted_snapshots(), [])
+
+    def test_session_index_listing(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        listings = []
+        original_get_all_sessions = self.repo.get_all_sessions
+        def counting_get_all_sessions():
+            listings.append(1)
+            return original_get_all_sessions()
+        self.repo.get_all_sessions = counting_get_all_sessions
+        sessions_dir = os.path.join(self.repopath, repository.SESSIONS_DIR)
+        os.utime(sessions_dir, (time.time() - 100, time.time() - 100))
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        self.assertEqual(len(listings), 1)
+        # An unchanged sessions directory is not listed again
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        self.assertEqual(self.repo.get_session_revisions(SESSION_NAME), [id1])
+        self.assertEqual(len(listings), 1)
+        # New snapshots change the directory
+        id2 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id2)
+        # A recently modified directory is listed every time
+        del listings[:]
+        self.repo.find_last_revision(SESSION_NAME)
+        self.repo.find_last_revision(SESSION_NAME)
+        self.assertEqual(len(listings), 2)
+
     def test_remove_nonexisting(self):
         writer1 = self.repo.create_snapshot(SESSION_NAME)
         self.assertRaises(Exception, writer1.remove, "doesnotexist.txt")
@@ -175,5 +262,131 @@ class TestBlobRepo(unittest.TestCase):
         open(os.path.join(self.repo.repopath, "recipes", "55", "551d8cd98f00b204e9800998ecf8427e.recipe"), "w")
         self.assertEqual(self.repo.get_orphan_blobs(), set(["551d8cd98f00b204e9800998ecf8427e"]))
 
+    def test_get_missing_blobs(self):
+        writer = self.repo.create_snapshot(SESSION_NAME)
+        writer.init_new_blob(DATA1_MD5, len(DATA1))
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.blob_finished(DATA1_MD5)
+        writer.add(copy(self.fileinfo1))
+        writer.commit()
+        os.mkdir(os.path.join(self.repo.repopath, "recipes", "55"))
+        open(os.path.join(self.repo.repopath, "recipes", "55", "551d8cd98f00b204e9800998ecf8427e.recipe"), "w")
+        unknown = ["55%030d" % n for n in range(repository.MIN_SUMS_FOR_SHARD_LISTING)]
+        self.assertEqual(self.repo.get_missing_blobs([]), set())
+        self.assertEqual(self.repo.get_missing_blobs([DATA1_MD5, DATA2_MD5]), set([DATA2_MD5]))
+        # Enough checksums in the "55" shard to list it instead
+        self.assertEqual(self.repo.get_missing_blobs(unknown + ["551d8cd98f00b204e9800998ecf8427e", DATA1_MD5]),
+                         set(unknown))
+
+    def test_blob_catalog(self):
+        writer = self.repo.create_snapshot(SESSION_NAME)
+        writer.init_new_blob(DATA1_MD5, len(DATA1))
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.blob_finished(DATA1_MD5)
+        writer.add(copy(self.fileinfo1))
+        writer.commit()
+        catalog = self.repo.get_blob_catalog()
+        self.assertEqual(catalog.get_entries(), [(DATA1_MD5, "raw", len(DATA1), 1)])
+        # Changes behind the back of the catalog must be detected
+        os.mkdir(os.path.join(self.repo.repopath, "blobs", "92"))
+        with open(os.path.join(self.repo.repopath, "blobs", "92", DATA2_MD5), "w") as f:
+            f.write(DATA2)
+        self.assertListsEqualAsSets(self.repo.get_raw_blob_names(), [DATA1_MD5, DATA2_MD5])
+        self.assertEqual(self.repo.check_blob_catalog(), [])
+        os.remove(os.path.join(self.repo.repopath, "blobs", "92", DATA2_MD5))
+        self.assertEqual(self.repo.get_raw_blob_names(), [DATA1_MD5])
+        # A changed file size can only be found by a check
+        with open(self.repo.get_blob_path(DATA1_MD5), "a") as f:
+            f.write("x")
+        self.assertEqual(self.repo.check_blob_catalog(), ["Cataloged raw blob has wrong size: %s" % DATA1_MD5])
+        os.remove(os.path.join(self.repo.repopath, "derived", "blobcatalog.db"))
+        with repository.Repo(self.repopath) as repo:
+            repo.rebuild_blob_catalog()
+            self.assertEqual(repo.get_blob_catalog().get_entries(), [(DATA1_MD5, "raw", len(DATA1) + 1, 1)])
+            self.assertEqual(repo.check_blob_catalog(), [])
+
+    def test_blob_catalog_recent_shard(self):
+        writer = self.repo.create_snapshot(SESSION_NAME)
+        writer.init_new_blob(DATA1_MD5, len(DATA1))
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.blob_finished(DATA1_MD5)
+        writer.add(copy(self.fileinfo1))
+        writer.commit()
+        shard_dir = os.path.dirname(self.repo.get_blob_path(DATA1_MD5))
+        extra_blob = DATA1_MD5[0:2] + "0" * 30
+        self.assertEqual(self.repo.get_raw_blob_names(), [DATA1_MD5])
+        # A change within the same mtime tick must be found as long
+        # as the shard was recently modified
+        mtime = os.stat(shard_dir).st_mtime
+        open(os.path.join(shard_dir, extra_blob), "w").close()
+        os.utime(shard_dir, (mtime, mtime))
+        self.assertListsEqualAsSets(self.repo.get_raw_blob_names(), [DATA1_MD5, extra_blob])
+        # A shard that has been unmodified for long enough is trusted
+        os.remove(os.path.join(shard_dir, extra_blob))
+        old_mtime = time.time() - repository.BLOB_CATALOG_MARGIN - 10
+        os.utime(shard_dir, (old_mtime, old_mtime))
+        self.assertEqual(self.repo.get_raw_blob_names(), [DATA1_MD5])
+        open(os.path.join(shard_dir, extra_blob), "w").close()
+        os.utime(shard_dir, (old_mtime, old_mtime))
+        self.assertEqual(self.repo.get_raw_blob_names(), [DATA1_MD5])
+
+    def test_locked_derived_dbs(self):
+        for db_class, read in ((blobcatalog.BlobCatalog, lambda db: db.get_blobs("raw")),
+                               (verifyledger.VerificationLedger, lambda db: db.get_all()),
+                               (snapshotstats.SnapshotStats, lambda db: db.get_all())):
+            dbpath = os.path.join(self.repopath, "tmp", "test.db")
+            db = db_class(dbpath)
+            db.conn.execute("PRAGMA busy_timeout = 0")
+            other = sqlite3.connect(dbpath)
+            other.execute("BEGIN EXCLUSIVE")
+            # A locked database is not a corrupt one
+            self.assertRaises(UserError, read, db)
+            other.rollback()
+            read(db)
+            del db, other
+            with open(dbpath, "w") as f:
+                f.write("X" * 10000)
+            self.assertRaises(SoftCorruptionError, db_class, dbpath)
+            os.remove(dbpath)
+
+    def test_blob_refcounts(self):
+        writer = self.repo.create_snapshot(SESSION_NAME)
+        writer.init_new_blob(DATA1_MD5, len(DATA1))
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.blob_finished(DATA1_MD5)
+        writer.add(copy(self.fileinfo1))
+        writer.commit()
+        writer = self.repo.create_snapshot(SESSION_NAME)
+        writer.init_new_blob(DATA2_MD5, len(DATA2))
+        writer.add_blob_data(DATA2_MD5, DATA2)
+        writer.blob_finished(DATA2_MD5)
+        writer.add(copy(self.fileinfo1))
+        writer.add(copy(self.fileinfo2))
+        writer.commit()
+        self.assertEqual(self.repo.get_orphan_blobs(), set())
+        self.assertEqual(self.repo.get_blob_catalog().get_refs([DATA1_MD5, DATA2_MD5]),
+                         {DATA1_MD5: 2, DATA2_MD5: 1})
+        self.assertEqual(self.repo.check_blob_refcounts(), [])
+        open(os.path.join(self.repopath, "ENABLE_PERMANENT_ERASE"), "w").close()
+        with self.repo:
+            self.repo._erase_snapshots([2])
+        self.assertEqual(self.repo.get_blob_catalog().get_refs([DATA1_MD5, DATA2_MD5]),
+                         {DATA1_MD5: 1, DATA2_MD5: 0})
+        self.assertEqual(self.repo.get_orphan_blobs(), set([DATA2_MD5]))
+        self.assertEqual(self.repo.check_blob_refcounts(), [])
+        self.repo.get_verify_ledger().mark_verified([(DATA1_MD5, 1000, len(DATA1), 1000),
+                                                     (DATA2_MD5, 1000, len(DATA2), 1000)])
+        with self.repo:
+            self.assertEqual(self.repo.erase_orphan_blobs(), 1)
+        self.assertEqual(self.repo.get_raw_blob_names(), [DATA1_MD5])
+        # Erased blobs are forgotten by the verification ledger
+        self.assertEqual(self.repo.get_verify_ledger().get_all().keys(), [DATA1_MD5])
+        # A lost catalog must be recounted from scratch
+        os.remove(os.path.join(self.repopath, "derived", "blobcatalog.db"))
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.get_orphan_blobs(), set())
+        self.assertEqual(repo.get_blob_catalog().get_refs([DATA1_MD5]), {DATA1_MD5: 1})
+        self.assertEqual(repo.check_blob_refcounts(), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The verification ledger remembers when each blob (or recipe) was last
+successfully verified, and the size and mtime of the blob file at
+that time. It makes it possible to verify a large repository
+incrementally, starting with the blobs that have gone the longest
+without being verified.
+
+The ledger is derived data, and can be deleted at any time. The only
+consequence is that all blobs will be considered unverified.
+"""
+
+import os
+import sqlite3
+
+from common import *
+from boar_exceptions import SoftCorruptionError, UserError
+
+class VerificationLedger:
+    def __init__(self, dbpath):
+        assert dbpath == ":memory:" or os.path.isabs(dbpath)
+        self.dbpath = dbpath
+        try:
+            self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS verified (blob CHAR(32) PRIMARY KEY, verified_time INT NOT NULL, size INT NOT NULL, mtime INT NOT NULL)")
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            # For instance "database is locked", which is not corruption
+            raise UserError("Verification ledger could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Verification ledger is corrupt: %s" % e)
+
+    def get_all(self):
+        """Returns a dict on the form blob -> (verified_time, size,
+        mtime) for all blobs in the ledger."""
+        try:
+            rows = self.conn.execute("SELECT blob, verified_time, size, mtime FROM verified").fetchall()
+        except sqlite3.OperationalError, e:
+            raise UserError("Verification ledger could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Verification ledger is corrupt: %s" % e)
+        result = {}
+        for blob, verified_time, size, mtime in rows:
+            result[str(blob)] = (verified_time, size, mtime)
+        return result
+
+    def mark_verified(self, entries):
+        """Records the given list of (blob, verified_time, size,
+        mtime) tuples as successfully verified."""
+        for blob, verified_time, size, mtime in entries:
+            assert is_md5sum(blob)
+        try:
+            self.conn.executemany("REPLACE INTO verified (blob, verified_time, size, mtime) VALUES (?, ?, ?, ?)", entries)
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            raise UserError("Verification ledger could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Verification ledger is corrupt: %s" % e)
+
+    def forget(self, blobs):
+        """Removes the given blobs from the ledger."""
+        try:
+            self.conn.executemany("DELETE FROM verified WHERE blob = ?", [(blob,) for blob in blobs])
+            self.conn.commit()
+        except sqlite3.OperationalError, e:
+            raise UserError("Verification ledger could not be accessed: %s" % e)
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Verification ledger is corrupt: %s" % e)
@@ -57,9 +57,10 @@ def init_stdio_server(repopath):
     communicate with the client. The function also hides the real
     sys.stdin and sys.stdout to prevent any print commands from
     accidentially corrupting the communication. (sys.stdout is
-    directed to sys.stderr, sys.stdin is set to None)"""
+    directed to sys.stderr, sys.stdin is directed to os.devnull. It
+    can not be None, since multiprocessing expects a stdin)"""
     server = PipedBoarServer(repopath, sys.stdin, sys.stdout)
-    sys.stdin = None
+    sys.stdin = open(os.devnull)
     sys.stdout = sys.stderr
     return server
 
@@ -189,6 +189,24 @@ static uint16_t crc16_row(const char* const blob, const uint64_t offset, const c
   return crc16(crc_data, (unsigned short) crc_data_len);
 }
 
+/* Returns the cached statement in the given slot, ready for
+ * binding. The statement is prepared if it is not already.
+ */
+static BLOCKSDB_RESULT get_cached_stmt(BlocksDbState* dbstate, sqlite3_stmt** slot, const char* sql) {
+  LOG_ENTER();
+  if(*slot == NULL) {
+    if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle, sql, -1, slot, NULL)) {
+      *slot = NULL;
+      RET_SQLITE_ERROR("Couldn't prepare statement");
+    }
+  } else {
+    sqlite3_reset(*slot);
+    sqlite3_clear_bindings(*slot);
+  }
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
 static BLOCKSDB_RESULT execute_simple(BlocksDbState* dbstate, char* sql) {
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
@@ -245,19 +263,69 @@ BLOCKSDB_RESULT get_rolling_finish(BlocksDbState* dbstate) {
   return BLOCKSDB_DONE;
 }
 
-BLOCKSDB_RESULT add_rolling(BlocksDbState* dbstate, uint64_t rolling){
+BLOCKSDB_RESULT get_rolling_page(BlocksDbState* dbstate, int64_t after_rowid, int limit,
+				 uint64_t* out_values, int* out_count, int64_t* out_last_rowid) {
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
+  *out_count = 0;
+  *out_last_rowid = after_rowid;
   sqlite3_stmt* stmt;
-  if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle, "INSERT INTO rolling (value) VALUES (?)",
+  if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle,
+				     "SELECT rowid, value FROM rolling WHERE rowid > ? ORDER BY rowid LIMIT ?",
 				     -1, &stmt, NULL))
+    RET_SQLITE_ERROR("Couldn't prepare query in get_rolling_page()");
+  if(SQLITE_OK != sqlite3_bind_int64(stmt, 1, (sqlite3_int64) after_rowid) ||
+     SQLITE_OK != sqlite3_bind_int(stmt, 2, limit)) {
+    sqlite3_finalize(stmt);
+    RET_SQLITE_ERROR();
+  }
+  int found = 0;
+  while(found < limit) {
+    const int s = sqlite3_step(stmt);
+    if(s == SQLITE_DONE)
+      break;
+    if(s != SQLITE_ROW) {
+      sqlite3_finalize(stmt);
+      RET_SQLITE_ERROR("Unexpected step result in get_rolling_page()");
+    }
+    *out_last_rowid = sqlite3_column_int64(stmt, 0);
+    out_values[found++] = (uint64_t) sqlite3_column_int64(stmt, 1);
+  }
+  sqlite3_finalize(stmt);
+  *out_count = found;
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT get_rolling_count(BlocksDbState* dbstate, int64_t* out_count) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  sqlite3_stmt* stmt;
+  if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle, "SELECT COUNT(*) FROM rolling", -1, &stmt, NULL))
+    RET_SQLITE_ERROR("Couldn't prepare query in get_rolling_count()");
+  if(SQLITE_ROW != sqlite3_step(stmt)) {
+    sqlite3_finalize(stmt);
+    RET_SQLITE_ERROR("Unexpected step result in get_rolling_count()");
+  }
+  *out_count = sqlite3_column_int64(stmt, 0);
+  sqlite3_finalize(stmt);
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT add_rolling(BlocksDbState* dbstate, uint64_t rolling){
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->add_rolling_stmt, 
+				      "INSERT INTO rolling (value) SELECT ?1 WHERE NOT EXISTS (SELECT 1 FROM rolling WHERE value = ?1)"))
     RET_SQLITE_ERROR("Couldn't prepare statement in add_rolling()");
+  sqlite3_stmt* stmt = dbstate->add_rolling_stmt;
   if(SQLITE_OK != sqlite3_bind_int64(stmt, 1, (sqlite3_int64) rolling))
     RET_SQLITE_ERROR();
   if(SQLITE_DONE != sqlite3_step(stmt)) {
     RET_SQLITE_ERROR("Unexpected step result in add_rolling()");
   }
-  if(SQLITE_OK != sqlite3_finalize(stmt))
+  if(SQLITE_OK != sqlite3_reset(stmt))
     RET_SQLITE_ERROR();  
   LOG_EXIT();
   return BLOCKSDB_DONE;
@@ -285,12 +353,11 @@ BLOCKSDB_RESULT add_block(BlocksDbState* dbstate, const char* blob, uint64_t off
   pack_md5(md5, packed_md5);
   char packed_blob[16];
   pack_md5(blob, packed_blob);
-  sqlite3_stmt* stmt;
-
-  if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle, "INSERT OR IGNORE INTO blocks (blob, offset, md5_short, md5, row_crc) VALUES (?, ?, ?, ?, ?)",
-				     -1, &stmt, NULL)) {
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->add_block_stmt,
+				      "INSERT OR IGNORE INTO blocks (blob, offset, md5_short, md5, row_crc) VALUES (?, ?, ?, ?, ?)")) {
     RET_SQLITE_ERROR("Error while preparing add_block()");
   }
+  sqlite3_stmt* stmt = dbstate->add_block_stmt;
   
   if(SQLITE_OK != sqlite3_bind_blob(stmt, 1, packed_blob, 16, SQLITE_STATIC)) 
     RET_SQLITE_ERROR();
@@ -306,12 +373,47 @@ BLOCKSDB_RESULT add_block(BlocksDbState* dbstate, const char* blob, uint64_t off
   if(SQLITE_DONE != sqlite3_step(stmt))
     RET_SQLITE_ERROR("Error while inserting new block");
 
-  if(SQLITE_OK != sqlite3_finalize(stmt))
+  if(SQLITE_OK != sqlite3_reset(stmt))
     RET_SQLITE_ERROR();
   LOG_EXIT();
   return BLOCKSDB_DONE;
 }
 
+BLOCKSDB_RESULT add_blocks(BlocksDbState* dbstate, const char* blobs, const uint64_t* offsets, const char* md5s,
+			   int count) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  char blob[33];
+  char md5[33];
+  blob[32] = '\0';
+  md5[32] = '\0';
+  for(int i = 0; i < count; i++) {
+    memcpy(blob, blobs + i * 32, 32);
+    memcpy(md5, md5s + i * 32, 32);
+    const BLOCKSDB_RESULT result = add_block(dbstate, blob, offsets[i], md5);
+    if(result != BLOCKSDB_DONE) {
+      LOG_EXIT();
+      return result;
+    }
+  }
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT add_rollings(BlocksDbState* dbstate, const uint64_t* rollings, int count) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  for(int i = 0; i < count; i++) {
+    const BLOCKSDB_RESULT result = add_rolling(dbstate, rollings[i]);
+    if(result != BLOCKSDB_DONE) {
+      LOG_EXIT();
+      return result;
+    }
+  }
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
 BLOCKSDB_RESULT get_blocks_init(BlocksDbState* dbstate, char* md5, int limit){
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
@@ -320,12 +422,11 @@ BLOCKSDB_RESULT get_blocks_init(BlocksDbState* dbstate, char* md5, int limit){
     LOG_EXIT();
     return BLOCKSDB_ERR_OTHER;
   }
-  int retval;
-  retval = sqlite3_prepare_v2(dbstate->handle, "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks WHERE md5_short = ? AND md5 = ? LIMIT ?",
-                              -1, &dbstate->stmt, NULL);
-  if(retval != SQLITE_OK){
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->get_blocks_stmt, 
+				      "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks WHERE md5_short = ? AND md5 = ? LIMIT ?")) {
     RET_SQLITE_ERROR("get_blocks_init() prepare failed");
   }
+  dbstate->stmt = dbstate->get_blocks_stmt;
 
   char packed_md5[16];
   pack_md5(md5, packed_md5);
@@ -340,40 +441,53 @@ BLOCKSDB_RESULT get_blocks_init(BlocksDbState* dbstate, char* md5, int limit){
   return BLOCKSDB_DONE;
 }
 
-BLOCKSDB_RESULT get_blocks_next(BlocksDbState* dbstate, char* blob, uint64_t* offset) {
+/* Reads and verifies the current row of a statement selecting
+ * blob, offset, row_crc and md5 from the blocks table. The md5 sum is
+ * only written if 'out_md5' is not NULL.
+ */
+static BLOCKSDB_RESULT read_block_row(BlocksDbState* dbstate, sqlite3_stmt* stmt, char* blob, uint64_t* offset,
+				      char* out_md5) {
   LOG_ENTER();
-  ASSERT_VALID_STATE(dbstate);
-  int s = sqlite3_step (dbstate->stmt);
-  if (s == SQLITE_ROW) {
-    // TODO: verify integrity
-    const char* blob_col = (const char*) sqlite3_column_text(dbstate->stmt, 0);
-    const int blob_col_length = sqlite3_column_bytes(dbstate->stmt, 0);
-    if(blob_col_length != 16)
-      RET_ERROR_CORRUPT("Unexpected blob column length in get_blocks_next()");
-    unpack_md5(blob_col, blob);
-    blob[32] = '\0';
-
-    *offset = (uint64_t) sqlite3_column_int64(dbstate->stmt, 1);
+  const char* blob_col = (const char*) sqlite3_column_text(stmt, 0);
+  const int blob_col_length = sqlite3_column_bytes(stmt, 0);
+  if(blob_col_length != 16)
+    RET_ERROR_CORRUPT("Unexpected blob column length in read_block_row()");
+  unpack_md5(blob_col, blob);
+  blob[32] = '\0';
+
+  *offset = (uint64_t) sqlite3_column_int64(stmt, 1);
     
-    const int row_crc = sqlite3_column_int(dbstate->stmt, 2);
+  const int row_crc = sqlite3_column_int(stmt, 2);
 
-    const char* md5_col = (const char*) sqlite3_column_text(dbstate->stmt, 3);
-    const int md5_col_length = sqlite3_column_bytes(dbstate->stmt, 3);
-    if(md5_col_length != 16)
-      RET_ERROR_CORRUPT("Unexpected md5 column length in get_blocks_next()");
-    char md5[33];
-    unpack_md5(md5_col, md5);
-    md5[32] = '\0';
+  const char* md5_col = (const char*) sqlite3_column_text(stmt, 3);
+  const int md5_col_length = sqlite3_column_bytes(stmt, 3);
+  if(md5_col_length != 16)
+    RET_ERROR_CORRUPT("Unexpected md5 column length in read_block_row()");
+  char md5[33];
+  unpack_md5(md5_col, md5);
+  md5[32] = '\0';
 
-    const unsigned short expected_row_crc = crc16_row(blob, *offset, md5);
+  const unsigned short expected_row_crc = crc16_row(blob, *offset, md5);
 
-    if(row_crc != expected_row_crc){
-      sprintf(dbstate->error_msg, "An entry in the blocks database is corrupt (block id %s)", md5);
-      LOG_EXIT();
-      return BLOCKSDB_ERR_CORRUPT;
-    }
+  if(row_crc != expected_row_crc){
+    sprintf(dbstate->error_msg, "An entry in the blocks database is corrupt (block id %s)", md5);
     LOG_EXIT();
-    return BLOCKSDB_ROW;
+    return BLOCKSDB_ERR_CORRUPT;
+  }
+  if(out_md5 != NULL)
+    memcpy(out_md5, md5, 33);
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT get_blocks_next(BlocksDbState* dbstate, char* blob, uint64_t* offset) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  int s = sqlite3_step (dbstate->stmt);
+  if (s == SQLITE_ROW) {
+    BLOCKSDB_RESULT result = read_block_row(dbstate, dbstate->stmt, blob, offset, NULL);
+    LOG_EXIT();
+    return result == BLOCKSDB_DONE ? BLOCKSDB_ROW : result;
   }
   else if (s == SQLITE_DONE) {
     LOG_EXIT();
@@ -387,13 +501,248 @@ BLOCKSDB_RESULT get_blocks_finish(BlocksDbState* dbstate) {
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
   assert(dbstate->stmt != NULL, "Tried to call get_blocks_finish() with no active cursor");
-  if(SQLITE_OK != sqlite3_finalize(dbstate->stmt))
+  // The statement is cached, so it is only reset here
+  if(SQLITE_OK != sqlite3_reset(dbstate->stmt))
     RET_SQLITE_ERROR();
   dbstate->stmt = NULL;
   LOG_EXIT();
   return BLOCKSDB_DONE;
 }
 
+BLOCKSDB_RESULT has_blocks(BlocksDbState* dbstate, const char* md5s, int count, int* out_found) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  for(int i = 0; i < count; i++) {
+    if(! is_md5sum(md5s + i * 32)) {
+      sprintf(dbstate->error_msg, "has_blocks(): Not a valid md5 sum: %.32s", md5s + i * 32);
+      LOG_EXIT();
+      return BLOCKSDB_ERR_OTHER;
+    }
+  }
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->get_blocks_stmt, 
+				      "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks WHERE md5_short = ? AND md5 = ? LIMIT ?")) {
+    RET_SQLITE_ERROR("has_blocks() prepare failed");
+  }
+  sqlite3_stmt* stmt = dbstate->get_blocks_stmt;
+  char packed_md5[16];
+  char blob[33];
+  uint64_t offset;
+  for(int i = 0; i < count; i++) {
+    sqlite3_reset(stmt);
+    pack_md5(md5s + i * 32, packed_md5);
+    if(SQLITE_OK != sqlite3_bind_blob(stmt, 1, packed_md5, 4, SQLITE_STATIC))
+      RET_SQLITE_ERROR();
+    if(SQLITE_OK != sqlite3_bind_blob(stmt, 2, packed_md5, 16, SQLITE_STATIC))
+      RET_SQLITE_ERROR();
+    if(SQLITE_OK != sqlite3_bind_int(stmt, 3, 1))
+      RET_SQLITE_ERROR();
+    const int s = sqlite3_step(stmt);
+    if(s == SQLITE_ROW) {
+      const BLOCKSDB_RESULT result = read_block_row(dbstate, stmt, blob, &offset, NULL);
+      if(result != BLOCKSDB_DONE) {
+	sqlite3_reset(stmt);
+	LOG_EXIT();
+	return result;
+      }
+      out_found[i] = 1;
+    } else if(s == SQLITE_DONE) {
+      out_found[i] = 0;
+    } else {
+      RET_SQLITE_ERROR("Unexpected step result in has_blocks()");
+    }
+  }
+  if(SQLITE_OK != sqlite3_reset(stmt))
+    RET_SQLITE_ERROR();
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT get_blocks_many(BlocksDbState* dbstate, const char* md5s, int count, int limit,
+				BlockLocation** out_locations, int* out_count) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  *out_locations = NULL;
+  *out_count = 0;
+  for(int i = 0; i < count; i++) {
+    if(! is_md5sum(md5s + i * 32)) {
+      sprintf(dbstate->error_msg, "get_blocks_many(): Not a valid md5 sum: %.32s", md5s + i * 32);
+      LOG_EXIT();
+      return BLOCKSDB_ERR_OTHER;
+    }
+  }
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->get_blocks_stmt, 
+				      "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks WHERE md5_short = ? AND md5 = ? LIMIT ?")) {
+    RET_SQLITE_ERROR("get_blocks_many() prepare failed");
+  }
+  sqlite3_stmt* stmt = dbstate->get_blocks_stmt;
+  char packed_md5[16];
+  int capacity = count;
+  BlockLocation* locations = malloc((capacity > 0 ? capacity : 1) * sizeof(BlockLocation));
+  if(locations == NULL) {
+    sprintf(dbstate->error_msg, "get_blocks_many(): Out of memory");
+    LOG_EXIT();
+    return BLOCKSDB_ERR_OTHER;
+  }
+  int found = 0;
+  for(int i = 0; i < count; i++) {
+    sqlite3_reset(stmt);
+    pack_md5(md5s + i * 32, packed_md5);
+    if(SQLITE_OK != sqlite3_bind_blob(stmt, 1, packed_md5, 4, SQLITE_STATIC) ||
+       SQLITE_OK != sqlite3_bind_blob(stmt, 2, packed_md5, 16, SQLITE_STATIC) ||
+       SQLITE_OK != sqlite3_bind_int(stmt, 3, limit)) {
+      free(locations);
+      RET_SQLITE_ERROR();
+    }
+    while(1) {
+      const int s = sqlite3_step(stmt);
+      if(s == SQLITE_DONE)
+	break;
+      if(s != SQLITE_ROW) {
+	free(locations);
+	RET_SQLITE_ERROR("Unexpected step result in get_blocks_many()");
+      }
+      if(found == capacity) {
+	capacity *= 2;
+	BlockLocation* grown = realloc(locations, capacity * sizeof(BlockLocation));
+	if(grown == NULL) {
+	  free(locations);
+	  sqlite3_reset(stmt);
+	  sprintf(dbstate->error_msg, "get_blocks_many(): Out of memory");
+	  LOG_EXIT();
+	  return BLOCKSDB_ERR_OTHER;
+	}
+	locations = grown;
+      }
+      const BLOCKSDB_RESULT result = read_block_row(dbstate, stmt, locations[found].blob, &locations[found].offset, NULL);
+      if(result != BLOCKSDB_DONE) {
+	free(locations);
+	sqlite3_reset(stmt);
+	LOG_EXIT();
+	return result;
+      }
+      locations[found].index = i;
+      found++;
+    }
+  }
+  if(SQLITE_OK != sqlite3_reset(stmt)) {
+    free(locations);
+    RET_SQLITE_ERROR();
+  }
+  *out_locations = locations;
+  *out_count = found;
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT find_block_at(BlocksDbState* dbstate, const char* md5, const char* blobs, const uint64_t* offsets,
+			      int count, int* out_found) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  if(! is_md5sum(md5)) {
+    sprintf(dbstate->error_msg, "find_block_at(): Not a valid md5 sum: %.32s", md5);
+    LOG_EXIT();
+    return BLOCKSDB_ERR_OTHER;
+  }
+  for(int i = 0; i < count; i++) {
+    if(! is_md5sum(blobs + i * 32)) {
+      sprintf(dbstate->error_msg, "find_block_at(): Not a valid blob name: %.32s", blobs + i * 32);
+      LOG_EXIT();
+      return BLOCKSDB_ERR_OTHER;
+    }
+  }
+  // Uses the unique index on (blob, offset)
+  if(BLOCKSDB_DONE != get_cached_stmt(dbstate, &dbstate->find_block_at_stmt,
+				      "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks WHERE blob = ? AND offset = ?")) {
+    RET_SQLITE_ERROR("find_block_at() prepare failed");
+  }
+  sqlite3_stmt* stmt = dbstate->find_block_at_stmt;
+  char packed_md5[16];
+  char packed_blob[16];
+  char blob[33];
+  uint64_t offset;
+  pack_md5(md5, packed_md5);
+  for(int i = 0; i < count; i++) {
+    sqlite3_reset(stmt);
+    pack_md5(blobs + i * 32, packed_blob);
+    if(SQLITE_OK != sqlite3_bind_blob(stmt, 1, packed_blob, 16, SQLITE_STATIC))
+      RET_SQLITE_ERROR();
+    if(SQLITE_OK != sqlite3_bind_int64(stmt, 2, (sqlite3_int64) offsets[i]))
+      RET_SQLITE_ERROR();
+    const int s = sqlite3_step(stmt);
+    if(s == SQLITE_ROW) {
+      const BLOCKSDB_RESULT result = read_block_row(dbstate, stmt, blob, &offset, NULL);
+      if(result != BLOCKSDB_DONE) {
+	sqlite3_reset(stmt);
+	LOG_EXIT();
+	return result;
+      }
+      out_found[i] = memcmp(sqlite3_column_blob(stmt, 3), packed_md5, 16) == 0;
+    } else if(s == SQLITE_DONE) {
+      out_found[i] = 0;
+    } else {
+      RET_SQLITE_ERROR("Unexpected step result in find_block_at()");
+    }
+  }
+  if(SQLITE_OK != sqlite3_reset(stmt))
+    RET_SQLITE_ERROR();
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
+BLOCKSDB_RESULT get_blocks_page(BlocksDbState* dbstate, int64_t after_rowid, int limit,
+				BlockEntry** out_entries, int* out_count, int64_t* out_last_rowid) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  *out_entries = NULL;
+  *out_count = 0;
+  *out_last_rowid = after_rowid;
+  BlockEntry* entries = malloc((limit > 0 ? limit : 1) * sizeof(BlockEntry));
+  if(entries == NULL) {
+    sprintf(dbstate->error_msg, "get_blocks_page(): Out of memory");
+    LOG_EXIT();
+    return BLOCKSDB_ERR_OTHER;
+  }
+  sqlite3_stmt* stmt;
+  if(SQLITE_OK != sqlite3_prepare_v2(dbstate->handle, 
+				     "SELECT blob, offset, row_crc, md5, rowid FROM blocks WHERE rowid > ? ORDER BY rowid LIMIT ?",
+				     -1, &stmt, NULL)) {
+    free(entries);
+    RET_SQLITE_ERROR("Couldn't prepare query in get_blocks_page()");
+  }
+  if(SQLITE_OK != sqlite3_bind_int64(stmt, 1, (sqlite3_int64) after_rowid) ||
+     SQLITE_OK != sqlite3_bind_int(stmt, 2, limit)) {
+    free(entries);
+    sqlite3_finalize(stmt);
+    RET_SQLITE_ERROR();
+  }
+  int found = 0;
+  while(found < limit) {
+    const int s = sqlite3_step(stmt);
+    if(s == SQLITE_DONE)
+      break;
+    if(s != SQLITE_ROW) {
+      free(entries);
+      sqlite3_finalize(stmt);
+      RET_SQLITE_ERROR("Unexpected step result in get_blocks_page()");
+    }
+    const BLOCKSDB_RESULT result = read_block_row(dbstate, stmt, entries[found].blob, &entries[found].offset,
+						  entries[found].md5);
+    if(result != BLOCKSDB_DONE) {
+      free(entries);
+      sqlite3_finalize(stmt);
+      LOG_EXIT();
+      return result;
+    }
+    *out_last_rowid = sqlite3_column_int64(stmt, 4);
+    found++;
+  }
+  sqlite3_finalize(stmt);
+  *out_entries = entries;
+  *out_count = found;
+  LOG_EXIT();
+  return BLOCKSDB_DONE;
+}
+
 BLOCKSDB_RESULT delete_blocks_init(BlocksDbState* dbstate){
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
@@ -497,6 +846,7 @@ static BLOCKSDB_RESULT initialize_database(BlocksDbState* dbstate, unsigned bloc
     "INSERT OR IGNORE INTO props VALUES ('modification_counter', 0)",
     "CREATE UNIQUE INDEX IF NOT EXISTS index_offset ON blocks (blob, offset)",    
     "CREATE INDEX IF NOT EXISTS index_block_md5 ON blocks (md5_short)",    
+    "CREATE INDEX IF NOT EXISTS index_rolling ON rolling (value)",
     "\0 SENTINEL"
   };
 
@@ -548,6 +898,10 @@ BLOCKSDB_RESULT init_blocksdb(const char* dbfile, int block_size, BlocksDbState*
   }
   state->magic = 0xabcd1234;
   state->stmt = NULL;
+  state->add_block_stmt = NULL;
+  state->add_rolling_stmt = NULL;
+  state->get_blocks_stmt = NULL;
+  state->find_block_at_stmt = NULL;
 
 #ifdef ENABLE_BLOCKSDB_LOGGING
   sqlite3_trace(state->handle, trace_callback, NULL);
@@ -561,6 +915,10 @@ BLOCKSDB_RESULT init_blocksdb(const char* dbfile, int block_size, BlocksDbState*
 BLOCKSDB_RESULT close_blocksdb(BlocksDbState* dbstate){
   LOG_ENTER();
   ASSERT_VALID_STATE(dbstate);
+  sqlite3_finalize(dbstate->add_block_stmt);
+  sqlite3_finalize(dbstate->add_rolling_stmt);
+  sqlite3_finalize(dbstate->get_blocks_stmt);
+  sqlite3_finalize(dbstate->find_block_at_stmt);
   const int retval = sqlite3_close(dbstate->handle);
   if(retval != SQLITE_OK){
     RET_SQLITE_ERROR();
@@ -587,6 +945,17 @@ BLOCKSDB_RESULT commit_blocksdb(BlocksDbState* dbstate) {
   return result;
 }
 
+BLOCKSDB_RESULT rollback_blocksdb(BlocksDbState* dbstate) {
+  LOG_ENTER();
+  ASSERT_VALID_STATE(dbstate);
+  BLOCKSDB_RESULT result = BLOCKSDB_DONE;
+  if(!sqlite3_get_autocommit(dbstate->handle)) {
+    result = execute_simple(dbstate, "ROLLBACK");
+  }
+  LOG_EXIT();
+  return result;
+}
+
 const char* get_error_message(BlocksDbState* dbstate) {
   ASSERT_VALID_STATE(dbstate);
   dbstate->error_msg[1023] = 0;
@@ -26,6 +26,12 @@ typedef struct _BlocksDbState {
   uint32_t magic;
   sqlite3* handle;
   sqlite3_stmt* stmt;
+  // Prepared statements that are kept for the lifetime of the
+  // connection. They are created on first use.
+  sqlite3_stmt* add_block_stmt;
+  sqlite3_stmt* add_rolling_stmt;
+  sqlite3_stmt* get_blocks_stmt;
+  sqlite3_stmt* find_block_at_stmt;
   int error_code;
   char error_msg[1024];
 } BlocksDbState;
@@ -39,10 +45,30 @@ BLOCKSDB_RESULT add_block(BlocksDbState* dbstate, const char* blob, uint64_t off
 
 BLOCKSDB_RESULT add_rolling(BlocksDbState* dbstate, uint64_t rolling);
 
+/** Adds 'count' blocks in a single call. The blob names and md5 sums
+ *  are given as consecutive 32 byte hex strings, without separators,
+ *  and 'offsets' holds the corresponding offsets.
+ */
+BLOCKSDB_RESULT add_blocks(BlocksDbState* dbstate, const char* blobs, const uint64_t* offsets, const char* md5s,
+			   int count);
+
+/** Adds 'count' rolling checksums in a single call.
+ */
+BLOCKSDB_RESULT add_rollings(BlocksDbState* dbstate, const uint64_t* rollings, int count);
+
 BLOCKSDB_RESULT get_rolling_init(BlocksDbState* dbstate);
 BLOCKSDB_RESULT get_rolling_next(BlocksDbState* dbstate, uint64_t* rolling);
 BLOCKSDB_RESULT get_rolling_finish(BlocksDbState* dbstate);
 
+/** Reads at most 'limit' rolling checksums with a rowid larger than
+ *  'after_rowid', in rowid order, into 'out_values', which must have
+ *  room for 'limit' values. The rowid of the last value is written to
+ *  '*out_last_rowid'.
+ */
+BLOCKSDB_RESULT get_rolling_page(BlocksDbState* dbstate, int64_t after_rowid, int limit,
+				 uint64_t* out_values, int* out_count, int64_t* out_last_rowid);
+BLOCKSDB_RESULT get_rolling_count(BlocksDbState* dbstate, int64_t* out_count);
+
 BLOCKSDB_RESULT get_blocks_init(BlocksDbState* dbstate, char* md5, int limit);
 
 /** Get the next row of the result. The blob name will be written to
@@ -52,6 +78,54 @@ BLOCKSDB_RESULT get_blocks_init(BlocksDbState* dbstate, char* md5, int limit);
 BLOCKSDB_RESULT get_blocks_next(BlocksDbState* dbstate, char* out_blob, uint64_t* out_offset);
 BLOCKSDB_RESULT get_blocks_finish(BlocksDbState* dbstate);
 
+/** Checks which of the given blocks exist. The md5 sums are given
+ *  as 'count' consecutive 32 byte hex strings, without separators. For
+ *  every md5 sum, 1 will be written to the corresponding position in
+ *  'out_found' if the block exists, otherwise 0.
+ */
+BLOCKSDB_RESULT has_blocks(BlocksDbState* dbstate, const char* md5s, int count, int* out_found);
+
+typedef struct _BlockLocation {
+  int index; // The position of the block in the list of md5 sums
+  char blob[33];
+  uint64_t offset;
+} BlockLocation;
+
+/** Finds the locations of all the given blocks, at most 'limit' for
+ *  every block (negative means no limit). The md5 sums are given as
+ *  for has_blocks(). On success, '*out_locations' will point to a
+ *  newly allocated array of '*out_count' locations, that must be
+ *  released by the caller using free().
+ */
+BLOCKSDB_RESULT get_blocks_many(BlocksDbState* dbstate, const char* md5s, int count, int limit,
+				BlockLocation** out_locations, int* out_count);
+
+/** Checks which of the given locations hold the block with the
+ *  given md5 sum. The blob names are given as 'count' consecutive 32
+ *  byte hex strings, without separators, and 'offsets' holds the
+ *  corresponding offsets. For every location, 1 will be written to
+ *  the corresponding position in 'out_found' if the block is stored
+ *  there, otherwise 0.
+ */
+BLOCKSDB_RESULT find_block_at(BlocksDbState* dbstate, const char* md5, const char* blobs, const uint64_t* offsets,
+			      int count, int* out_found);
+
+typedef struct _BlockEntry {
+  char blob[33];
+  uint64_t offset;
+  char md5[33];
+} BlockEntry;
+
+/** Reads at most 'limit' verified blocks with a rowid larger than
+ *  'after_rowid', in rowid order. On success, '*out_entries' will
+ *  point to a newly allocated array of '*out_count' entries, that
+ *  must be released by the caller using free(), and the rowid of the
+ *  last entry is written to '*out_last_rowid'. Fewer than 'limit'
+ *  entries means that all blocks have been read.
+ */
+BLOCKSDB_RESULT get_blocks_page(BlocksDbState* dbstate, int64_t after_rowid, int limit,
+				BlockEntry** out_entries, int* out_count, int64_t* out_last_rowid);
+
 BLOCKSDB_RESULT delete_blocks_init(BlocksDbState* dbstate);
 BLOCKSDB_RESULT delete_blocks_add(BlocksDbState* dbstate, char* blob);
 BLOCKSDB_RESULT delete_blocks_finish(BlocksDbState* dbstate);
@@ -63,5 +137,8 @@ BLOCKSDB_RESULT get_block_size(BlocksDbState* dbstate, int* out_block_size);
 
 BLOCKSDB_RESULT begin_blocksdb(BlocksDbState* dbstate);
 BLOCKSDB_RESULT commit_blocksdb(BlocksDbState* dbstate);
+// Aborts the current transaction. Does nothing if there is none, for
+// instance if it was already ended by a failed commit.
+BLOCKSDB_RESULT rollback_blocksdb(BlocksDbState* dbstate);
 
 #endif
@@ -0,0 +1,73 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#include "bloomfilter.h"
+
+#include "stdlib.h"
+#include "stdio.h"
+#include "stdint.h"
+
+static void massert(int condition, const char* message) {
+  if(condition == 0){
+    printf("Assertion failed: %s\n", message);
+    exit(1);
+  }
+}
+
+// The finalizer of MurmurHash3. The rolling checksums are not evenly
+// distributed, so they must be mixed before they are used as indices.
+static inline uint64_t mix64(uint64_t k) {
+  k ^= k >> 33;
+  k *= 0xff51afd7ed558ccdULL;
+  k ^= k >> 33;
+  k *= 0xc4ceb9fe1a85ec53ULL;
+  k ^= k >> 33;
+  return k;
+}
+
+void init_bloom(BloomFilter* bloom, unsigned char* bits, uint64_t bit_count, uint32_t hash_count) {
+  massert(bits != NULL, "Bloom filter bits must not be NULL");
+  massert(bit_count >= 8 && (bit_count & (bit_count - 1)) == 0, "Bloom filter bit count must be a power of 2");
+  massert(hash_count > 0, "Bloom filter hash count must not be zero");
+  bloom->bits = bits;
+  bloom->bit_count = bit_count;
+  bloom->hash_count = hash_count;
+}
+
+// The bit indices are derived from two hashes, as described by
+// Kirsch and Mitzenmacher in "Less Hashing, Same Performance".
+
+void add_bloom(BloomFilter* bloom, uint64_t int_to_add) {
+  const uint64_t h1 = mix64(int_to_add);
+  const uint64_t h2 = mix64(h1) | 1;
+  const uint64_t mask = bloom->bit_count - 1;
+  for(uint32_t i = 0; i < bloom->hash_count; i++){
+    const uint64_t bit = (h1 + i * h2) & mask;
+    bloom->bits[bit >> 3] |= (unsigned char) (1 << (bit & 7));
+  }
+}
+
+int contains_bloom(const BloomFilter* const bloom, const uint64_t int_to_find) {
+  // This function is a hot spot. Most values are not in the filter,
+  // and the first cleared bit ends the search.
+  const uint64_t h1 = mix64(int_to_find);
+  const uint64_t h2 = mix64(h1) | 1;
+  const uint64_t mask = bloom->bit_count - 1;
+  for(uint32_t i = 0; i < bloom->hash_count; i++){
+    const uint64_t bit = (h1 + i * h2) & mask;
+    if((bloom->bits[bit >> 3] & (1 << (bit & 7))) == 0)
+      return 0;
+  }
+  return 1;
+}
@@ -0,0 +1,32 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef BLOOMFILTER_H
+#define BLOOMFILTER_H
+
+#include <stdint.h>
+
+// A bloom filter of 64 bit integers. The bit array is owned by the
+// caller, so that it can be a memory mapped file.
+typedef struct _BloomFilter {
+  unsigned char* bits;
+  uint64_t bit_count; // Must be a power of 2
+  uint32_t hash_count;
+} BloomFilter;
+
+void init_bloom(BloomFilter* bloom, unsigned char* bits, uint64_t bit_count, uint32_t hash_count);
+void add_bloom(BloomFilter* bloom, uint64_t int_to_add);
+int contains_bloom(const BloomFilter* bloom, uint64_t int_to_find);
+
+#endif
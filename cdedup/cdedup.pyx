@@ -13,12 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-__version__ = "1.0" # Major, minor. Major == API changes
+__version__ = "2.0" # Major, minor. Major == API changes
 
-from libc.stdint cimport uint32_t, uint64_t
+from libc.stdint cimport uint32_t, uint64_t, int64_t
+from libc.stdlib cimport malloc, realloc, free
+from cpython.pythread cimport PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock, \
+    PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK
 from boar_exceptions import SoftCorruptionError
+import threading
 
-cdef extern from "rollsum.h":
+cdef extern from "rollsum.h" nogil:
     cdef struct _RollingState:
         pass
     ctypedef _RollingState RollingState
@@ -30,7 +34,7 @@ cdef extern from "rollsum.h":
     void push_buffer_rolling(RollingState* state, char* buf, unsigned len)
     uint64_t value64_rolling(RollingState* state)
 
-cdef extern from "intset.h":
+cdef extern from "intset.h" nogil:
     cdef struct _IntSet:
         pass
     ctypedef _IntSet IntSet
@@ -39,7 +43,25 @@ cdef extern from "intset.h":
     int contains_intset(IntSet* intset, int int_to_find)
     void destroy_intset(IntSet* intset)
 
-cdef extern from "blocksdb.h":
+cdef extern from "bloomfilter.h" nogil:
+    ctypedef struct BloomFilter:
+        unsigned char* bits
+        uint64_t bit_count
+        uint32_t hash_count
+    void init_bloom(BloomFilter* bloom, unsigned char* bits, uint64_t bit_count, uint32_t hash_count)
+    void add_bloom(BloomFilter* bloom, uint64_t int_to_add)
+    int contains_bloom(BloomFilter* bloom, uint64_t int_to_find)
+
+cdef extern from "chunker.h" nogil:
+    ctypedef struct Chunker:
+        uint32_t position
+    void init_chunker(Chunker* chunker, uint32_t avg_size)
+    size_t find_chunk_boundary(Chunker* chunker, const unsigned char* buf, size_t len, int* out_found)
+
+cdef extern from "Python.h":
+    int PyObject_AsWriteBuffer(object obj, void** buffer, Py_ssize_t* buffer_len) except -1
+
+cdef extern from "blocksdb.h" nogil:
 
     cdef enum BLOCKSDB_RESULT:
         BLOCKSDB_DONE=1
@@ -52,14 +74,36 @@ cdef extern from "blocksdb.h":
 
     BLOCKSDB_RESULT add_block(void* handle, const char* blob, uint64_t offset, const char* md5)
     BLOCKSDB_RESULT add_rolling(void* handle, uint64_t rolling)
+    BLOCKSDB_RESULT add_blocks(void* handle, const char* blobs, const uint64_t* offsets, const char* md5s, int count)
+    BLOCKSDB_RESULT add_rollings(void* handle, const uint64_t* rollings, int count)
 
     BLOCKSDB_RESULT get_rolling_init(void* handle)
     BLOCKSDB_RESULT get_rolling_next(void* handle, uint64_t* rolling)
     BLOCKSDB_RESULT get_rolling_finish(void* handle)
+    BLOCKSDB_RESULT get_rolling_page(void* handle, int64_t after_rowid, int limit,
+                                     uint64_t* out_values, int* out_count, int64_t* out_last_rowid)
+    BLOCKSDB_RESULT get_rolling_count(void* handle, int64_t* out_count)
 
     BLOCKSDB_RESULT get_blocks_init(void* handle, char* md5, int limit)
     BLOCKSDB_RESULT get_blocks_next(void* handle, char* blob, uint64_t* offset)
     BLOCKSDB_RESULT get_blocks_finish(void *handle)
+    BLOCKSDB_RESULT has_blocks(void* handle, const char* md5s, int count, int* out_found)
+
+    ctypedef struct BlockLocation:
+        int index
+        char blob[33]
+        uint64_t offset
+    BLOCKSDB_RESULT get_blocks_many(void* handle, const char* md5s, int count, int limit,
+                                    BlockLocation** out_locations, int* out_count)
+    BLOCKSDB_RESULT find_block_at(void* handle, const char* md5, const char* blobs, const uint64_t* offsets,
+                                  int count, int* out_found)
+
+    ctypedef struct BlockEntry:
+        char blob[33]
+        uint64_t offset
+        char md5[33]
+    BLOCKSDB_RESULT get_blocks_page(void* handle, int64_t after_rowid, int limit,
+                                    BlockEntry** out_entries, int* out_count, int64_t* out_last_rowid)
 
     BLOCKSDB_RESULT delete_blocks_init(void* dbstate)
     BLOCKSDB_RESULT delete_blocks_add(void* dbstate, char* blob)
@@ -72,14 +116,90 @@ cdef extern from "blocksdb.h":
 
     BLOCKSDB_RESULT begin_blocksdb(void* handle)
     BLOCKSDB_RESULT commit_blocksdb(void* handle)
+    BLOCKSDB_RESULT rollback_blocksdb(void* handle)
     
     char* get_error_message(void* handle)
     
 #class BlocksDB:
     
 
+cdef class ContentChunker:
+    """Splits a stream of data into content defined chunks, with the
+    given average size. The smallest chunk is a quarter of the
+    average size, and the largest is four times the average size
+    (except for the last chunk of the stream, which may be shorter)."""
+    cdef Chunker chunker
+    cdef uint64_t feeded_bytecount
+
+    def __init__(self, uint32_t avg_size):
+        assert avg_size >= 64 and (avg_size & (avg_size - 1)) == 0, \
+            "Average chunk size must be a power of 2, at least 64"
+        init_chunker(&self.chunker, avg_size)
+        self.feeded_bytecount = 0
+
+    def feed_string(self, s):
+        """Feeds the given string, and returns a list of the offsets in
+        the stream where the chunks that were completed by this
+        string end."""
+        assert type(s) == str
+        cdef const unsigned char* buf = s
+        cdef size_t buf_len = len(s)
+        cdef size_t pos = 0
+        cdef size_t consumed
+        cdef int found
+        result = []
+        while pos < buf_len:
+            with nogil:
+                consumed = find_chunk_boundary(&self.chunker, buf + pos, buf_len - pos, &found)
+            pos += consumed
+            if found:
+                result.append(self.feeded_bytecount + pos)
+        self.feeded_bytecount += buf_len
+        return result
+
+cdef class RollingFilter:
+    """A bloom filter of rolling checksums, stored in the given
+    writable buffer (typically a memory mapped file) starting at the
+    given offset. The buffer must be kept unchanged in size for the
+    lifetime of the filter."""
+    cdef BloomFilter bloom
+    cdef object buffer
+
+    def __init__(self, buffer, uint64_t offset, uint64_t bit_count, uint32_t hash_count):
+        cdef void* buf
+        cdef Py_ssize_t buf_len
+        PyObject_AsWriteBuffer(buffer, &buf, &buf_len)
+        assert offset + bit_count / 8 <= <uint64_t> buf_len, "Buffer is too small for the rolling filter"
+        assert bit_count >= 8 and (bit_count & (bit_count - 1)) == 0, "Bit count must be a power of 2"
+        assert hash_count > 0
+        self.buffer = buffer
+        init_bloom(&self.bloom, <unsigned char*> buf + offset, bit_count, hash_count)
+
+    def add(self, uint64_t int_to_add):
+        add_bloom(&self.bloom, int_to_add)
+
+    def add_all(self, ints_to_add):
+        cdef uint64_t n
+        for n in ints_to_add:
+            add_bloom(&self.bloom, n)
+
+    def contains(self, uint64_t int_to_find):
+        return bool(contains_bloom(&self.bloom, int_to_find))
+
+    cdef BloomFilter* get_bloom(self):
+        return &self.bloom
+
 cdef class IntegerSet:
+    """A set of integers. The set may be read by several
+    RollingChecksums in different threads at once. Values that are
+    added while the set is being read are kept in a pending set. They
+    are moved to the real set before the next read starts, which
+    waits for the current readers to finish first."""
     cdef IntSet* intset
+    cdef RollingFilter rolling_filter
+    cdef int readers
+    cdef object pending
+    cdef object flushed
 
     def __cinit__(self):
         self.intset = NULL
@@ -89,25 +209,74 @@ cdef class IntegerSet:
         while adjusted_bucket_count < bucket_count:
             adjusted_bucket_count *= 2
         self.intset = create_intset(adjusted_bucket_count)
+        self.rolling_filter = None
+        self.readers = 0
+        self.pending = set()
+        self.flushed = threading.Condition()
 
     def __dealloc__(self):
         if self.intset != NULL:
             destroy_intset(self.intset)
 
+    def set_filter(self, RollingFilter rolling_filter):
+        """Makes this set also contain all values in the given
+        filter. The filter may give false positives."""
+        self.rolling_filter = rolling_filter
+
     def add(self, uint64_t int_to_add):
-        add_intset(self.intset, int_to_add)
-    
+        if self.readers > 0:
+            self.pending.add(int_to_add)
+        else:
+            add_intset(self.intset, int_to_add)
+
     def add_all(self, ints_to_add):
         cdef uint64_t n
         for n in ints_to_add:
             self.add(n)
 
     def contains(self, uint64_t int_to_find):
-        return bool(contains_intset(self.intset, int_to_find))
-
-    cdef IntSet* get_intset(self):
+        if contains_intset(self.intset, int_to_find) or int_to_find in self.pending:
+            return True
+        if self.rolling_filter is not None:
+            return bool(contains_bloom(self.rolling_filter.get_bloom(), int_to_find))
+        return False
+
+    cdef IntSet* begin_read(self):
+        """Returns the real set, which is guaranteed not to be
+        modified until end_read() is called. The GIL does not need to
+        be held while reading it. All values added before this call
+        are in the returned set."""
+        if self.pending:
+            with self.flushed:
+                # Other readers only hold the set while scanning a
+                # single fragment, so this wait is short.
+                while self.pending and self.readers > 0:
+                    self.flushed.wait()
+                if self.pending:
+                    self._flush_pending()
+        self.readers += 1
         return self.intset
 
+    cdef end_read(self):
+        assert self.readers > 0
+        self.readers -= 1
+        if self.readers == 0 and self.pending:
+            with self.flushed:
+                self._flush_pending()
+                self.flushed.notify_all()
+
+    cdef _flush_pending(self):
+        cdef uint64_t n
+        assert self.readers == 0
+        for n in self.pending:
+            add_intset(self.intset, n)
+        self.pending = set()
+
+    cdef BloomFilter* get_bloom(self):
+        if self.rolling_filter is None:
+            return NULL
+        return self.rolling_filter.get_bloom()
+
 cdef class RollingChecksum:
     cdef RollingState* state
     cdef uint64_t feeded_bytecount
@@ -156,21 +325,96 @@ cdef class RollingChecksum:
         cdef uint64_t rolling_value
         cdef char* buf
         cdef unsigned int buf_len
+        cdef unsigned int pos
+        cdef uint64_t bytecount
+        cdef int hit
         cdef IntSet* intset
+        cdef BloomFilter* bloom
         while True: # Until StopIteration or a hit is returned
             if self.feed_pos == len(self.feed_s):
                 self._pop_queue()
             buf = self.feed_s
             buf_len = len(self.feed_s)
-            intset = self.my_intset.get_intset()
-            while self.feed_pos < buf_len:
-                push_rolling(self.state, buf[self.feed_pos])
-                self.feeded_bytecount += 1
-                self.feed_pos += 1
-                if self.feeded_bytecount >= self.window_size:
-                    rolling_value = value64_rolling(self.state)
-                    if contains_intset(intset, rolling_value):
-                        return (self.feeded_bytecount - self.window_size, rolling_value)
+            pos = self.feed_pos
+            bytecount = self.feeded_bytecount
+            hit = 0
+            bloom = self.my_intset.get_bloom()
+            intset = self.my_intset.begin_read()
+            try:
+                # The GIL is released while scanning, so that other
+                # threads can deduplicate other blobs meanwhile.
+                with nogil:
+                    while pos < buf_len:
+                        push_rolling(self.state, buf[pos])
+                        bytecount += 1
+                        pos += 1
+                        if bytecount >= self.window_size:
+                            rolling_value = value64_rolling(self.state)
+                            if contains_intset(intset, rolling_value) or \
+                                    (bloom != NULL and contains_bloom(bloom, rolling_value)):
+                                hit = 1
+                                break
+            finally:
+                self.my_intset.end_read()
+            self.feed_pos = pos
+            self.feeded_bytecount = bytecount
+            if hit:
+                return (self.feeded_bytecount - self.window_size, rolling_value)
+
+    def find_candidates(self, unsigned int max_count, uint64_t min_offset = 0):
+        """Scans the fed data for hits, and returns at most max_count
+        of them at once, as a tuple of two lists: the offsets and the
+        rolling values of the hits. Hits at offsets below min_offset
+        are skipped. Empty lists are returned when all fed data has
+        been scanned. This is much faster than iterating, and the GIL
+        is released while scanning."""
+        assert max_count > 0
+        cdef char* buf
+        cdef unsigned int buf_len
+        cdef unsigned int pos
+        cdef uint64_t bytecount
+        cdef uint64_t rolling_value
+        cdef unsigned int hit_count = 0
+        cdef BloomFilter* bloom = self.my_intset.get_bloom()
+        cdef IntSet* intset
+        # Every hit is stored as an offset followed by a rolling value
+        cdef uint64_t* hits = <uint64_t*> malloc(max_count * 2 * sizeof(uint64_t))
+        if hits == NULL:
+            raise MemoryError()
+        try:
+            while hit_count < max_count:
+                if self.feed_pos == len(self.feed_s):
+                    if not self.feed_queue:
+                        break
+                    self.feed_s = self.feed_queue.pop(0)
+                    self.feed_pos = 0
+                    continue
+                buf = self.feed_s
+                buf_len = len(self.feed_s)
+                pos = self.feed_pos
+                bytecount = self.feeded_bytecount
+                intset = self.my_intset.begin_read()
+                try:
+                    with nogil:
+                        while pos < buf_len and hit_count < max_count:
+                            push_rolling(self.state, buf[pos])
+                            bytecount += 1
+                            pos += 1
+                            if bytecount < self.window_size or bytecount - self.window_size < min_offset:
+                                continue
+                            rolling_value = value64_rolling(self.state)
+                            if contains_intset(intset, rolling_value) or \
+                                    (bloom != NULL and contains_bloom(bloom, rolling_value)):
+                                hits[hit_count * 2] = bytecount - self.window_size
+                                hits[hit_count * 2 + 1] = rolling_value
+                                hit_count += 1
+                finally:
+                    self.my_intset.end_read()
+                self.feed_pos = pos
+                self.feeded_bytecount = bytecount
+            return [hits[i * 2] for i in range(hit_count)], [hits[i * 2 + 1] for i in range(hit_count)]
+        finally:
+            free(hits)
 
     cpdef uint64_t value(self):
         try:
@@ -268,12 +512,13 @@ class StopWatch:
         self.t_last = time.time()
 
 cdef class BlocksDB:
+   """A database of the blocks in a repository. It may be shared by
+   several threads. The lookup methods do not hold the GIL while
+   accessing the database."""
    cdef void* dbhandle
    cdef int in_transaction
-   cdef IntegerSet all_rolling
    cdef int is_modified
-   cdef int last_seen_modcount
-   cdef int __rolling_loaded
+   cdef PyThread_type_lock lock
 
    def __init__(self, dbfile, block_size):
        assert isinstance(block_size, (int, long)), \
@@ -284,139 +529,395 @@ cdef class BlocksDB:
            raise SoftCorruptionError(get_error_message(self.dbhandle))
        self.in_transaction = False
        self.is_modified = False
-       self.last_seen_modcount = -1
-       self.__rolling_loaded = False # Lazy initialization
-
-   def __load_rolling_lazy(self):
-       if self.__rolling_loaded:
-           return
-       self.__rolling_loaded = True
-       self.__reload_rolling()
 
    def __cinit__(self):
        self.dbhandle = NULL
+       self.lock = PyThread_allocate_lock()
+       if self.lock == NULL:
+           raise MemoryError()
 
    def __dealloc__(self):
        if self.dbhandle != NULL:
            close_blocksdb(self.dbhandle)
-   
-   def __reload_rolling(self):
-       rolling = self.get_all_rolling()
-       self.all_rolling = IntegerSet(max(len(rolling), 2**16))
-       self.all_rolling.add_all(rolling)
-
-       # This is not transaction safe unless we're in a transaction -
-       # it is possible some commit went through since we finished
-       # reading the values, but let's not push the issue, the
-       # consequences are slight.
-       result = get_modcount(self.dbhandle, &self.last_seen_modcount)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
+       if self.lock != NULL:
+           PyThread_free_lock(self.lock)
+
+   cdef _lock(self):
+       # The GIL must not be held while waiting, or a thread that
+       # holds the lock could never get the GIL back.
+       with nogil:
+           PyThread_acquire_lock(self.lock, WAIT_LOCK)
+
+   cdef _unlock(self):
+       PyThread_release_lock(self.lock)
 
    def get_all_rolling(self):
-        self.__load_rolling_lazy()
         result = []
-        if get_rolling_init(self.dbhandle) != BLOCKSDB_DONE:
-            raise Exception(get_error_message(self.dbhandle))
         cdef uint64_t rolling
-        while True:
-            s = get_rolling_next(self.dbhandle, &rolling)
-            if s == BLOCKSDB_ROW:
-                result.append(rolling)
-            elif s == BLOCKSDB_DONE:
-                break
-            else:
+        self._lock()
+        try:
+            if get_rolling_init(self.dbhandle) != BLOCKSDB_DONE:
+                raise Exception(get_error_message(self.dbhandle))
+            while True:
+                s = get_rolling_next(self.dbhandle, &rolling)
+                if s == BLOCKSDB_ROW:
+                    result.append(rolling)
+                elif s == BLOCKSDB_DONE:
+                    break
+                else:
+                    raise Exception(get_error_message(self.dbhandle))
+            if get_rolling_finish(self.dbhandle) != BLOCKSDB_DONE:
                 raise Exception(get_error_message(self.dbhandle))
-        if get_rolling_finish(self.dbhandle) != BLOCKSDB_DONE:
-            raise Exception(get_error_message(self.dbhandle))
+        finally:
+            self._unlock()
         return result
 
+   def get_rolling_page(self, after_rowid = 0, limit = 10000):
+       """Returns a tuple (last_rowid, values), where values is a list
+       of at most 'limit' rolling checksums, following the one with the
+       given rowid. An empty list means that all values have been
+       read."""
+       cdef int64_t c_after_rowid = after_rowid
+       cdef int c_limit = limit
+       cdef int count = 0
+       cdef int64_t last_rowid = 0
+       cdef BLOCKSDB_RESULT result
+       cdef uint64_t* values = <uint64_t*> malloc(max(limit, 1) * sizeof(uint64_t))
+       if values == NULL:
+           raise MemoryError()
+       try:
+           self._lock()
+           try:
+               with nogil:
+                   result = get_rolling_page(self.dbhandle, c_after_rowid, c_limit, values, &count, &last_rowid)
+               if result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+           finally:
+               self._unlock()
+           return last_rowid, [values[i] for i in range(count)]
+       finally:
+           free(values)
+
+   def get_rolling_pages(self, page_size = 10000):
+       """Yields all rolling checksums as lists of at most page_size
+       values."""
+       rowid = 0
+       while True:
+           rowid, values = self.get_rolling_page(rowid, page_size)
+           if not values:
+               break
+           yield values
+
+   def get_rolling_count(self):
+       cdef int64_t count
+       self._lock()
+       try:
+           result = get_rolling_count(self.dbhandle, &count)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
+       return count
+
+   def get_modcount(self):
+       """Returns the modification counter, which is incremented by
+       every transaction that adds something to the database."""
+       cdef int modcount
+       self._lock()
+       try:
+           result = get_modcount(self.dbhandle, &modcount)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
+       return modcount
+
    def has_block(self, md5):
        return bool(self.get_block_locations(md5, limit = 1))
 
+   def has_blocks(self, md5s):
+       """Returns the set of the given blocks that exist in the
+       database. All blocks are looked up in a single call."""
+       md5s = list(md5s)
+       if not md5s:
+           return set()
+       joined_md5s = "".join(md5s)
+       assert len(joined_md5s) == 32 * len(md5s), "Not a list of md5 sums"
+       cdef const char* c_md5s = joined_md5s
+       cdef int count = len(md5s)
+       cdef BLOCKSDB_RESULT result
+       cdef int* found = <int*> malloc(count * sizeof(int))
+       if found == NULL:
+           raise MemoryError()
+       try:
+           self._lock()
+           try:
+               with nogil:
+                   result = has_blocks(self.dbhandle, c_md5s, count, found)
+               if result == BLOCKSDB_ERR_CORRUPT:
+                   raise SoftCorruptionError(get_error_message(self.dbhandle))
+               elif result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+           finally:
+               self._unlock()
+           return set([md5s[i] for i in range(count) if found[i]])
+       finally:
+           free(found)
+
+   def lookup_blocks(self, md5s, limit = -1):
+       """Returns a dict with the locations of the given blocks, as
+       lists of (blob, offset) tuples. At most 'limit' locations are
+       returned for every block. Blocks that do not exist are left
+       out. All blocks are looked up in a single call."""
+       md5s = list(md5s)
+       if not md5s:
+           return {}
+       joined_md5s = "".join(md5s)
+       assert len(joined_md5s) == 32 * len(md5s), "Not a list of md5 sums"
+       cdef const char* c_md5s = joined_md5s
+       cdef int count = len(md5s)
+       cdef int c_limit = limit
+       cdef BlockLocation* locations = NULL
+       cdef int location_count = 0
+       cdef BLOCKSDB_RESULT result
+       self._lock()
+       try:
+           with nogil:
+               result = get_blocks_many(self.dbhandle, c_md5s, count, c_limit, &locations, &location_count)
+           if result == BLOCKSDB_ERR_CORRUPT:
+               raise SoftCorruptionError(get_error_message(self.dbhandle))
+           elif result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
+       try:
+           block_locations = {}
+           for i in range(location_count):
+               md5 = md5s[locations[i].index]
+               if md5 not in block_locations:
+                   block_locations[md5] = []
+               block_locations[md5].append((locations[i].blob, locations[i].offset))
+           return block_locations
+       finally:
+           free(locations)
+
    def get_block_locations(self, md5, limit = -1):
-        result = []
-        if BLOCKSDB_DONE != get_blocks_init(self.dbhandle, md5, limit):
-            raise Exception(get_error_message(self.dbhandle))
-        cdef char blob[33]
-        cdef uint64_t offset
-        while True:
-            s = get_blocks_next(self.dbhandle, blob, &offset)
-            if s == BLOCKSDB_ROW:
-                blob[32] = 0
-                result.append((blob, offset))
-            elif s == BLOCKSDB_DONE:
-                break
-            else:
-                raise SoftCorruptionError(get_error_message(self.dbhandle))            
-        if BLOCKSDB_DONE != get_blocks_finish(self.dbhandle):
-            raise Exception(get_error_message(self.dbhandle))
-        return result
+        return self.lookup_blocks([md5], limit).get(md5, [])
+
+   def find_block_at(self, md5, locations):
+       """Returns the ones of the given (blob, offset) locations where
+       the block with the given md5 is stored, in the given order. All
+       locations are looked up in a single call."""
+       locations = list(locations)
+       if not locations:
+           return []
+       joined_blobs = "".join([blob for blob, offset in locations])
+       assert len(joined_blobs) == 32 * len(locations), "Not a list of blob names"
+       assert len(md5) == 32, "Not an md5 sum"
+       cdef const char* c_md5 = md5
+       cdef const char* c_blobs = joined_blobs
+       cdef int count = len(locations)
+       cdef BLOCKSDB_RESULT result
+       cdef uint64_t* offsets = <uint64_t*> malloc(count * sizeof(uint64_t))
+       cdef int* found = <int*> malloc(count * sizeof(int))
+       try:
+           if offsets == NULL or found == NULL:
+               raise MemoryError()
+           for i in range(count):
+               offsets[i] = locations[i][1]
+           self._lock()
+           try:
+               with nogil:
+                   result = find_block_at(self.dbhandle, c_md5, c_blobs, offsets, count, found)
+               if result == BLOCKSDB_ERR_CORRUPT:
+                   raise SoftCorruptionError(get_error_message(self.dbhandle))
+               elif result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+           finally:
+               self._unlock()
+           return [locations[i] for i in range(count) if found[i]]
+       finally:
+           free(offsets)
+           free(found)
+
+   def get_blocks_page(self, after_rowid = 0, limit = 10000):
+       """Returns a tuple (last_rowid, blocks), where blocks is a list
+       of at most 'limit' (blob, offset, md5) tuples, following the
+       block with the given rowid. The returned rowid is used to fetch
+       the next page. An empty list means that all blocks have been
+       read."""
+       cdef int64_t c_after_rowid = after_rowid
+       cdef int c_limit = limit
+       cdef BlockEntry* entries = NULL
+       cdef int entry_count = 0
+       cdef int64_t last_rowid = 0
+       cdef BLOCKSDB_RESULT result
+       self._lock()
+       try:
+           with nogil:
+               result = get_blocks_page(self.dbhandle, c_after_rowid, c_limit, &entries, &entry_count, &last_rowid)
+           if result == BLOCKSDB_ERR_CORRUPT:
+               raise SoftCorruptionError(get_error_message(self.dbhandle))
+           elif result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
+       try:
+           return last_rowid, [(entries[i].blob, entries[i].offset, entries[i].md5) for i in range(entry_count)]
+       finally:
+           free(entries)
+
+   def add_blocks(self, blocks):
+       """Adds the given list of (blob, offset, md5) tuples in a single
+       call."""
+       assert self.in_transaction, "Tried to add a block outside of a transaction"
+       blocks = list(blocks)
+       if not blocks:
+           return
+       joined_blobs = "".join([blob for blob, offset, md5 in blocks])
+       joined_md5s = "".join([md5 for blob, offset, md5 in blocks])
+       assert len(joined_blobs) == 32 * len(blocks), "Not a list of blob names"
+       assert len(joined_md5s) == 32 * len(blocks), "Not a list of md5 sums"
+       cdef const char* c_blobs = joined_blobs
+       cdef const char* c_md5s = joined_md5s
+       cdef int count = len(blocks)
+       cdef BLOCKSDB_RESULT result
+       cdef uint64_t* offsets = <uint64_t*> malloc(count * sizeof(uint64_t))
+       if offsets == NULL:
+           raise MemoryError()
+       try:
+           for i in range(count):
+               offsets[i] = blocks[i][1]
+           self._lock()
+           try:
+               with nogil:
+                   result = add_blocks(self.dbhandle, c_blobs, offsets, c_md5s, count)
+               if result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+           finally:
+               self._unlock()
+       finally:
+           free(offsets)
+       self.is_modified = True
+
+   def add_rollings(self, rollings):
+       """Adds the given rolling checksums in a single call. Already
+       existing values are ignored."""
+       assert self.in_transaction, "Tried to add a rolling cs outside of a transaction"
+       rollings = list(rollings)
+       if not rollings:
+           return
+       cdef int count = len(rollings)
+       cdef BLOCKSDB_RESULT result
+       cdef uint64_t* c_rollings = <uint64_t*> malloc(count * sizeof(uint64_t))
+       if c_rollings == NULL:
+           raise MemoryError()
+       try:
+           for i in range(count):
+               c_rollings[i] = rollings[i]
+           self._lock()
+           try:
+               with nogil:
+                   result = add_rollings(self.dbhandle, c_rollings, count)
+               if result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+           finally:
+               self._unlock()
+       finally:
+           free(c_rollings)
+       self.is_modified = True
 
    def add_rolling(self, rolling):
-       self.__load_rolling_lazy()
+       """Adds the given rolling checksum, unless it already exists."""
        assert self.in_transaction, "Tried to add a rolling cs outside of a transaction"
-       if not self.all_rolling.contains(rolling):
-           self.all_rolling.add(rolling)
-           self.is_modified = True
+       self.is_modified = True
+       self._lock()
+       try:
            result = add_rolling(self.dbhandle, rolling)
            if result != BLOCKSDB_DONE:
                raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
 
    def delete_blocks(self, blobs):
        #print "Deleting blocks belonging to blobs", blobs
        assert self.in_transaction, "Tried to delete blocks outside of a transaction"
-       if BLOCKSDB_DONE != delete_blocks_init(self.dbhandle):
-           raise Exception(get_error_message(self.dbhandle))
-
-       for blob in blobs:
-           if BLOCKSDB_DONE != delete_blocks_add(self.dbhandle, blob):
+       self._lock()
+       try:
+           if BLOCKSDB_DONE != delete_blocks_init(self.dbhandle):
                raise Exception(get_error_message(self.dbhandle))
 
-       if BLOCKSDB_DONE != delete_blocks_finish(self.dbhandle):
-           raise Exception(get_error_message(self.dbhandle))
-           
+           for blob in blobs:
+               if BLOCKSDB_DONE != delete_blocks_add(self.dbhandle, blob):
+                   raise Exception(get_error_message(self.dbhandle))
+
+           if BLOCKSDB_DONE != delete_blocks_finish(self.dbhandle):
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
 
    def add_block(self, blob, offset, md5):
-       assert self.in_transaction, "Tried to add a block outside of a transaction"       
-       result = add_block(self.dbhandle, blob, offset, md5)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
+       assert self.in_transaction, "Tried to add a block outside of a transaction"
+       self._lock()
+       try:
+           result = add_block(self.dbhandle, blob, offset, md5)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
        self.is_modified = True
-       
+
    def begin(self):
-       self.__load_rolling_lazy()
        assert not self.in_transaction, "Tried to start a transaction while one was already in progress"
-       result = begin_blocksdb(self.dbhandle)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
-       cdef int current_modcount
-       result = get_modcount(self.dbhandle, &current_modcount)
-       if self.last_seen_modcount != current_modcount:
-           self.__reload_rolling()
+       self._lock()
+       try:
+           result = begin_blocksdb(self.dbhandle)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
        self.in_transaction = True
 
    def commit(self):
        assert self.in_transaction, "Tried to do a commit while no transaction was in progress"
        self.in_transaction = False
-       if self.is_modified:
-           result = increment_modcount(self.dbhandle)
+       self._lock()
+       try:
+           if self.is_modified:
+               result = increment_modcount(self.dbhandle)
+               if result != BLOCKSDB_DONE:
+                   raise Exception(get_error_message(self.dbhandle))
+               self.is_modified = False
+
+           result = commit_blocksdb(self.dbhandle)
            if result != BLOCKSDB_DONE:
                raise Exception(get_error_message(self.dbhandle))
-           self.is_modified = False
-       result = get_modcount(self.dbhandle, &self.last_seen_modcount)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
 
-       result = commit_blocksdb(self.dbhandle)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
+   def rollback(self):
+       """Discards all changes made in the current transaction. It is
+       safe to call this even if there is no transaction in progress,
+       for instance after a failed commit()."""
+       self.in_transaction = False
+       self.is_modified = False
+       self._lock()
+       try:
+           result = rollback_blocksdb(self.dbhandle)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
 
    def get_block_size(self):
        cdef int block_size
-       result = get_block_size(self.dbhandle, &block_size)
-       if result != BLOCKSDB_DONE:
-           raise Exception(get_error_message(self.dbhandle))
+       self._lock()
+       try:
+           result = get_block_size(self.dbhandle, &block_size)
+           if result != BLOCKSDB_DONE:
+               raise Exception(get_error_message(self.dbhandle))
+       finally:
+           self._unlock()
        return block_size
        
 
@@ -0,0 +1,99 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+#include "chunker.h"
+
+#include "stdlib.h"
+#include "stdio.h"
+#include "stdint.h"
+
+static void massert(int condition, const char* message) {
+  if(condition == 0){
+    printf("Assertion failed: %s\n", message);
+    exit(1);
+  }
+}
+
+// The gear table must never change, since chunk boundaries of
+// existing data would move. It is generated with splitmix64 from a
+// fixed seed.
+static uint64_t gear[256];
+static int gear_initialized = 0;
+
+static void init_gear(void) {
+  uint64_t state = 0x626f617263646331ULL; // "boarcdc1"
+  for(int i = 0; i < 256; i++) {
+    state += 0x9e3779b97f4a7c15ULL;
+    uint64_t z = state;
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    gear[i] = z ^ (z >> 31);
+  }
+  gear_initialized = 1;
+}
+
+// A mask of the given number of bits. In the gear hash, a bit only
+// depends on the bytes that were shifted in after it, so the high
+// bits are used.
+static uint64_t high_mask(int bits) {
+  return ((1ULL << bits) - 1) << (64 - bits);
+}
+
+void init_chunker(Chunker* chunker, uint32_t avg_size) {
+  massert(avg_size >= 64 && (avg_size & (avg_size - 1)) == 0, "Average chunk size must be a power of 2, at least 64");
+  if(!gear_initialized)
+    init_gear();
+  int bits = 0;
+  while((1U << bits) < avg_size)
+    bits++;
+  chunker->hash = 0;
+  chunker->position = 0;
+  chunker->min_size = avg_size / 4;
+  chunker->avg_size = avg_size;
+  chunker->max_size = avg_size * 4;
+  // Normalized chunking, to make the chunk sizes closer to the average
+  chunker->mask_small = high_mask(bits + 2);
+  chunker->mask_large = high_mask(bits - 2);
+}
+
+size_t find_chunk_boundary(Chunker* chunker, const unsigned char* buf, size_t len, int* out_found) {
+  size_t i = 0;
+  uint32_t position = chunker->position;
+  uint64_t hash = chunker->hash;
+  *out_found = 0;
+  if(position < chunker->min_size) {
+    // No boundaries are possible before the minimum size, so the
+    // hash does not need to be updated.
+    const size_t skip = chunker->min_size - position;
+    if(skip >= len) {
+      chunker->position += len;
+      return len;
+    }
+    i = skip;
+    position = chunker->min_size;
+  }
+  for(; i < len; i++) {
+    hash = (hash << 1) + gear[buf[i]];
+    position++;
+    const uint64_t mask = position < chunker->avg_size ? chunker->mask_small : chunker->mask_large;
+    if((hash & mask) == 0 || position >= chunker->max_size) {
+      *out_found = 1;
+      chunker->hash = 0;
+      chunker->position = 0;
+      return i + 1;
+    }
+  }
+  chunker->hash = hash;
+  chunker->position = position;
+  return len;
+}
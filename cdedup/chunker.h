@@ -0,0 +1,46 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef CHUNKER_H
+#define CHUNKER_H
+
+#include <stdint.h>
+#include <stddef.h>
+
+// A content defined chunker, using the gear hash as described for
+// FastCDC by Xia et al. Chunk boundaries depend only on the data
+// since the start of the current chunk, so chunking can be restarted
+// at any chunk boundary with the same result.
+typedef struct _Chunker {
+  uint64_t hash;
+  uint32_t position; // Number of bytes in the current chunk
+  uint32_t min_size;
+  uint32_t avg_size;
+  uint32_t max_size;
+  uint64_t mask_small; // Used before the average size is reached
+  uint64_t mask_large; // Used after the average size is reached
+} Chunker;
+
+/* The average size must be a power of 2. */
+void init_chunker(Chunker* chunker, uint32_t avg_size);
+
+/* Scans the given buffer for the end of the current chunk. Returns
+ * the number of bytes that belong to the current chunk. If a
+ * boundary was found, *out_found is set to 1, and the next call will
+ * start on a new chunk. Otherwise, all bytes were consumed and
+ * *out_found is set to 0.
+ */
+size_t find_chunk_boundary(Chunker* chunker, const unsigned char* buf, size_t len, int* out_found);
+
+#endif
@@ -3,7 +3,7 @@ from distutils.extension import Extension
 from Cython.Distutils import build_ext
 
 ext_modules = [Extension("cdedup",
-                         ["cdedup.pyx", "rollsum.c", "intset.c", "circularbuffer.c", "blocksdb.c"],
+                         ["cdedup.pyx", "rollsum.c", "intset.c", "bloomfilter.c", "chunker.c", "circularbuffer.c", "blocksdb.c"],
                          extra_compile_args=["-static", "-O2", "-std=c99", "-Wall"],
                          extra_link_args=["sqlite3.o"],
                          )]
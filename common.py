@@ -30,6 +30,16 @@ import textwrap
 from tempfile import TemporaryFile
 from threading import current_thread
 
+try:
+    # Python 3.5+ has scandir built in, older versions may have the
+    # scandir module installed.
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 def json_has_bug():
     if type(json.loads(json.dumps("abc"))) != unicode: # Simplejson, built-in json
         return True
@@ -554,6 +564,160 @@ def get_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_pri
     # The order of the returned files must be deterministic for tests to pass.
     return sorted(all_files)
 
+# A directory listing is only recorded in a scan journal if the
+# directory had not been modified for this many seconds. Otherwise, a
+# change within the timestamp resolution of the file system could go
+# unnoticed.
+SCAN_JOURNAL_MARGIN = 5.0
+
+def _dir_key(stat):
+    """Returns the directory attributes that must be unchanged for a
+    recorded listing of the directory to be valid."""
+    return stat.st_mtime, stat.st_ctime, stat.st_ino
+
+def _scan_dir(path):
+    """Lists a single directory for scan_tree(). Returns a tuple (dirs,
+    files, complete), where dirs is a list of the names of the
+    subdirectories and files is a list of (name, stat result) tuples
+    for everything else. Symbolic links are followed. Complete is
+    False if some entries (broken symbolic links) were ignored. If the
+    scandir function is available, the file type information from the
+    directory listing is used, so that directories do not need to be
+    stat'ed."""
+    dirs = []
+    files = []
+    complete = True
+    if scandir:
+        entries = [(entry.name, entry) for entry in scandir(path)]
+    else:
+        entries = [(name, None) for name in os.listdir(path)]
+    for name, entry in entries:
+        if type(name) != unicode:
+            raise UndecodableFilenameException(path, name)
+        try:
+            if entry:
+                if entry.is_dir():
+                    dirs.append(name)
+                    continue
+                stat = entry.stat()
+            else:
+                stat = os.stat(os.path.join(path, name))
+        except OSError, e:
+            if e.errno == errno.ENOENT and os.path.islink(os.path.join(path, name)):
+                print "Warning: ignoring broken symbolic link: ", os.path.join(path, name)
+                complete = False
+                continue
+            raise
+        if os.path.stat.S_ISDIR(stat.st_mode):
+            dirs.append(name)
+        else:
+            files.append((name, stat))
+    return dirs, files, complete
+
+def _restat_dir(path, dirs, names):
+    """Stats the files of a recorded directory listing. Returns a
+    tuple on the same form as _scan_dir(), or None if the listing does
+    not match the directory anymore. The subdirectories are not
+    stat'ed here, since scan_tree() stats every directory it enters
+    anyway, and an added or removed subdirectory changes the key of
+    the directory."""
+    files = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(path, name))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if os.path.stat.S_ISDIR(stat.st_mode):
+            return None
+        files.append((name, stat))
+    return dirs, files, True
+
+def scan_tree(root, skip = [], progress_printer = None, threads = 1, journal = None):
+    """Like get_tree(), but returns a dict mapping the path of every
+    file under the given root directory to its stat result, so that
+    the caller does not need to stat the files again. The paths are
+    relative to the root, and always separated by "/", like session
+    paths.
+
+    If threads is larger than 1, that many directories are listed in
+    parallel. This makes scanning faster on file systems with high
+    latency, such as network file systems.
+
+    If a journal dict is given, it is used to avoid listing
+    directories that have not changed since the previous scan. The
+    dict maps the relative path of a directory to a tuple (key, dirs,
+    files) as recorded by the previous scan, and is updated in place
+    with the listings of this scan. The files in a directory are
+    always stat'ed, since modifying a file does not change the
+    directory.
+    """
+    assert isinstance(root, unicode) # Avoid any encoding problems later
+    assert type(skip) == type([]), "skip list must be a list"
+    assert threads >= 1
+    absolute_root = uabspath(root)
+    if not progress_printer:
+        class DummyProgressPrinter:
+            def update(self, new_value=None): pass
+            def finished(self): pass
+        progress_printer = DummyProgressPrinter()
+    scan_start = time.time()
+
+    def scan(relative_path):
+        path = os.path.join(absolute_root, relative_path.replace("/", os.sep))
+        key = None
+        try:
+            listing = None
+            if journal != None:
+                key = _dir_key(os.stat(path))
+                recorded = journal.get(relative_path, None)
+                if recorded and recorded[0] == key:
+                    listing = _restat_dir(path, recorded[1], recorded[2])
+            if listing == None:
+                listing = _scan_dir(path)
+            return relative_path, key, listing
+        except OSError, e:
+            # See get_tree() for why access errors are skipped
+            if e.errno != errno.EACCES:
+                raise
+            return relative_path, None, ([], [], False)
+
+    pool = None
+    if threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+    result = {}
+    new_journal = {}
+    try:
+        pending = [u""]
+        while pending:
+            if pool:
+                listings = pool.map(scan, pending)
+            else:
+                listings = map(scan, pending)
+            pending = []
+            for relative_path, key, (dirs, files, complete) in listings:
+                if key and complete and scan_start - key[0] >= SCAN_JOURNAL_MARGIN:
+                    new_journal[relative_path] = (key, dirs, [name for name, stat in files])
+                prefix = relative_path + "/" if relative_path else u""
+                for name in dirs:
+                    if name not in skip:
+                        pending.append(prefix + name)
+                for name, stat in files:
+                    if name not in skip:
+                        result[prefix + name] = stat
+                progress_printer.update(new_value=len(result))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if journal != None:
+        journal.clear()
+        journal.update(new_journal)
+    progress_printer.finished()
+    return result
+
 class FileMutex:
     """ The purpose of this class is to protect a shared resource from
     other processes. It accomplishes this by using the atomicity of
@@ -1086,6 +1250,20 @@ assert calculate_progress(10, 11) == 0.0  # Too large count
 assert calculate_progress(10, -5) == 0.0  # Illegal count
 assert calculate_progress(-5, -5) == 0.0  # Illegal
 
+def parse_duration(s):
+    """Parses a duration string such as "30d", "2h", "45m" or "90s"
+    and returns the number of seconds. A number without a unit is
+    interpreted as seconds. Raises ValueError for illegal strings."""
+    units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+    m = re.match("^([0-9]+)([smhdw]?)$", s.strip())
+    if not m:
+        raise ValueError("Illegal duration: '%s'" % s)
+    number, unit = m.groups()
+    return int(number) * units.get(unit, 1)
+
+assert parse_duration("30d") == 30 * 24 * 60 * 60
+assert parse_duration("90") == 90
+
 class ProgressHelper:
     def __init__(self, start_f, progress_callback):
         assert 0.0 <= start_f <= 1.0
@@ -23,13 +23,21 @@ from jsonrpc import FileDataSource
 import sys
 import tempfile
 import array
+import mmap
+import struct
+import bisect
+import sqlite3
+import re
+import threading
+
+from boar_exceptions import SoftCorruptionError
 
 try:
     if os.getenv("BOAR_DISABLE_DEDUP") == "1": raise ImportError()
     import cdedup
-    assert cdedup.__version__ == "1.0", "Unexpected deduplication module version (was: %s)" % rollingcs.__version__
+    assert cdedup.__version__ == "2.0", "Unexpected deduplication module version (was: %s)" % cdedup.__version__
     cdedup_version = cdedup.__version__
-    from cdedup import RollingChecksum, calc_rolling, IntegerSet, BlocksDB
+    from cdedup import RollingChecksum, calc_rolling, IntegerSet, BlocksDB, RollingFilter, ContentChunker
     dedup_available = True
 except ImportError:
     cdedup_version = None
@@ -50,6 +58,98 @@ def CreateIntegerSet(ints):
     intset.add_all(ints)
     return intset
 
+# The rolling filter is a bloom filter containing the rolling
+# checksums of all blocks in the blocks database. It is stored in a
+# file so that it can be memory mapped by every session writer,
+# instead of loading all rolling checksums from the database. The
+# header is followed by the bit array. The modcount is the blocksdb
+# modcount the filter was last synced with.
+ROLLING_FILTER_MAGIC = "BOARRFv1"
+ROLLING_FILTER_HEADER = struct.Struct("<8sQQIi") # magic, bit count, value count, hash count, modcount
+ROLLING_FILTER_BITS_PER_VALUE = 32 # Gives a false positive rate of about 2e-7 when full
+ROLLING_FILTER_HASH_COUNT = 22
+ROLLING_FILTER_MIN_CAPACITY = 100000
+
+class RollingFilterFile:
+    """An existing rolling filter file. If the file is missing or
+    invalid, is_valid() will return False. A filter opened without
+    writable access can still be added to, but the changes will only
+    be visible to this instance."""
+    def __init__(self, path, writable = False):
+        assert dedup_available
+        self.path = path
+        self.writable = writable
+        self.filter = None
+        self.mmap = None
+        self.bit_count, self.value_count, self.hash_count, self.modcount = 0, 0, 0, None
+        if os.path.exists(path):
+            self.__open()
+
+    def __open(self):
+        with open(self.path, "r+b" if self.writable else "rb") as f:
+            header = f.read(ROLLING_FILTER_HEADER.size)
+            if len(header) != ROLLING_FILTER_HEADER.size:
+                return
+            magic, bit_count, value_count, hash_count, modcount = ROLLING_FILTER_HEADER.unpack(header)
+            if magic != ROLLING_FILTER_MAGIC or bit_count < 8 or bit_count & (bit_count - 1) or hash_count == 0:
+                return
+            if os.fstat(f.fileno()).st_size != ROLLING_FILTER_HEADER.size + bit_count / 8:
+                return
+            access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_COPY
+            self.mmap = mmap.mmap(f.fileno(), 0, access = access)
+        self.filter = RollingFilter(self.mmap, ROLLING_FILTER_HEADER.size, bit_count, hash_count)
+        self.bit_count, self.value_count, self.hash_count, self.modcount = \
+            bit_count, value_count, hash_count, modcount
+
+    def is_valid(self):
+        return self.filter != None
+
+    def is_full(self):
+        assert self.is_valid()
+        return self.value_count >= self.bit_count / ROLLING_FILTER_BITS_PER_VALUE
+
+    def get_modcount(self):
+        assert self.is_valid()
+        return self.modcount
+
+    def contains(self, rolling):
+        return self.filter.contains(rolling)
+
+    def add(self, rolling):
+        self.filter.add(rolling)
+        self.value_count += 1
+
+    def flush(self, modcount):
+        """Writes the header, stamped with the given blocksdb
+        modcount, and flushes all changes to disk."""
+        assert self.writable and self.is_valid()
+        self.modcount = modcount
+        self.mmap[0:ROLLING_FILTER_HEADER.size] = ROLLING_FILTER_HEADER.pack(
+            ROLLING_FILTER_MAGIC, self.bit_count, self.value_count, self.hash_count, self.modcount)
+        self.mmap.flush()
+
+def create_rolling_filter(path, rolling_count, rolling_pages, modcount):
+    """Creates a new rolling filter file at the given path, replacing
+    any existing file. It will contain the rolling values in the given
+    iterable of lists, which must hold rolling_count values in total,
+    and will be stamped with the given blocksdb modcount. There will be
+    room for at least as many new values. Returns a writable
+    RollingFilterFile."""
+    capacity = max(2 * rolling_count, ROLLING_FILTER_MIN_CAPACITY)
+    bit_count = 8
+    while bit_count < capacity * ROLLING_FILTER_BITS_PER_VALUE:
+        bit_count *= 2
+    bits = bytearray(bit_count / 8)
+    bloom = RollingFilter(bits, 0, bit_count, ROLLING_FILTER_HASH_COUNT)
+    for rolling_values in rolling_pages:
+        bloom.add_all(rolling_values)
+    header = ROLLING_FILTER_HEADER.pack(ROLLING_FILTER_MAGIC, bit_count, rolling_count,
+                                        ROLLING_FILTER_HASH_COUNT, modcount)
+    replace_file(path, header + str(bits))
+    rolling_filter = RollingFilterFile(path, writable = True)
+    assert rolling_filter.is_valid()
+    return rolling_filter
+
 class FakeRollingChecksum:
     """This is a dummy version of RollingChecksum. An instance of this
     class will never report any hits."""
@@ -59,6 +159,9 @@ class FakeRollingChecksum:
     def feed_string(self, s):
         pass
 
+    def find_candidates(self, max_count, min_offset = 0):
+        return [], []
+
     def __iter__(self):
         return self
 
@@ -91,25 +194,57 @@ class FakeBlockChecksum:
         return []
 
 class TmpBlocksDB:
+    """Adds the blocks of the blobs that are not yet committed to the
+    given blocks db. It may be shared by several threads."""
     def __init__(self, blocksdb):
         self.blocksdb = blocksdb
         self.blocks = {} # md5 -> [(blob, offset), ...]
+        self.blocks_at = {} # (blob, offset) -> md5
+        self.lock = threading.Lock()
 
     def add_tmp_block(self, md5, blob, offset):
         assert is_md5sum(md5)
         assert is_md5sum(blob)
-        if md5 not in self.blocks:
-            self.blocks[md5] = []
-        self.blocks[md5].append((blob, offset))
+        with self.lock:
+            if md5 not in self.blocks:
+                self.blocks[md5] = []
+            self.blocks[md5].append((blob, offset))
+            self.blocks_at[(blob, offset)] = md5
 
     def get_block_size(self):
         return self.blocksdb.get_block_size()
 
     def get_block_locations(self, md5, limit = -1):
-        return self.blocks.get(md5, []) + self.blocksdb.get_block_locations(md5, limit)
+        with self.lock:
+            tmp_locations = list(self.blocks.get(md5, []))
+        return tmp_locations + self.blocksdb.get_block_locations(md5, limit)
+
+    def lookup_blocks(self, md5s, limit = -1):
+        md5s = list(md5s)
+        result = self.blocksdb.lookup_blocks(md5s, limit)
+        with self.lock:
+            for md5 in md5s:
+                if md5 in self.blocks:
+                    result[md5] = self.blocks[md5] + result.get(md5, [])
+        return result
+
+    def find_block_at(self, md5, locations):
+        locations = list(locations)
+        with self.lock:
+            tmp_found = set([location for location in locations if self.blocks_at.get(location) == md5])
+        found = set(self.blocksdb.find_block_at(md5, [location for location in locations if location not in tmp_found]))
+        return [location for location in locations if location in tmp_found or location in found]
 
     def has_block(self, md5):
-        return md5 in self.blocks or self.blocksdb.has_block(md5)
+        with self.lock:
+            if md5 in self.blocks:
+                return True
+        return self.blocksdb.has_block(md5)
+
+    def has_blocks(self, md5s):
+        with self.lock:
+            found = set([md5 for md5 in md5s if md5 in self.blocks])
+        return found | self.blocksdb.has_blocks([md5 for md5 in md5s if md5 not in found])
 
 class FakeBlocksDB:
     def __init__(self, dbfile, block_size):
@@ -118,32 +253,239 @@ class FakeBlocksDB:
     def get_all_rolling(self):
         return []
 
+    def get_rolling_pages(self):
+        return iter([])
+
+    def get_rolling_count(self):
+        return 0
+
+    def get_modcount(self):
+        return 0
+
     def has_block(self, md5):
         return False
 
+    def has_blocks(self, md5s):
+        return set()
+
     def get_block_locations(self, md5, limit = -1):
         return []
 
+    def lookup_blocks(self, md5s, limit = -1):
+        return {}
+
+    def find_block_at(self, md5, locations):
+        return []
+
     def add_rolling(self, rolling):
         pass
 
+    def add_rollings(self, rollings):
+        pass
+
     def delete_blocks(self, blobs):
         pass
 
     def add_block(self, blob, offset, md5):
         pass
 
+    def add_blocks(self, blocks):
+        pass
+
     def begin(self):
         pass
 
     def commit(self):
         pass
 
+    def rollback(self):
+        pass
+
     def get_block_size(self):
         return self.block_size
 
+BLOCKSDB_SHARD_COUNT = 16
+BLOCKSDB_PAGE_SIZE = 10000
+
+# The max number of threads that look up a batch of blocks in the
+# shards of a ShardedBlocksDB at the same time. BlocksDB releases the
+# GIL while it searches, so more threads could pay off with several
+# cores. But new threads are started for every batch, and no gain has
+# been measured yet, so the lookups are sequential by default.
+BLOCKSDB_LOOKUP_THREADS = 1
+
+class ShardedBlocksDB:
+    """A blocks database that is partitioned into a number of shards,
+    each stored as a BlocksDB file in the given directory. Blocks are
+    placed in shards by the prefix of their md5 sum, and rolling
+    checksums by their value. Every shard has its own lock, so threads
+    looking up blocks in different shards do not have to wait for
+    each other, and a batch lookup queries its shards from up to
+    lookup_threads threads. The interface is the same as for
+    BlocksDB."""
+    def __init__(self, dirpath, block_size, shard_count = BLOCKSDB_SHARD_COUNT,
+                 lookup_threads = BLOCKSDB_LOOKUP_THREADS):
+        assert shard_count > 0
+        assert lookup_threads > 0
+        self.lookup_threads = lookup_threads
+        if not os.path.exists(dirpath):
+            os.mkdir(dirpath)
+        filenames = ["blocks-%02d.db" % n for n in range(0, shard_count)]
+        existing = [fn for fn in os.listdir(dirpath) if re.match("^blocks-\d+\.db$", fn)]
+        if existing and sorted(existing) != filenames:
+            raise SoftCorruptionError("Blocks database shards are missing or unexpected: %s" % dirpath)
+        self.shards = [BlocksDB(os.path.join(dirpath, fn), block_size) for fn in filenames]
+
+    def __block_shard(self, md5):
+        assert is_md5sum(md5)
+        return int(md5[:4], 16) % len(self.shards)
+
+    def __group_by_shard(self, items, key):
+        groups = {}
+        for item in items:
+            groups.setdefault(key(item), []).append(item)
+        return groups.items()
+
+    def __map_shards(self, function, groups):
+        """Calls function(shard, items) for every (shard number, items)
+        pair in the given list, and returns a list of the results in no
+        particular order. The calls are spread over up to
+        lookup_threads threads, one of them being the calling
+        thread."""
+        if self.lookup_threads == 1 or len(groups) < 2:
+            return [function(self.shards[n], items) for n, items in groups]
+        thread_count = min(self.lookup_threads, len(groups))
+        results = []
+        errors = []
+        def worker(work):
+            try:
+                for n, items in work:
+                    results.append(function(self.shards[n], items))
+            except:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target = worker, args = (groups[i::thread_count],))
+                   for i in range(1, thread_count)]
+        for thread in threads:
+            thread.start()
+        worker(groups[0::thread_count])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def get_all_rolling(self):
+        result = []
+        for shard in self.shards:
+            result += shard.get_all_rolling()
+        return result
+
+    def get_rolling_pages(self, page_size = BLOCKSDB_PAGE_SIZE):
+        for shard in self.shards:
+            for rolling_values in shard.get_rolling_pages(page_size):
+                yield rolling_values
+
+    def get_rolling_count(self):
+        return sum([shard.get_rolling_count() for shard in self.shards])
+
+    def get_modcount(self):
+        return sum([shard.get_modcount() for shard in self.shards])
+
+    def has_block(self, md5):
+        return self.shards[self.__block_shard(md5)].has_block(md5)
+
+    def has_blocks(self, md5s):
+        result = set()
+        for found in self.__map_shards(lambda shard, shard_md5s: shard.has_blocks(shard_md5s),
+                                       self.__group_by_shard(md5s, self.__block_shard)):
+            result |= found
+        return result
+
+    def get_block_locations(self, md5, limit = -1):
+        return self.shards[self.__block_shard(md5)].get_block_locations(md5, limit)
+
+    def lookup_blocks(self, md5s, limit = -1):
+        result = {}
+        for locations in self.__map_shards(lambda shard, shard_md5s: shard.lookup_blocks(shard_md5s, limit),
+                                           self.__group_by_shard(md5s, self.__block_shard)):
+            result.update(locations)
+        return result
+
+    def find_block_at(self, md5, locations):
+        return self.shards[self.__block_shard(md5)].find_block_at(md5, locations)
+
+    def add_rolling(self, rolling):
+        self.shards[rolling % len(self.shards)].add_rolling(rolling)
+
+    def add_rollings(self, rollings):
+        for n, shard_rollings in self.__group_by_shard(rollings, lambda rolling: rolling % len(self.shards)):
+            self.shards[n].add_rollings(shard_rollings)
+
+    def delete_blocks(self, blobs):
+        for shard in self.shards:
+            shard.delete_blocks(blobs)
+
+    def add_block(self, blob, offset, md5):
+        self.shards[self.__block_shard(md5)].add_block(blob, offset, md5)
+
+    def add_blocks(self, blocks):
+        """Adds the given list of (blob, offset, md5) tuples, with a
+        single call to every shard involved."""
+        for n, shard_blocks in self.__group_by_shard(blocks, lambda block: self.__block_shard(block[2])):
+            self.shards[n].add_blocks(shard_blocks)
+
+    def begin(self):
+        for n, shard in enumerate(self.shards):
+            try:
+                shard.begin()
+            except:
+                self.__rollback_after_error(self.shards[:n])
 
+    def commit(self):
+        """Commits every shard. This is not atomic: if a shard fails
+        to commit, the shards before it stay committed and the rest
+        are rolled back. The blocks are recreated from the queued
+        blocks lists the next time the repository is opened, so a
+        partial commit only delays them."""
+        for n, shard in enumerate(self.shards):
+            try:
+                shard.commit()
+            except:
+                self.__rollback_after_error(self.shards[n:])
+
+    def rollback(self):
+        for shard in self.shards:
+            shard.rollback()
+
+    def __rollback_after_error(self, shards):
+        """Rolls back the given shards and re-raises the exception that
+        is currently being handled, leaving all shards ready for a new
+        transaction."""
+        exc_info = sys.exc_info()
+        for shard in shards:
+            try:
+                shard.rollback()
+            except Exception:
+                pass # The original error is the interesting one
+        raise exc_info[0], exc_info[1], exc_info[2]
 
+    def get_block_size(self):
+        return self.shards[0].get_block_size()
+
+def copy_blocksdb(source, destination):
+    """Copies all blocks and rolling checksums from the source BlocksDB
+    to the destination, in a single transaction. Everything is read a
+    page at a time, and every block is verified while reading."""
+    destination.begin()
+    rowid = 0
+    while True:
+        rowid, blocks = source.get_blocks_page(rowid, BLOCKSDB_PAGE_SIZE)
+        if not blocks:
+            break
+        destination.add_blocks(blocks)
+    for rolling_values in source.get_rolling_pages(BLOCKSDB_PAGE_SIZE):
+        destination.add_rollings(rolling_values)
+    destination.commit()
 
 class BlockChecksum:
     def __init__(self, window_size):
@@ -167,8 +509,129 @@ class BlockChecksum:
         self.blocks = []
         return result
 
+class ChunkChecksum:
+    """The content defined chunking counterpart of BlockChecksum. The
+    data is split into chunks with the given average size, and
+    harvest() returns a list of (offset, size, md5) tuples. The last
+    chunk is included even if the data does not end at a chunk
+    boundary, so harvest() should only be called when all data has
+    been fed."""
+    def __init__(self, avg_chunk_size):
+        self.buffer = TailBuffer()
+        self.chunker = ContentChunker(avg_chunk_size)
+        self.position = 0
+        self.chunks = []
+
+    def feed_string(self, s):
+        self.buffer.append(s)
+        for end in self.chunker.feed_string(s):
+            self.chunks.append((self.position, end - self.position, md5sum(self.buffer[self.position:end])))
+            self.position = end
+        self.buffer.release(self.position)
+
+    def harvest(self):
+        end = self.buffer.virtual_size()
+        if self.position < end:
+            self.chunks.append((self.position, end - self.position, md5sum(self.buffer[self.position:end])))
+            self.position = end
+        result = self.chunks
+        self.chunks = []
+        return result
+
 if not dedup_available:
+    del ShardedBlocksDB
     del BlockChecksum
+    del ChunkChecksum
+
+class ChunksDB:
+    """The content defined chunking counterpart of BlocksDB. Chunks
+    have different sizes, so the size is stored with every chunk."""
+    def __init__(self, dbfile, avg_chunk_size):
+        try:
+            self.conn = sqlite3.connect(dbfile, check_same_thread = False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (md5 CHAR(32) NOT NULL, blob CHAR(32) NOT NULL, offset INT NOT NULL, size INT NOT NULL, PRIMARY KEY (blob, offset))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS index_chunk_md5 ON chunks (md5)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS props (name TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("INSERT OR IGNORE INTO props VALUES ('avg_chunk_size', ?)", (avg_chunk_size,))
+            self.conn.commit()
+            stored_size, = self.conn.execute("SELECT value FROM props WHERE name = 'avg_chunk_size'").fetchone()
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Chunks database is corrupt: %s" % e)
+        if int(stored_size) != avg_chunk_size:
+            raise SoftCorruptionError("Chunk size mismatch in chunks database: %s" % stored_size)
+        self.avg_chunk_size = avg_chunk_size
+        self.in_transaction = False
+
+    def __query(self, sql, args = ()):
+        try:
+            return self.conn.execute(sql, args).fetchall()
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Chunks database is corrupt: %s" % e)
+
+    def get_avg_chunk_size(self):
+        return self.avg_chunk_size
+
+    def get_chunk_locations(self, md5s):
+        """Returns a dict md5 -> (blob, offset, size) for those of the
+        given chunks that exist in the database. Only one location is
+        given for every chunk."""
+        result = {}
+        for md5 in md5s:
+            assert is_md5sum(md5)
+            rows = self.__query("SELECT blob, offset, size FROM chunks WHERE md5 = ? LIMIT 1", (md5,))
+            if rows:
+                blob, offset, size = rows[0]
+                result[md5] = (str(blob), offset, size)
+        return result
+
+    def add_chunk(self, blob, offset, size, md5):
+        assert self.in_transaction, "Tried to add a chunk outside of a transaction"
+        assert is_md5sum(blob) and is_md5sum(md5)
+        self.__query("INSERT OR IGNORE INTO chunks (md5, blob, offset, size) VALUES (?, ?, ?, ?)",
+                     (md5, blob, offset, size))
+
+    def delete_blocks(self, blobs):
+        """Removes all chunks of the given blobs."""
+        for blob in blobs:
+            self.__query("DELETE FROM chunks WHERE blob = ?", (blob,))
+
+    def begin(self):
+        assert not self.in_transaction, "Tried to start a transaction while one was already in progress"
+        self.in_transaction = True
+
+    def commit(self):
+        assert self.in_transaction, "Tried to do a commit while no transaction was in progress"
+        self.in_transaction = False
+        try:
+            self.conn.commit()
+        except sqlite3.DatabaseError, e:
+            raise SoftCorruptionError("Chunks database is corrupt: %s" % e)
+
+class TmpChunksDB:
+    """Adds the chunks of the blobs that are not yet committed to the
+    given chunks db. It may be shared by several threads."""
+    def __init__(self, chunksdb):
+        self.chunksdb = chunksdb
+        self.chunks = {} # md5 -> (blob, offset, size)
+        self.lock = threading.Lock()
+
+    def add_tmp_chunk(self, md5, blob, offset, size):
+        assert is_md5sum(md5)
+        assert is_md5sum(blob)
+        with self.lock:
+            if md5 not in self.chunks:
+                self.chunks[md5] = (blob, offset, size)
+
+    def get_avg_chunk_size(self):
+        return self.chunksdb.get_avg_chunk_size()
+
+    def get_chunk_locations(self, md5s):
+        with self.lock:
+            result = self.chunksdb.get_chunk_locations([md5 for md5 in md5s if md5 not in self.chunks])
+            for md5 in md5s:
+                if md5 in self.chunks:
+                    result[md5] = self.chunks[md5]
+            return result
 
 class UniformBlobGetter:
     def __init__(self, repo, local_blob_dir = None):
@@ -224,6 +687,9 @@ ORIGINAL_DATA_FOUND_EVENT = "ORIGINAL_EVENT"
 DEDUP_BLOCK_FOUND_EVENT = "DEDUP_BLOCK_FOUND_EVENT"
 EOF_EVENT = "EOF_EVENT"
 
+# The max number of candidate blocks that are looked up at once
+RECIPE_FINDER_BATCH_SIZE = 64
+
 class RecipeFinder(GenericStateMachine):
     def __init__(self, blocksdb, block_size, intset, blob_source, original_piece_handler, tmpdir = None,
                  RollingChecksumClass = None):
@@ -358,21 +824,15 @@ class RecipeFinder(GenericStateMachine):
         self.rs.feed_string(s)
         self.md5summer.update(s)
         self.tail_buffer.append(s)
-        for offset, rolling in self.rs:
-            if offset < self.end_of_last_hit:
-                # Ignore overlapping blocks
-                continue
-            block_data = self.tail_buffer[offset : offset + self.block_size]
-            md5 = md5sum(block_data)
-            self.end_of_last_hit >= 0
-            if self.blocksdb.has_block(md5):
-                assert self.end_of_last_hit >= 0
-                if offset - self.end_of_last_hit > 0:
-                    # If this hit is NOT a continuation of the last
-                    # one, there must be original data in between.
-                    #print "Gap found between block hits"
-                    self.dispatch(ORIGINAL_DATA_FOUND_EVENT, offset = self.end_of_last_hit)
-                self.dispatch(DEDUP_BLOCK_FOUND_EVENT, md5 = md5, offset = offset, block_data = block_data)
+        while True:
+            # Candidates that overlap a hit are never used, so they
+            # are not even reported. Data where almost every offset is
+            # a candidate, such as long runs of zeroes, would
+            # otherwise produce one candidate for every byte.
+            candidates, rollings = self.rs.find_candidates(RECIPE_FINDER_BATCH_SIZE, self.end_of_last_hit)
+            if not candidates:
+                break
+            self.__process_candidates(candidates)
 
         #print "State after feeding is", self.get_state()
         # We know here that all data, except the last block_size
@@ -390,6 +850,42 @@ class RecipeFinder(GenericStateMachine):
             self.dispatch(ORIGINAL_DATA_FOUND_EVENT, offset = self.feed_byte_count - self.block_size)
         #print "Half-time flush complete"
 
+    def __process_candidates(self, candidates):
+        looked_up = {} # offset -> (md5, found)
+        for index, offset in enumerate(candidates):
+            if offset < self.end_of_last_hit:
+                # Ignore overlapping blocks
+                continue
+            if offset not in looked_up:
+                self.__lookup_candidates(candidates, index, looked_up)
+            md5, found = looked_up[offset]
+            if found:
+                block_data = self.tail_buffer[offset : offset + self.block_size]
+                assert self.end_of_last_hit >= 0
+                if offset - self.end_of_last_hit > 0:
+                    # If this hit is NOT a continuation of the last
+                    # one, there must be original data in between.
+                    #print "Gap found between block hits"
+                    self.dispatch(ORIGINAL_DATA_FOUND_EVENT, offset = self.end_of_last_hit)
+                self.dispatch(DEDUP_BLOCK_FOUND_EVENT, md5 = md5, offset = offset, block_data = block_data)
+
+    def __lookup_candidates(self, candidates, start_index, looked_up):
+        """Looks up a batch of the candidate offsets, starting at the
+        given index, in the blocks db. The result is stored in the
+        looked_up dict. The batch is simply the next candidates in
+        order. A hit hides the candidates that overlap it, which is
+        resolved by the caller after the lookup. The md5 sums of the
+        hidden candidates are then calculated in vain, but that is
+        much cheaper than a lookup for every candidate on data where
+        most candidates are false ones."""
+        batch = []
+        for offset in candidates[start_index : start_index + RECIPE_FINDER_BATCH_SIZE]:
+            if offset not in looked_up:
+                batch.append((offset, md5sum(self.tail_buffer[offset : offset + self.block_size])))
+        found = self.blocksdb.has_blocks([md5 for offset, md5 in batch])
+        for offset, md5 in batch:
+            looked_up[offset] = (md5, md5 in found)
+
     def close(self):
         #print "Closing"
 
@@ -510,17 +1006,134 @@ class RecipeFinder(GenericStateMachine):
             self.__polish_recipe_repeats()
         return self.recipe
 
+class ChunkRecipeFinder:
+    """The content defined chunking counterpart of RecipeFinder. The
+    fed data is split into chunks, and every chunk that already exists
+    in the chunks db becomes a reference to that chunk in the
+    recipe. The remaining data is given to the piece handler, and the
+    resulting recipe has the same format as one from RecipeFinder."""
+    def __init__(self, chunksdb, original_piece_handler):
+        self.chunksdb = chunksdb
+        self.chunker = ContentChunker(chunksdb.get_avg_chunk_size())
+        self.original_piece_handler = original_piece_handler
+        self.md5summer = hashlib.md5()
+        self.feed_byte_count = 0
+        self.pending = [] # The data of the current, unfinished chunk
+        self.pieces = [] # For original pieces, the source is the piece index
+        self.piece_index = -1
+        self.in_original_piece = False
+        self.closed = False
+        self.recipe = None
+
+    def feed(self, s):
+        assert type(s) == str
+        assert not self.closed
+        chunks = []
+        pos = 0
+        for end in self.chunker.feed_string(s):
+            self.pending.append(s[pos : end - self.feed_byte_count])
+            chunks.append("".join(self.pending))
+            self.pending = []
+            pos = end - self.feed_byte_count
+        if pos < len(s):
+            self.pending.append(s[pos:])
+        self.feed_byte_count += len(s)
+        self.md5summer.update(s)
+        self.__add_chunks(chunks)
+
+    def __add_chunks(self, chunks):
+        md5s = [md5sum(chunk) for chunk in chunks]
+        locations = self.chunksdb.get_chunk_locations(md5s)
+        for chunk, md5 in zip(chunks, md5s):
+            if md5 in locations:
+                blob, offset, size = locations[md5]
+                assert size == len(chunk)
+                self.__add_dedup_chunk(blob, offset, size)
+            else:
+                self.__add_original_chunk(chunk)
+
+    def __add_original_chunk(self, chunk):
+        if not self.in_original_piece:
+            self.piece_index += 1
+            self.original_piece_handler.init_piece(self.piece_index)
+            self.pieces.append(self.__piece(self.piece_index, None, 0, True))
+            self.in_original_piece = True
+        self.original_piece_handler.add_piece_data(self.piece_index, chunk)
+        self.pieces[-1]['size'] += len(chunk)
+
+    def __add_dedup_chunk(self, blob, offset, size):
+        self.__end_original_piece()
+        last = self.pieces[-1] if self.pieces else None
+        if last and not last['original'] and last['source'] == blob:
+            if (last['offset'], last['size']) == (offset, size):
+                last['repeat'] += 1
+                return
+            if last['repeat'] == 1 and last['offset'] + last['size'] == offset:
+                last['size'] += size
+                return
+        self.pieces.append(self.__piece(blob, offset, size, False))
+
+    def __end_original_piece(self):
+        if self.in_original_piece:
+            self.original_piece_handler.end_piece(self.piece_index)
+            self.in_original_piece = False
+
+    def __piece(self, source, offset, size, original):
+        return OrderedDict([("source", source),
+                            ("offset", offset),
+                            ("size", size),
+                            ("original", original),
+                            ("repeat", 1)])
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+        if self.pending:
+            self.__add_chunks(["".join(self.pending)])
+            self.pending = []
+        if not self.pieces:
+            # An empty blob still needs a piece
+            self.__add_original_chunk("")
+        self.__end_original_piece()
+        self.original_piece_handler.close()
+        for piece in self.pieces:
+            if piece['original']:
+                piece['source'], piece['offset'] = self.original_piece_handler.get_piece_address(piece['source'])
+        restored_size = sum([piece['size'] * piece['repeat'] for piece in self.pieces])
+        assert restored_size == self.feed_byte_count, "Restored is %s, feeded is %s" % (restored_size, self.feed_byte_count)
+
+    def get_recipe(self):
+        assert self.closed
+        if self.recipe == None:
+            self.recipe = OrderedDict([("md5sum", self.md5summer.hexdigest()),
+                                       ("size", self.feed_byte_count),
+                                       ("method", "concat"),
+                                       ("pieces", self.pieces)])
+        return self.recipe
+
+# The max number of locations of the first block in a sequence that
+# are tried as the start of the sequence. Some blocks, such as blocks
+# of zeroes, may exist at a huge number of locations.
+BLOCK_SEQUENCE_MAX_CANDIDATES = 100
+
 class BlockSequenceFinder:
+    """Finds locations where a sequence of blocks exists in the same
+    order. Blocks are added one at a time, as long as at least one of
+    the candidate locations continues with the added block. For every
+    new block, the blocks db is asked which of the candidates are
+    followed by it, so the number of lookups does not depend on how
+    common the blocks are."""
     def __init__(self, blocksdb):
         self.blocksdb = blocksdb
 
         # The candidates are tuples on the form (blob, offset), where
         # offset is the end of the last matched block.
-        self.candidates = set()
+        self.candidates = []
         self.feeded_blocks = 0
 
         self.firstblock = True
         self.block_size = blocksdb.get_block_size()
+        self.extended = None # (md5, candidates) from the last can_add()
 
     def get_matches(self):
         length = self.block_size * self.feeded_blocks
@@ -535,24 +1148,25 @@ class BlockSequenceFinder:
             yield blob, start_pos, length
 
     def can_add(self, block_md5):
-        return self.firstblock or bool(self.__filter_and_extend_candidates(block_md5))
+        return self.firstblock or bool(self.__extend_candidates(block_md5))
 
-    def __filter_and_extend_candidates(self, block_md5):
+    def __extend_candidates(self, block_md5):
         """ Returns the candidates that can be extended with the given block."""
-        surviving_candidates = set()
-        for block in self.candidates.intersection(set(self.blocksdb.get_block_locations(block_md5))):
-            blob, offset = block
-            surviving_candidates.add((blob, offset + self.block_size))
-        return surviving_candidates
+        if self.extended == None or self.extended[0] != block_md5:
+            found = self.blocksdb.find_block_at(block_md5, self.candidates)
+            self.extended = block_md5, [(blob, offset + self.block_size) for blob, offset in found]
+        return self.extended[1]
 
     def add_block(self, block_md5):
         self.feeded_blocks += 1
         if self.firstblock:
             self.firstblock = False
-            for blob, offset in self.blocksdb.get_block_locations(block_md5):
-                self.candidates.add((blob, offset + self.block_size))
+            locations = self.blocksdb.get_block_locations(block_md5, limit = BLOCK_SEQUENCE_MAX_CANDIDATES)
+            self.candidates = [(blob, offset + self.block_size)
+                               for blob, offset in locations[:BLOCK_SEQUENCE_MAX_CANDIDATES]]
         else:
-            self.candidates = self.__filter_and_extend_candidates(block_md5)
+            self.candidates = self.__extend_candidates(block_md5)
+        self.extended = None
         assert self.candidates, "No remaining candidates"
         #print "Candidates are", list(self.get_matches())
 
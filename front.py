@@ -24,10 +24,12 @@ implement an RPC mechanism for this interface.
 from blobrepo import repository
 from boar_exceptions import *
 import sys
+import multiprocessing
 from time import ctime, time
 from common import md5sum, is_md5sum, warn, get_json_module, StopWatch, calculate_progress
 from boar_common import SimpleProgressPrinter
 from blobrepo.sessions import bloblist_fingerprint
+from jsonrpc import pipelined
 import copy
 
 json = get_json_module()
@@ -162,19 +164,25 @@ def __clone_single_snapshot(from_front, to_front, session_id):
     """ This function requires that a new snapshot is underway in
     to_front. It does not commit that snapshot. """
     assert from_front != to_front
+    # Calls without a return value don't need to wait for the server
+    pipelined_to_front = pipelined(to_front)
     other_bloblist = from_front.get_session_bloblist(session_id)
     other_raw_bloblist = from_front.get_session_raw_bloblist(session_id)
+    # Find out which blobs must be sent with a single call
+    wanted_blobs = set([blobinfo['md5sum'] for blobinfo in other_raw_bloblist
+                        if not blobinfo.get("action", None)])
+    missing_blobs = set(to_front.has_blobs(list(wanted_blobs)))
     for n, blobinfo in enumerate(other_raw_bloblist):
         action = blobinfo.get("action", None)
         if not action:
             md5sum = blobinfo['md5sum']
-            if not (to_front.has_blob(md5sum) or to_front.new_snapshot_has_blob(md5sum)):
+            if md5sum in missing_blobs:
                 pp = SimpleProgressPrinter(sys.stdout,
                                            label="Sending blob %s of %s (%s MB)" %
                                            (n+1, len(other_raw_bloblist),
                                             round(blobinfo['size'] / (1.0 * 2**20), 3)))
                 sw = StopWatch(enabled=False, name="front.clone")
-                to_front.init_new_blob(md5sum, blobinfo['size'])
+                pipelined_to_front.init_new_blob(md5sum, blobinfo['size'])
                 sw.mark("front.init_new_blob()")
                 datasource = from_front.get_blob(md5sum)
                 pp.update(0.0)
@@ -183,11 +191,12 @@ def __clone_single_snapshot(from_front, to_front, session_id):
                                                 datasource = datasource)
                 pp.finished()
                 sw.mark("front.add_blob_data_streamed()")
-                to_front.blob_finished(md5sum)
+                pipelined_to_front.blob_finished(md5sum)
                 sw.mark("front.finished()")
-            to_front.add(blobinfo)
+                missing_blobs.discard(md5sum)
+            pipelined_to_front.add(blobinfo)
         elif action == "remove":
-            to_front.remove(blobinfo['filename'])
+            pipelined_to_front.remove(blobinfo['filename'])
         else:
             assert False, "Unexpected blobinfo action: " + str(action)
 
@@ -217,9 +226,13 @@ def is_continuation(base_front, cont_front):
             return False
     return True
 
-def verify_repo(front, verify_blobs = True, verbose = False):
+def verify_repo(front, verify_blobs = True, verbose = False, jobs = 1, since = None, budget = None):
     """Returns True if the repo was clean. Otherwise throws an
-    exception."""
+    exception. The 'jobs' argument gives the number of processes that
+    will be used to verify the blobs. If 'since' is given, blobs that
+    have been verified within that many seconds are skipped. If
+    'budget' is given, blob verification stops after that many
+    seconds. See Front.init_verify_blobs()."""
     for rev in range(1, front.repo_get_highest_used_revision() + 1):
         front.repo_verify_snapshot(rev)
     session_ids = front.get_session_ids()
@@ -227,11 +240,11 @@ def verify_repo(front, verify_blobs = True, verbose = False):
     existing_blobs = set(front.get_all_raw_blobs()) | set(front.get_all_recipes())
     for i in range(0, len(session_ids)):
         id = session_ids[i]
-        bloblist = front.get_session_bloblist(id) # We must not use a
-                                                  # cached bloblist
-                                                  # here - we're
-                                                  # verifying the
-                                                  # repo!
+        bloblist = front.get_session_bloblist(id, False) # We must not use a
+                                                         # cached bloblist
+                                                         # here - we're
+                                                         # verifying the
+                                                         # repo!
         calc_fingerprint = bloblist_fingerprint(bloblist)
         if calc_fingerprint != front.get_session_fingerprint(id):
             raise CorruptionError("Fingerprint didn't match for snapshot %s" % id)
@@ -243,47 +256,64 @@ def verify_repo(front, verify_blobs = True, verbose = False):
         if verbose: print "Skipping blob verification"
         return True
     if verbose: print "Collecting a list of all blobs..."
-    count = front.init_verify_blobs()
-    if verbose: print "Verifying %s blobs..." % (count)
+    count = front.init_verify_blobs(jobs, since, budget)
+    pp = None
+    if verbose:
+        pp = SimpleProgressPrinter(sys.stdout, label="Verifying %s blobs" % count)
     done = 0
     while done < count:
-        done += len(front.verify_some_blobs())
-        if verbose: print done, "of "+str(count)+" blobs verified, "+ \
-            str(round(1.0*done/count * 100,1)) + "% done."
+        verified = front.verify_some_blobs()
+        if not verified:
+            break
+        done += len(verified)
+        if pp: pp.update(1.0 * done / count)
+    if pp: pp.finished()
+    if verbose and done < count:
+        print "Time budget exhausted. %s of %s blobs verified." % (done, count)
+    if since == None and budget == None:
+        # Only a full verification is worth the directory walk
+        if verbose: print "Checking blob catalog"
+        problems = front.repo_check_blob_catalog()
+        if problems:
+            raise SoftCorruptionError("Blob catalog does not match the repository (%s)" % problems[0])
     return True
 
+# The repo used by the verification worker processes. It is
+# inherited from the parent process on platforms with fork().
+_verify_worker_repo = None
+
+def _init_verify_worker(repopath):
+    global _verify_worker_repo
+    if _verify_worker_repo == None:
+        _verify_worker_repo = repository.Repo(repopath)
+
+def _verify_blob_worker(blob):
+    return blob, _verify_worker_repo.verify_blob(blob)
+
 
 class Front:
     def __init__(self, repo):
         self.repo = repo
         self.new_session = None
         self.blobs_to_verify = []
+        self.verify_blob_stats = {}
+        self.verify_deadline = None
+        self.verify_pool = None
         self.loadstats = {}
 
     def allows_permanent_erase(self):
         return self.repo.allows_permanent_erase()
 
     def get_session_ids(self, session_name = None):
-        sids = self.repo.get_all_sessions()
         if not session_name:
-            return sids
-        result = []
-        for sid in sids:
-            session_info = self.get_session_info(sid)
-            name = session_info.get("name")
-            if name == session_name:
-                result.append(sid)
-        return result
+            return self.repo.get_all_sessions()
+        return self.repo.get_session_revisions(session_name)
 
     def get_session_names(self, include_meta = False):
-        sessions_count = {}
-        for sid in self.get_session_ids():
-            session_info = self.get_session_info(sid)
-            name = session_info.get("name", "<no name>")
-            if not include_meta and name.startswith("__"):
-                continue
-            sessions_count[name] = sessions_count.get(name, 0) + 1
-        return sessions_count.keys()
+        names = self.repo.get_session_names()
+        if not include_meta:
+            names = [name for name in names if not name.startswith("__")]
+        return names
 
     def get_deleted_snapshots(self):
         return self.repo.get_deleted_snapshots()
@@ -377,9 +407,9 @@ class Front:
         assert "fingerprint" in properties
         return properties["fingerprint"]
 
-    def get_session_bloblist(self, id):
+    def get_session_bloblist(self, id, use_cache = True):
         session_reader = self.repo.get_session(id)
-        bloblist = list(session_reader.get_all_blob_infos())
+        bloblist = list(session_reader.get_all_blob_infos(use_cache = use_cache))
         seen = set()
         for b in bloblist:
             assert b['filename'] not in seen, "Duplicate file found in bloblist - internal error"
@@ -400,6 +430,9 @@ class Front:
     def get_stats(self):
         return self.repo.get_stats()
 
+    def get_session_stats(self):
+        return self.repo.get_session_stats()
+
     def create_session(self, session_name, base_session = None, force_base_snapshot = False):
         """Creates a new snapshot for the given session. Commit() must
         be called when the construction of the new snapshot is
@@ -575,6 +608,17 @@ class Front:
     def has_blob(self, sum):
         return self.repo.has_blob(sum)
 
+    def has_blobs(self, sums):
+        """ Returns a list of the given checksums that there is no
+        blob for, neither in the repository nor in the new snapshot,
+        if one is underway. This is a bulk version of has_blob() and
+        new_snapshot_has_blob(), so that a client can find all blobs
+        it must send in a single call. """
+        missing = self.repo.get_missing_blobs(sums)
+        if self.new_session:
+            missing = [sum for sum in missing if not self.new_session.has_blob(sum)]
+        return list(missing)
+
     def get_all_blobs(self):
         """ Returns a list of all blobs (raw or recipes) in the
         repository. This method is deprecated. Use get_all_raw_blobs()
@@ -596,32 +640,111 @@ class Front:
         session. Returns None if there is no such session. """
         return self.repo.find_last_revision(session_name)
 
-    def init_verify_blobs(self):
+    def init_verify_blobs(self, jobs = 1, since = None, budget = None):
+        """Prepares for verification of all blobs in the repo by
+        calling verify_some_blobs() until all blobs are done. If jobs
+        is more than 1, the blobs will be verified by that many worker
+        processes. Blobs are verified in the order of how long ago
+        they were last verified. If 'since' is given, blobs that have
+        been verified within that many seconds are skipped. If
+        'budget' is given, verify_some_blobs() will stop handing out
+        blobs after that many seconds. Returns the number of blobs to
+        verify."""
+        global _verify_worker_repo
         assert self.blobs_to_verify == []
-        self.blobs_to_verify = self.repo.get_raw_blob_names() + self.repo.get_recipe_names()
+        if jobs < 1:
+            raise UserError("The number of jobs must be at least 1")
+        assert since == None or since >= 0
+        assert budget == None or budget >= 0
+        now = int(time())
+        ledger = self.repo.get_verify_ledger()
+        ledger_entries = ledger.get_all()
+        self.verify_blob_stats = {}
+        last_verified = {}
+        for blob in self.repo.get_raw_blob_names() + self.repo.get_recipe_names():
+            try:
+                self.verify_blob_stats[blob] = self.repo.get_blob_file_stat(blob)
+            except OSError:
+                raise CorruptionError("Blob is missing: " + blob)
+            last_verified[blob] = 0
+            if blob in ledger_entries:
+                verified_time, size, mtime = ledger_entries[blob]
+                if (size, mtime) == self.verify_blob_stats[blob]:
+                    last_verified[blob] = verified_time
+        blobs = last_verified.keys()
+        if since != None:
+            blobs = [blob for blob in blobs if last_verified[blob] < now - since]
+        # Stalest blobs first, otherwise in disk order (sort is stable)
+        blobs = self.repo.sort_blobs_by_location(blobs)
+        blobs.sort(key = lambda blob: last_verified[blob])
+        self.blobs_to_verify = blobs
+        self.blobs_to_verify.reverse() # We pop() blobs from the end
+        self.verify_deadline = None
+        if budget != None:
+            self.verify_deadline = time() + budget
         for scanner in self.repo.scanners:
             scanner.scan_init()
+        if jobs > 1 and self.blobs_to_verify:
+            _verify_worker_repo = self.repo
+            self.verify_pool = multiprocessing.Pool(jobs, _init_verify_worker, (self.repo.get_repo_path(),))
+            self.verify_pool_size = jobs
         return len(self.blobs_to_verify)
 
     def verify_some_blobs(self):
+        """Verifies a batch of blobs and returns a list of the
+        verified blobs. Returns an empty list when there are no more
+        blobs to verify, or the time budget is exhausted."""
         succeeded = []
-        count = min(100, len(self.blobs_to_verify))
-        for i in range(0, count):
-            blob_to_verify = self.blobs_to_verify.pop()
-            if not self.repo.verify_blob(blob_to_verify):
-                raise CorruptionError("Blob corrupted: " + blob_to_verify)
-            succeeded.append(blob_to_verify)
+        if self.verify_deadline != None and time() > self.verify_deadline:
+            self.blobs_to_verify = []
+        if self.verify_pool:
+            count = min(100 * self.verify_pool_size, len(self.blobs_to_verify))
+        else:
+            count = min(100, len(self.blobs_to_verify))
+        blobs = [self.blobs_to_verify.pop() for i in range(0, count)]
+        if self.verify_pool:
+            results = self.verify_pool.imap(_verify_blob_worker, blobs)
+        else:
+            results = ((blob, self.repo.verify_blob(blob)) for blob in blobs)
+        try:
+            for blob, verified_ok in results:
+                if not verified_ok:
+                    raise CorruptionError("Blob corrupted: " + blob)
+                succeeded.append(blob)
+        except:
+            self.__close_verify_pool(terminate = True)
+            raise
+        verified_time = int(time())
+        self.repo.get_verify_ledger().mark_verified(
+            [(blob, verified_time) + self.verify_blob_stats[blob] for blob in succeeded])
         if not self.blobs_to_verify:
+            self.__close_verify_pool()
             for scanner in self.repo.scanners:
                 scanner.scan_finish()
         return succeeded
 
+    def __close_verify_pool(self, terminate = False):
+        if not self.verify_pool:
+            return
+        if terminate:
+            self.verify_pool.terminate()
+        else:
+            self.verify_pool.close()
+        self.verify_pool.join()
+        self.verify_pool = None
+
     def repo_get_highest_used_revision(self):
         return self.repo.get_highest_used_revision()
 
     def repo_verify_snapshot(self, rev):
         return self.repo.verify_snapshot(rev)
 
+    def repo_check_blob_catalog(self):
+        return self.repo.check_blob_catalog()
+
+    def repo_check_blob_refcounts(self):
+        return self.repo.check_blob_refcounts()
+
     def acquire_repo_lock(self):
         self.repo.repo_mutex.lock()
 
@@ -645,8 +768,8 @@ class DryRunFront:
     def get_session_info(self, id):
         return self.realfront.get_session_properties(id)['client_data']
 
-    def get_session_bloblist(self, id):
-        return self.realfront.get_session_bloblist(id)
+    def get_session_bloblist(self, id, use_cache = True):
+        return self.realfront.get_session_bloblist(id, use_cache)
 
     def create_session(self, session_name, base_session = None, force_base_snapshot = False):
         pass
@@ -685,6 +808,9 @@ class DryRunFront:
     def has_blob(self, sum):
         return self.realfront.has_blob(sum)
 
+    def has_blobs(self, sums):
+        return self.realfront.has_blobs(sums)
+
     def new_snapshot_has_blob(self, sum):
         return False
 
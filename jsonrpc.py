@@ -336,6 +336,33 @@ class JsonRpc20:
             data = json.loads(string)
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
+        return JsonRpc20.parse_response(data, allowed_exceptions)
+
+    @staticmethod
+    def loads_batch_response( string, allowed_exceptions, request_count ):
+        """de-serialize the response to a batch of requests. The
+        responses are checked in order, and the first error found is
+        raised.
+
+        :Returns: | a list of the results
+        :Raises:  | see loads_response()
+        """
+        try:
+            data = json.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+        if not isinstance(data, list):
+            # The server could not even parse the batch
+            JsonRpc20.parse_response(data, allowed_exceptions)
+            raise RPCInvalidRPC("Invalid batch response, not a list.")
+        results = [JsonRpc20.parse_response(item, allowed_exceptions)[0] for item in data]
+        if len(results) != request_count:
+            raise RPCInvalidRPC("Invalid batch response, expected %s responses, got %s." % (request_count, len(results)))
+        return results
+
+    @staticmethod
+    def parse_response( data, allowed_exceptions ):
+        """Check a de-serialized JSON-RPC Response/error. See loads_response()."""
         if not isinstance(data, dict):  raise RPCInvalidRPC("No valid RPC-package.")
         if "jsonrpc" not in data:       raise RPCInvalidRPC("""Invalid Response, "jsonrpc" missing.""")
         if not isinstance(data["jsonrpc"], (str, unicode)):
@@ -438,7 +465,7 @@ def log_filedate( filename ):
 
 HEADER_SIZE=22
 HEADER_MAGIC=0x626f6172 # "boar"
-HEADER_VERSION=6
+HEADER_VERSION=7 # Version 7 adds batch requests
 
 def pack_header(payload_size, has_binary_payload = False, binary_payload_size = 0L, progress_packet = False):
     assert binary_payload_size >= 0
@@ -491,6 +518,7 @@ class BoarMessageClient:
         self.s_out = s_out
         self.call_count = 0
         self.progress_callback = lambda x: None
+        self.outstanding_responses = 0
 
     def set_progress_callback(self, cb):
         self.progress_callback = cb
@@ -505,7 +533,10 @@ class BoarMessageClient:
     def __repr__(self):
         return "<JsonrpcClient, %s, %s>" % (self.s_in, self.s_out)
 
-    def __send( self, string, datasource = None ):
+    def send( self, string, datasource = None ):
+        """Sends a message. The response must be fetched with recv()
+        before any further messages can be received. Several messages
+        may be sent before the responses are fetched."""
         #print "CLIENT sending", string, datasource
         bin_length = 0
         if datasource:
@@ -515,7 +546,7 @@ class BoarMessageClient:
         self.s_out.write(string)
         if datasource:
             while datasource.bytes_left() > 0:
-                if os.name == "posix":
+                if os.name == "posix" and not self.outstanding_responses:
                     # Select() only works for sockets on windows, but
                     # this assert will let us discover protocol errors
                     # on linux at least, which is quite useful.
@@ -523,8 +554,12 @@ class BoarMessageClient:
                     assert not incoming_data, "No incoming data allowed during send"
                 self.s_out.write(datasource.read(2**14))
         self.s_out.flush()
+        self.outstanding_responses += 1
 
-    def __recv( self ):
+    def recv( self ):
+        """Receives the response to the oldest message that has not yet
+        been responded to."""
+        assert self.outstanding_responses > 0
         while True:
             datasize, binary_data_size, is_progress_packet = read_header(self.s_in)
             data = self.s_in.read(datasize)
@@ -533,6 +568,7 @@ class BoarMessageClient:
             f = json.loads(data)
             self.progress_callback(f)
 
+        self.outstanding_responses -= 1
         if binary_data_size != None:
             return data, StreamDataSource(self.s_in, binary_data_size)
         else:
@@ -540,8 +576,8 @@ class BoarMessageClient:
 
     def sendrecv( self, string, data_source = None ):
         """send data + receive data + close"""
-        self.__send( string, data_source )
-        return self.__recv()
+        self.send( string, data_source )
+        return self.recv()
 
 
 class BoarMessageServer:
@@ -637,12 +673,21 @@ class BoarMessageServer:
 #=========================================
 # client side: server proxy
 
+# Pipelined calls are sent in batches of at most this many calls
+MAX_BATCH_SIZE = 100
+# The number of batches that may be sent before their responses are
+# read. The responses must fit in the transport buffers, or the
+# server will block.
+MAX_PENDING_BATCHES = 4
+
 class ServerProxy:
     """RPC-client: server proxy
 
     A logical connection to a RPC server.
 
-    Notifications and id-handling/multicall are not yet implemented.
+    Notifications and id-handling are not yet implemented. Calls
+    made through a pipelined() object are sent as batches, without
+    waiting for the response.
 
     :Example:
         see module-docstring
@@ -664,6 +709,8 @@ class ServerProxy:
         self.active_upload_datasource = None
         self.active_download_datasource = None
         self.caller_progress_callback = None
+        self.__batch = [] # Request strings of pipelined calls that are not yet sent
+        self.__pending_batches = [] # The number of calls in each sent batch that awaits a response
 
     def __progress_callback(self, f):
         if self.caller_progress_callback:
@@ -674,9 +721,7 @@ class ServerProxy:
     def __repr__(self):
         return "<ServerProxy for %s>" % (self.__transport)
 
-    def __req( self, methodname, args=None, kwargs=None, id=0, progress_callback=None):
-        # JSON-RPC 2.0: only args OR kwargs allowed!
-
+    def __check_no_active_datasources(self):
         if self.active_upload_datasource:
             assert self.active_upload_datasource.bytes_left() == 0, \
                 "Client tried to make a RPC call during data upload."
@@ -684,25 +729,84 @@ class ServerProxy:
             assert self.active_download_datasource.bytes_left() == 0, \
                 "Client tried to make a RPC call during data download."
 
-        datasource = kwargs.get("datasource", None)
-
-        if datasource:
-            assert isinstance(datasource, DataSource)
-            self.active_upload_datasource = datasource
-            del kwargs["datasource"]
+    def __dumps_request(self, methodname, args, kwargs, id):
+        # JSON-RPC 2.0: only args OR kwargs allowed!
         for arg in args:
             assert not isinstance(arg, DataSource), "DataSource must be a keyword argument"
-
         if len(args) > 0 and len(kwargs) > 0:
             raise ValueError("Only positional or named parameters are allowed!")
         if len(kwargs) == 0:
-            req_str  = JsonRpc20.dumps_request( methodname, args, id )
+            return JsonRpc20.dumps_request( methodname, args, id )
         else:
-            req_str  = JsonRpc20.dumps_request( methodname, kwargs, id )
+            return JsonRpc20.dumps_request( methodname, kwargs, id )
+
+    def __send(self, string, datasource = None):
+        """Sends a message. If the server has hung up because a
+        pipelined call failed, the error of that call is raised
+        instead of the broken connection."""
+        try:
+            self.__transport.send(string, datasource)
+        except EnvironmentError:
+            exc_info = sys.exc_info()
+            while self.__pending_batches:
+                self.__recv_batch()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def __send_batch(self):
+        if not self.__batch:
+            return
+        self.__send("[" + ",".join(self.__batch) + "]")
+        self.__pending_batches.append(len(self.__batch))
+        self.__batch = []
+
+    def __recv_batch(self):
+        """Reads the response to the oldest pending batch. Raises the
+        first error in the batch, if any."""
+        request_count = self.__pending_batches.pop(0)
+        resp_str, result_data_source = self.__transport.recv()
+        assert not result_data_source, "Pipelined calls must not return data"
+        JsonRpc20.loads_batch_response( resp_str, self.allowed_exceptions, request_count )
+
+    def __flush_pipelined(self):
+        """Sends any queued pipelined calls, and reads the responses
+        to all sent batches. Raises the first error, if any."""
+        self.__send_batch()
+        while self.__pending_batches:
+            self.__recv_batch()
+
+    def __pipelined_req( self, methodname, args=None, kwargs=None, id=0, progress_callback=None):
+        assert not progress_callback, "Pipelined calls can not report progress"
+        assert "datasource" not in kwargs, "Pipelined calls can not send data"
+        self.__check_no_active_datasources()
+        self.__batch.append(self.__dumps_request(methodname, args, kwargs, id))
+        if len(self.__batch) >= MAX_BATCH_SIZE:
+            self.__send_batch()
+            if len(self.__pending_batches) > MAX_PENDING_BATCHES:
+                self.__recv_batch()
+
+    def __req( self, methodname, args=None, kwargs=None, id=0, progress_callback=None):
+        self.__check_no_active_datasources()
+        datasource = kwargs.get("datasource", None)
+
+        if datasource:
+            assert isinstance(datasource, DataSource)
+            # A failed pipelined call makes the server hang up. Its
+            # error must be read before the upload starts, or the
+            # upload will only fail with a broken pipe.
+            self.__flush_pipelined()
+            self.active_upload_datasource = datasource
+            del kwargs["datasource"]
+        req_str = self.__dumps_request(methodname, args, kwargs, id)
 
         try:
             self.caller_progress_callback = progress_callback
-            resp_str, result_data_source = self.__transport.sendrecv( req_str, datasource)
+            # Any pipelined calls are sent first. Their responses will
+            # arrive before the response to this call.
+            self.__send_batch()
+            self.__send( req_str, datasource )
+            while self.__pending_batches:
+                self.__recv_batch()
+            resp_str, result_data_source = self.__transport.recv()
         finally:
             self.caller_progress_callback = None
         if result_data_source:
@@ -715,7 +819,22 @@ class ServerProxy:
         # magic method dispatcher
         #  note: to call a remote object with an non-standard name, use
         #  result getattr(my_server_proxy, "strange-python-name")(args)
-        return _method(self.__req, name)
+        return _method(self.__req, name, self.__pipelined_req)
+
+def pipelined(obj):
+    """Returns a pipelined version of the given remote object. Calls
+    to the pipelined object are queued and sent to the server in
+    batches, without waiting for the results. The calls always return
+    None. An error in a pipelined call is raised by the next ordinary
+    call to the same server. An ordinary call that sends streamed data
+    waits for the responses to all pipelined calls before the data is
+    sent. Pipelined calls can not send or receive
+    streamed data. Objects that are not remote objects are returned
+    unchanged, so that the same code can be used for local and remote
+    objects."""
+    if not isinstance(obj, _method):
+        return obj
+    return obj._method__as_pipelined()
 
 # request dispatcher
 class _method:
@@ -725,15 +844,19 @@ class _method:
 
     :Raises: AttributeError for method-names/attributes beginning with '_'.
     """
-    def __init__(self, req, name):
+    def __init__(self, req, name, pipelined_req = None):
         if name[0] == "_":  #prevent rpc-calls for proxy._*-functions
             raise AttributeError("invalid attribute '%s'" % name)
         self.__req  = req
         self.__name = name
+        self.__pipelined_req = pipelined_req
+    def __as_pipelined(self):
+        assert self.__pipelined_req
+        return _method(self.__pipelined_req, self.__name)
     def __getattr__(self, name):
         if name[0] == "_":  #prevent rpc-calls for proxy._*-functions
             raise AttributeError("invalid attribute '%s'" % name)
-        return _method(self.__req, "%s.%s" % (self.__name, name))
+        return _method(self.__req, "%s.%s" % (self.__name, name), self.__pipelined_req)
     def __call__(self, *args, **kwargs):
         cb = None
         if "progress_callback" in kwargs:
@@ -811,6 +934,8 @@ class RpcHandler:
         """
         #TODO: id
         assert not self.dead, "An exception has already killed the server - go away"
+        if rpcstr.startswith("["):
+            return self.__handle_batch(rpcstr, incoming_data_source, progress_callback)
         try:
             req = JsonRpc20.loads_request( rpcstr )
             if len(req) == 2:
@@ -859,5 +984,29 @@ class RpcHandler:
             self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return JsonRpc20.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id )
 
+    def __handle_batch(self, rpcstr, incoming_data_source, progress_callback):
+        """Handle a batch of RPC-Requests. The requests are handled in
+        order, until one of them fails.
 
-
+        :Returns: a JSON list of the responses
+        """
+        try:
+            requests = json.loads(rpcstr)
+            if incoming_data_source:
+                raise RPCInvalidRPC("Batch requests can not contain streamed data.")
+        except ValueError, err:
+            self.dead = True
+            return JsonRpc20.dumps_error( RPCParseError("No valid JSON. (%s)" % str(err)), id=None )
+        except RPCFault, err:
+            self.dead = True
+            return JsonRpc20.dumps_error( err, id=None )
+        responses = []
+        for request in requests:
+            response = self.handle(json.dumps(request), None, progress_callback)
+            if isinstance(response, DataSource):
+                self.dead = True
+                response = JsonRpc20.dumps_error( RPCInvalidRPC("Batch requests can not return streamed data."), id=None )
+            responses.append(response)
+            if self.dead:
+                break
+        return "[" + ",".join(responses) + "]"
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares deduplication with fixed size blocks to deduplication
+with content defined chunks. A file of random data is committed,
+followed by a number of edited versions of it, where some bytes have
+been inserted, deleted or overwritten. For every method, the
+throughput of the commits and the amount of data that had to be
+stored is printed.
+
+Usage: benchmark-cdc.py [size in MB] [number of versions] [edits per version]
+"""
+
+from __future__ import with_statement
+import sys
+import os
+import time
+import random
+import hashlib
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo import repository
+from common import md5sum, tounicode
+
+def random_data(size, seed):
+    parts = []
+    for n in range(0, size / 16 + 1):
+        parts.append(hashlib.md5("%s:%s" % (seed, n)).digest())
+    return "".join(parts)[:size]
+
+def edit(data, edits, rnd):
+    for n in range(0, edits):
+        pos = rnd.randrange(len(data))
+        kind = rnd.choice(("insert", "delete", "overwrite"))
+        length = rnd.randrange(1, 100)
+        if kind == "insert":
+            data = data[:pos] + random_data(length, rnd.random()) + data[pos:]
+        elif kind == "delete":
+            data = data[:pos] + data[pos + length:]
+        else:
+            data = data[:pos] + random_data(length, rnd.random()) + data[pos + length:]
+    return data
+
+def commit(repo, session_name, data):
+    blob = md5sum(data)
+    writer = repo.create_snapshot(session_name)
+    writer.init_new_blob(blob, len(data))
+    for pos in range(0, len(data), 2**20):
+        writer.add_blob_data(blob, data[pos:pos + 2**20])
+    writer.blob_finished(blob)
+    writer.add({"filename": u"file.bin", "md5sum": blob})
+    writer.commit({"name": session_name})
+
+def run(dedup_method, versions):
+    repopath = tounicode(tempfile.mktemp(prefix = "boar_benchmark_cdc_"))
+    try:
+        repository.create_repository(repopath, enable_deduplication = True, dedup_method = dedup_method)
+        repo = repository.Repo(repopath)
+        times = []
+        for n, data in enumerate(versions):
+            t0 = time.time()
+            commit(repo, u"Version%s" % n, data)
+            times.append(time.time() - t0)
+        stats = dict(repo.get_stats())
+        first_mbps = len(versions[0]) / 2.0**20 / times[0]
+        rest_mbps = sum([len(data) for data in versions[1:]]) / 2.0**20 / max(sum(times[1:]), 0.001)
+        print "%-6s  first commit %6.1f MB/s  later commits %6.1f MB/s  stored %8.1f MB of %8.1f MB (%s%% removed)" % \
+            (dedup_method, first_mbps, rest_mbps, stats['actual_size'] / 2.0**20,
+             stats['virtual_size'] / 2.0**20, stats['dedup_removed_percentage'])
+    finally:
+        shutil.rmtree(repopath, ignore_errors = True)
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    size_mb, version_count, edits = (args + [32, 5, 20][len(args):])[:3]
+    rnd = random.Random(0)
+    versions = [random_data(size_mb * 2**20, "base")]
+    for n in range(1, version_count):
+        versions.append(edit(versions[-1], edits, rnd))
+    print "%s versions of %s MB, %s edits per version" % (version_count, size_mb, edits)
+    for dedup_method in (repository.DEDUP_METHOD_FIXED, repository.DEDUP_METHOD_CDC):
+        run(dedup_method, versions)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Regression benchmark for deduplication of data with very common
+blocks. A mostly zero-filled disk image is committed, followed by a
+number of versions where some files have been written to the free
+space of the image. Every block of zeroes exists at a huge number of
+locations in the repository, which used to make the commits of the
+later versions quadratic in the size of the image. The time of every
+commit is printed.
+
+Usage: benchmark-zeroes.py [image size in MB] [number of versions]
+"""
+
+from __future__ import with_statement
+import sys
+import os
+import time
+import random
+import hashlib
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo import repository
+from common import md5sum, tounicode
+
+def random_data(size, seed):
+    parts = []
+    for n in range(0, size / 16 + 1):
+        parts.append(hashlib.md5("%s:%s" % (seed, n)).digest())
+    return "".join(parts)[:size]
+
+def write_files(image, file_count, rnd):
+    """Writes some random files at random sector aligned positions
+    in the image."""
+    for n in range(0, file_count):
+        size = rnd.randrange(1, 2**20)
+        pos = rnd.randrange(0, (len(image) - size) / 512) * 512
+        image = image[:pos] + random_data(size, rnd.random()) + image[pos + size:]
+    return image
+
+def commit(repo, session_name, data):
+    blob = md5sum(data)
+    writer = repo.create_snapshot(session_name)
+    writer.init_new_blob(blob, len(data))
+    for pos in range(0, len(data), 2**20):
+        writer.add_blob_data(blob, data[pos:pos + 2**20])
+    writer.blob_finished(blob)
+    writer.add({"filename": u"disk.img", "md5sum": blob})
+    writer.commit({"name": session_name})
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    size_mb, version_count = (args + [64, 3][len(args):])[:2]
+    rnd = random.Random(0)
+    versions = [write_files("\0" * (size_mb * 2**20), 4, rnd)]
+    for n in range(1, version_count):
+        versions.append(write_files(versions[-1], 4, rnd))
+    print "%s versions of a %s MB disk image" % (version_count, size_mb)
+    repopath = tounicode(tempfile.mktemp(prefix = "boar_benchmark_zeroes_"))
+    try:
+        repository.create_repository(repopath, enable_deduplication = True)
+        repo = repository.Repo(repopath)
+        for n, data in enumerate(versions):
+            t0 = time.time()
+            commit(repo, u"Image%s" % n, data)
+            print "Version %s committed in %6.1f s (%6.1f MB/s)" % \
+                (n, time.time() - t0, len(data) / 2.0**20 / (time.time() - t0))
+        stats = dict(repo.get_stats())
+        print "Stored %.1f MB of %.1f MB" % (stats['actual_size'] / 2.0**20, stats['virtual_size'] / 2.0**20)
+    finally:
+        shutil.rmtree(repopath, ignore_errors = True)
+
+if __name__ == "__main__":
+    main()
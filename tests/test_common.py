@@ -16,7 +16,7 @@
 
 
 from __future__ import with_statement
-import sys, os, unittest, tempfile, shutil
+import sys, os, unittest, tempfile, shutil, time
 
 TMPDIR=tempfile.gettempdir()
 
@@ -131,6 +131,65 @@ class TestGetTree(unittest.TestCase):
                                      self.fullpath(u'räksmörgåsar' + os.sep + u'räksmörgås.txt')])
         self.assertTreeExists(tree)
 
+    def testScanTree(self):
+        self.addFile('test1.txt')
+        self.addFile('subdir/test2.txt')
+        self.addFile('subdir/deeper/test3.txt')
+        self.addFile(u'räksmörgåsar/räksmörgås.txt')
+
+        for threads in (1, 3):
+            tree = common.scan_tree(self.testdir, threads = threads)
+            self.assertTreeEquals(tree.keys(), [u'test1.txt',
+                                                u'subdir/test2.txt',
+                                                u'subdir/deeper/test3.txt',
+                                                u'räksmörgåsar/räksmörgås.txt'])
+            for fn, stat in tree.items():
+                self.assertEqual(stat.st_size, os.path.getsize(self.fullpath(fn)))
+            tree = common.scan_tree(u'testdirÅÄÖ', skip=['deeper', u'räksmörgåsar'], threads = threads)
+            self.assertTreeEquals(tree.keys(), [u'test1.txt', u'subdir/test2.txt'])
+
+    def testScanTreeJournal(self):
+        self.addFile('test1.txt')
+        self.addFile('subdir/test2.txt')
+        self.addFile('other/test3.txt')
+        def age_dirs():
+            for d in (u'', u'subdir', u'other'):
+                os.utime(os.path.join(self.testdir, d), (time.time() - 100, time.time() - 100))
+        listed = []
+        original_scan_dir = common._scan_dir
+        def counting_scan_dir(path):
+            listed.append(path)
+            return original_scan_dir(path)
+        common._scan_dir = counting_scan_dir
+        try:
+            journal = {}
+            age_dirs()
+            tree = common.scan_tree(self.testdir, journal = journal)
+            self.assertEqual(len(listed), 3)
+            self.assertEqual(sorted(journal.keys()), [u'', u'other', u'subdir'])
+            # Nothing has changed, so nothing needs to be listed
+            del listed[:]
+            self.assertEqual(common.scan_tree(self.testdir, journal = journal), tree)
+            self.assertEqual(listed, [])
+            # Modified files are found without listing their directory
+            open(self.fullpath('subdir/test2.txt'), "a").write("more")
+            tree = common.scan_tree(self.testdir, journal = journal)
+            self.assertEqual(tree[u'subdir/test2.txt'].st_size, len('subdir/test2.txt') + 4)
+            self.assertEqual(listed, [])
+            # Only the changed directory is listed again
+            open(self.fullpath('other/test4.txt'), 'w').write('test4')
+            tree = common.scan_tree(self.testdir, journal = journal)
+            self.assertTreeEquals(tree.keys(), [u'test1.txt', u'subdir/test2.txt', u'other/test3.txt', u'other/test4.txt'])
+            self.assertEqual(listed, [self.fullpath('other')])
+            # Recently modified directories are not recorded
+            self.assertEqual(sorted(journal.keys()), [u'', u'subdir'])
+            # A removed subdirectory changes its parent
+            shutil.rmtree(self.fullpath('subdir'))
+            tree = common.scan_tree(self.testdir, journal = journal)
+            self.assertTreeEquals(tree.keys(), [u'test1.txt', u'other/test3.txt', u'other/test4.txt'])
+        finally:
+            common._scan_dir = original_scan_dir
+
 class TestStrictFileWriterBasics(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix='testcommon_', dir=TMPDIR)
@@ -300,6 +359,16 @@ class TestMisc(unittest.TestCase):
         self.assertEqual(set(inv_d["v2"]), set(["k2", "kx"]))
         self.assertEqual(inv_d["v3"], ["k3"])
 
+    def test_parse_duration(self):
+        self.assertEqual(common.parse_duration("90s"), 90)
+        self.assertEqual(common.parse_duration("45m"), 45 * 60)
+        self.assertEqual(common.parse_duration("2h"), 2 * 60 * 60)
+        self.assertEqual(common.parse_duration("30d"), 30 * 24 * 60 * 60)
+        self.assertEqual(common.parse_duration("1w"), 7 * 24 * 60 * 60)
+        self.assertRaises(ValueError, common.parse_duration, "")
+        self.assertRaises(ValueError, common.parse_duration, "2x")
+        self.assertRaises(ValueError, common.parse_duration, "-5d")
+
 
 if __name__ == '__main__':
     unittest.main()
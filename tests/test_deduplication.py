@@ -16,6 +16,9 @@
 
 import sys, os, unittest, shutil
 import sqlite3
+import random
+import threading
+import time
 
 if os.getenv("BOAR_SKIP_DEDUP_TESTS") == "1":
     print "Skipping test_deduplication.py due to BOAR_SKIP_DEDUP_TESTS"
@@ -26,18 +29,20 @@ if __name__ == '__main__':
 
 import workdir
 
-from blobrepo import repository
+from blobrepo import repository, sessions
 repository.DEDUP_BLOCK_SIZE = 3 # Make deduplication cases more manageble
+repository.DEDUP_AVG_CHUNK_SIZE = 1024
 
 from common import get_tree, my_relpath, convert_win_path_to_unix, md5sum, DevNull
-from boar_exceptions import UserError, SoftCorruptionError
+from boar_exceptions import UserError, SoftCorruptionError, MisuseError
 from front import Front, verify_repo
 from wdtools import read_tree, write_tree, WorkdirHelper, boar_dirs, write_file
 
+import deduplication
 from deduplication import print_recipe
 from deduplication import RecipeFinder
 from deduplication import BlocksDB
-from cdedup import IntegerSet, calc_rolling
+from cdedup import IntegerSet, calc_rolling, ContentChunker, RollingChecksum
 
 class FakePieceHandler:
     def init_piece(self, index): pass
@@ -74,6 +79,74 @@ class TestRecipeFinder(unittest.TestCase, WorkdirHelper):
                                                'original': False, 'repeat': 1, 'offset': 0}]
                                    })
 
+    def testBatchedLookupOfOverlappingCandidates(self):
+        class RecordingBlocksDB:
+            def __init__(self, blocksdb):
+                self.blocksdb = blocksdb
+                self.lookups = []
+            def has_blocks(self, md5s):
+                self.lookups.append(md5s)
+                return self.blocksdb.has_blocks(md5s)
+            def __getattr__(self, name):
+                return getattr(self.blocksdb, name)
+        for s in "abc", "bcd", "def", "fgh":
+            self.integer_set.add(calc_rolling(s, 3))
+        self.blocksdb.begin()
+        self.blocksdb.add_block("47bce5c74f589f4867dbd57e9ca9f808", 0, md5sum("bcd"))
+        self.blocksdb.add_block("47bce5c74f589f4867dbd57e9ca9f808", 3, md5sum("def"))
+        self.blocksdb.add_block("47bce5c74f589f4867dbd57e9ca9f808", 6, md5sum("fgh"))
+        self.blocksdb.commit()
+        recording_db = RecordingBlocksDB(self.blocksdb)
+        recipe_finder = RecipeFinder(recording_db, 3, self.integer_set, None, original_piece_handler = self.piece_handler)
+        recipe_finder.feed("abcdefghX")
+        # All candidates are looked up at once, even if they overlap
+        self.assertEquals(recording_db.lookups, [[md5sum("abc"), md5sum("bcd"), md5sum("def"), md5sum("fgh")]])
+        # The hit at "bcd" hides "def", but not "fgh"
+        self.assertEquals([s for s in recipe_finder.sequences if type(s) == list],
+                          [[md5sum("bcd")], [md5sum("fgh")]])
+
+    def testFindCandidates(self):
+        self.integer_set.add(calc_rolling("aaa", 3))
+        self.integer_set.add(calc_rolling("bcd", 3))
+        data = "XaaaabcdYaaZaa"
+        iterated = RollingChecksum(3, self.integer_set)
+        iterated.feed_string(data)
+        expected = list(iterated)
+        self.assertEquals([offset for offset, rolling in expected], [1L, 2L, 5L])
+        batched = RollingChecksum(3, self.integer_set)
+        offsets, rollings = [], []
+        for fragment in ("Xa", "aaabcdY", "", "aaZaa"):
+            batched.feed_string(fragment)
+            fragment_offsets, fragment_rollings = batched.find_candidates(2)
+            while fragment_offsets:
+                offsets += fragment_offsets
+                rollings += fragment_rollings
+                fragment_offsets, fragment_rollings = batched.find_candidates(2)
+        self.assertEquals(zip(offsets, rollings), expected)
+        skipping = RollingChecksum(3, self.integer_set)
+        skipping.feed_string(data)
+        self.assertEquals(skipping.find_candidates(10, 2), ([2L, 5L], [expected[1][1], expected[2][1]]))
+        self.assertEquals(skipping.find_candidates(10), ([], []))
+
+    def testValuesAddedWhileScanning(self):
+        # A value added while another thread scans must be found by
+        # every scan that starts after it was added.
+        scanning = threading.Event()
+        def scan():
+            busy = RollingChecksum(3, self.integer_set)
+            busy.feed_string("x" * 2**25)
+            scanning.set()
+            busy.find_candidates(1)
+        thread = threading.Thread(target = scan)
+        thread.start()
+        scanning.wait()
+        time.sleep(0.05)
+        self.integer_set.add(calc_rolling("aaa", 3))
+        rolling = RollingChecksum(3, self.integer_set)
+        rolling.feed_string("Xaaa")
+        self.assertEquals(rolling.find_candidates(10), ([1L], [calc_rolling("aaa", 3)]))
+        thread.join()
+
 
 class TestConcurrentCommit(unittest.TestCase, WorkdirHelper):
     def setUp(self):
@@ -427,6 +500,210 @@ class TestDeduplicationWorkdir(unittest.TestCase, WorkdirHelper):
         self.wd.checkin()
         #print_recipe(recipe)
 
+    def testDeduplicationThreads(self):
+        self.addWorkdirFile("a.txt", "aaa")
+        self.wd.checkin()
+        blobs = []
+        for n in range(0, 20):
+            blobs.append(self.addWorkdirFile("b%s.txt" % n, "X%saaaY" % n))
+        blobs.append(self.addWorkdirFile("c.txt", "aaa" * 1000))
+        sessions.DEDUP_THREADS = 3
+        try:
+            self.wd.checkin()
+        finally:
+            sessions.DEDUP_THREADS = 1
+        for blob in blobs:
+            self.assertTrue(self.repo.get_recipe(blob))
+            self.assertEquals(md5sum(self.wd.front.get_blob(blob).read()), blob)
+
+    def testInterleavedBlobsInThreads(self):
+        writer = self.repo.create_snapshot(u"TestSession")
+        writer.dedup_threads = 2
+        blob_a = md5sum("aaabbbXccc")
+        blob_b = md5sum("cccbbbYaaa")
+        writer.init_new_blob(blob_a, 10)
+        writer.init_new_blob(blob_b, 10)
+        for fragment_a, fragment_b in (("aaab", "cccb"), ("bbXc", "bbYa"), ("cc", "aa")):
+            writer.add_blob_data(blob_a, fragment_a)
+            writer.add_blob_data(blob_b, fragment_b)
+        writer.blob_finished(blob_a)
+        writer.blob_finished(blob_b)
+        self.assertTrue(writer.has_blob(blob_a) and writer.has_blob(blob_b))
+        writer.add({"filename": u"a.txt", "md5sum": blob_a})
+        writer.add({"filename": u"b.txt", "md5sum": blob_b})
+        # Blocks found in one blob are visible to the blobs that are
+        # started after its worker is done
+        for job in writer.dedup_jobs.values():
+            job.thread.join()
+        blob_c = md5sum("bbbccc")
+        writer.init_new_blob(blob_c, 6)
+        writer.add_blob_data(blob_c, "bbbccc")
+        writer.blob_finished(blob_c)
+        writer.add({"filename": u"c.txt", "md5sum": blob_c})
+        writer.commit({"name": u"TestSession"})
+        for blob in (blob_a, blob_b, blob_c):
+            self.assertEquals(md5sum(self.repo.get_blob_reader(blob).read()), blob)
+        self.assertTrue(self.repo.get_recipe(blob_c))
+
+    def testMoreOpenBlobsThanThreads(self):
+        # The blobs that do not get a worker thread must not wait for one
+        writer = self.repo.create_snapshot(u"TestSession")
+        writer.dedup_threads = 2
+        contents = ["aaa%sbbb" % n for n in range(0, 4)]
+        blobs = [md5sum(content) for content in contents]
+        for blob, content in zip(blobs, contents):
+            writer.init_new_blob(blob, len(content))
+        for blob, content in zip(blobs, contents):
+            writer.add_blob_data(blob, content)
+        for n, blob in enumerate(blobs):
+            writer.blob_finished(blob)
+            writer.add({"filename": u"%s.txt" % n, "md5sum": blob})
+        writer.commit({"name": u"TestSession"})
+        for blob in blobs:
+            self.assertEquals(md5sum(self.repo.get_blob_reader(blob).read()), blob)
+
+    def testCommitWithUnfinishedBlob(self):
+        # Commit must not wait for a worker that will never get the
+        # rest of its blob
+        writer = self.repo.create_snapshot(u"TestSession")
+        writer.dedup_threads = 2
+        blob = md5sum("aaabbb")
+        writer.init_new_blob(blob, 6)
+        writer.add_blob_data(blob, "aaa")
+        job = writer.dedup_jobs[blob]
+        self.assertRaises(MisuseError, writer.commit, {"name": u"TestSession"})
+        self.assertFalse(job.thread.isAlive())
+        self.assertEquals(self.repo.get_all_sessions(), [1])
+
+    def testPopularBlocks(self):
+        self.addWorkdirFile("a.txt", "aaa" * 300)
+        self.wd.checkin()
+        old_max_candidates = deduplication.BLOCK_SEQUENCE_MAX_CANDIDATES
+        deduplication.BLOCK_SEQUENCE_MAX_CANDIDATES = 2
+        try:
+            blob = self.addWorkdirFile("b.txt", "X" + "aaa" * 200 + "Y")
+            self.wd.checkin()
+        finally:
+            deduplication.BLOCK_SEQUENCE_MAX_CANDIDATES = old_max_candidates
+        recipe = self.repo.get_recipe(blob)
+        self.assertEquals([(piece['original'], piece['size'], piece['repeat']) for piece in recipe['pieces']],
+                          [(True, 1, 1), (False, 600, 1), (True, 1, 1)])
+        self.assertEquals(md5sum(self.wd.front.get_blob(blob).read()), blob)
+
+    def testSnapshotStats(self):
+        self.addWorkdirFile("a.txt", "aaa")
+        self.wd.checkin()
+        self.addWorkdirFile("b.txt", "aaaccc")
+        self.wd.checkin()
+        expected = {1: (u"TestSession", False, 0, 0, 0),
+                    2: (u"TestSession", False, 1, 3, 3),
+                    3: (u"TestSession", False, 1, 6, 3)}
+        self.assertEquals(self.repo.get_snapshot_stats(), expected)
+        self.assertEquals(self.repo.get_session_stats(), [(u"TestSession", 3, 2, 9, 6)])
+        stats = dict(self.repo.get_stats())
+        self.assertEquals(stats['number_of_user_files'], 2)
+        self.assertEquals(stats['virtual_size'], 9)
+        self.assertEquals(stats['actual_size'], 6)
+        # The statistics must be recalculated identically if lost
+        os.remove(os.path.join(self.repopath, repository.DERIVED_SNAPSHOT_STATS))
+        self.assertEquals(repository.Repo(self.repopath).get_snapshot_stats(), expected)
+
+    def testStatsMatchDistinctFiles(self):
+        # The totals must match the earlier calculation from all
+        # distinct files in all snapshots
+        self.addWorkdirFile("a.txt", "aaabbb")
+        self.wd.checkin()
+        self.addWorkdirFile("b.txt", "Xaaabbb")
+        self.addWorkdirFile("c.txt", "aaabbb")
+        self.wd.checkin()
+        self.rmWorkdirFile("a.txt")
+        self.addWorkdirFile("d.txt", "Xaaabbb")
+        self.addWorkdirFile("e.txt", "ccc")
+        self.wd.checkin()
+        self.rmWorkdirFile("e.txt")
+        self.wd.checkin()
+        level_1_blobs = self.repo.get_all_level_1_blobs()
+        stats = dict(self.repo.get_stats())
+        self.assertEquals(stats['number_of_user_files'], len(level_1_blobs))
+        self.assertEquals(stats['virtual_size'], sum([self.repo.get_blob_size(blob) for blob in level_1_blobs]))
+        # "X" is already stored as an original piece of the recipes
+        # above, but is still a new user file
+        self.addWorkdirFile("f.txt", "X")
+        self.wd.checkin()
+        level_1_blobs = self.repo.get_all_level_1_blobs()
+        stats = dict(self.repo.get_stats())
+        self.assertEquals(stats['number_of_user_files'], len(level_1_blobs))
+        self.assertEquals(stats['virtual_size'], sum([self.repo.get_blob_size(blob) for blob in level_1_blobs]))
+        # The recorded statistics must match a recalculation
+        recorded = self.repo.get_snapshot_stats()
+        os.remove(os.path.join(self.repopath, repository.DERIVED_SNAPSHOT_STATS))
+        self.assertEquals(repository.Repo(self.repopath).get_snapshot_stats(), recorded)
+
+    def testRollingFilter(self):
+        self.addWorkdirFile("a.txt", "aaa")
+        self.wd.checkin()
+        filter_path = os.path.join(self.repopath, repository.DERIVED_ROLLING_FILTER)
+        rolling_filter = deduplication.RollingFilterFile(filter_path)
+        self.assertTrue(rolling_filter.is_valid())
+        self.assertTrue(rolling_filter.contains(3298534883712)) # "aaa"
+        self.assertEquals(rolling_filter.get_modcount(), self.repo.blocksdb.get_modcount())
+        del rolling_filter
+        os.remove(filter_path) # Deduplication must still work without the filter
+        blob = self.addWorkdirFile("b.txt", "Xaaa")
+        self.wd.checkin()
+        self.assertEquals(len(self.repo.get_recipe(blob)['pieces']), 2)
+        self.assertTrue(deduplication.RollingFilterFile(filter_path).is_valid())
+        with open(filter_path, "r+b") as f:
+            f.write("XXXXXXXX")
+        self.assertFalse(deduplication.RollingFilterFile(filter_path).is_valid())
+        repository.Repo(self.repopath)
+        rolling_filter = deduplication.RollingFilterFile(filter_path)
+        self.assertTrue(rolling_filter.contains(3298534883712))
+        blob = self.addWorkdirFile("c.txt", "YaaaZ")
+        self.wd.checkin()
+        self.assertEquals(len(self.repo.get_recipe(blob)['pieces']), 3)
+
+    def testBlocksDBMigration(self):
+        blob = self.addWorkdirFile("a.txt", "aaa")
+        self.wd.checkin()
+        # Recreate the single file blocks database of earlier versions
+        shutil.rmtree(os.path.join(self.repopath, repository.DERIVED_BLOCKS_SHARDS_DIR))
+        legacy_path = os.path.join(self.repopath, repository.DERIVED_BLOCKS_DB)
+        legacy_db = BlocksDB(legacy_path, 3)
+        legacy_db.begin()
+        legacy_db.add_block(blob, 0, blob)
+        legacy_db.add_rolling(3298534883712) # "aaa"
+        legacy_db.commit()
+        del legacy_db
+        # Opening the repo must not do the potentially slow migration
+        repo = repository.Repo(self.repopath)
+        self.assertTrue(os.path.exists(legacy_path))
+        self.assertTrue(repo.needs_blocksdb_migration())
+        self.assertEquals(repo.blocksdb.get_block_locations(blob), [(blob, 0)])
+        with repo:
+            repo.migrate_blocksdb()
+        self.assertFalse(os.path.exists(legacy_path))
+        self.assertFalse(repo.needs_blocksdb_migration())
+        self.assertTrue(isinstance(repo.blocksdb, deduplication.ShardedBlocksDB))
+        self.assertEquals(repo.blocksdb.get_block_locations(blob), [(blob, 0)])
+        rolling_filter = deduplication.RollingFilterFile(os.path.join(self.repopath, repository.DERIVED_ROLLING_FILTER))
+        self.assertTrue(rolling_filter.contains(3298534883712))
+        self.assertEquals(rolling_filter.get_modcount(), repo.blocksdb.get_modcount())
+
+    def testRebuildBlocksDB(self):
+        blob = self.addWorkdirFile("a.txt", "aaabbb")
+        self.wd.checkin()
+        with self.repo:
+            self.repo.blocksdb.begin()
+            self.repo.blocksdb.delete_blocks([blob])
+            self.repo.blocksdb.commit()
+            self.assertFalse(self.repo.blocksdb.has_block(md5sum("bbb")))
+            self.repo.rebuild_blocksdb()
+        self.assertEquals(self.repo.blocksdb.get_block_locations(md5sum("bbb")), [(blob, 3)])
+        blob = self.addWorkdirFile("b.txt", "Xbbb")
+        self.wd.checkin()
+        self.assertEquals(len(self.repo.get_recipe(blob)['pieces']), 2)
+
     def testEmptyFile(self):
         a_blob = self.addWorkdirFile("empty.txt", "")
         self.wd.checkin()
@@ -489,6 +766,110 @@ class TestDeduplicationWorkdir(unittest.TestCase, WorkdirHelper):
         for d in self.remove_at_teardown:
             shutil.rmtree(d, ignore_errors = True)
 
+class TestContentDefinedChunking(unittest.TestCase, WorkdirHelper):
+    def setUp(self):
+        self.remove_at_teardown = []
+        self.workdir = self.createTmpName()
+        self.repopath = self.createTmpName()
+        repository.create_repository(self.repopath, enable_deduplication = True,
+                                     dedup_method = repository.DEDUP_METHOD_CDC)
+        os.mkdir(self.workdir)
+        self.wd = workdir.Workdir(self.repopath, u"TestSession", u"", None, self.workdir)
+        self.wd.setLogOutput(DevNull())
+        self.wd.use_progress_printer(False)
+        self.repo = self.wd.front.repo
+        id = self.wd.get_front().mksession(u"TestSession")
+        assert id == 1
+        rnd = random.Random(0)
+        self.data = "".join([chr(rnd.randrange(256)) for n in range(100000)])
+
+    def testChunker(self):
+        chunker = ContentChunker(1024)
+        ends = chunker.feed_string(self.data)
+        sizes = [end - start for start, end in zip([0] + ends, ends)]
+        self.assertTrue(len(ends) > 20)
+        self.assertTrue(min(sizes) >= 256 and max(sizes) <= 4096)
+        # Chunking can be restarted at any boundary
+        chunker = ContentChunker(1024)
+        self.assertEquals([ends[3] + end for end in chunker.feed_string(self.data[ends[3]:])], ends[4:])
+        # Feeding in small parts gives the same result
+        chunker = ContentChunker(1024)
+        self.assertEquals(sum([chunker.feed_string(self.data[n:n+7]) for n in range(0, len(self.data), 7)], []), ends)
+
+    def testDedupMethod(self):
+        self.assertEquals(self.repo.get_dedup_method(), repository.DEDUP_METHOD_CDC)
+
+    def testShiftedDataIsDeduplicated(self):
+        self.addWorkdirFile("a.txt", self.data)
+        self.wd.checkin()
+        raw_size = self.repo.get_blob_catalog().get_total_size("raw")
+        blob = self.addWorkdirFile("b.txt", "X" + self.data[:50000] + "YY" + self.data[50000:])
+        self.wd.checkin()
+        recipe = self.repo.get_recipe(blob)
+        self.assertTrue(recipe)
+        self.assertTrue(self.repo.get_blob_catalog().get_total_size("raw") - raw_size < 20000)
+        self.assertEquals(md5sum(self.wd.front.get_blob(blob).read()), blob)
+
+    def testDeduplicationWithinCommit(self):
+        blob_a = self.addWorkdirFile("a.txt", self.data)
+        blob_b = self.addWorkdirFile("b.txt", self.data + "X")
+        self.wd.checkin()
+        self.assertTrue(self.repo.get_recipe(blob_a) or self.repo.get_recipe(blob_b))
+
+    def testRepeatedChunks(self):
+        self.addWorkdirFile("a.txt", "\0" * 5000)
+        self.wd.checkin()
+        blob = self.addWorkdirFile("b.txt", "\0" * 50000)
+        self.wd.checkin()
+        recipe = self.repo.get_recipe(blob)
+        self.assertTrue(recipe['pieces'][0]['repeat'] > 1)
+        self.assertEquals(self.wd.front.get_blob(blob).read(), "\0" * 50000)
+
+    def testEmptyFile(self):
+        blob = self.addWorkdirFile("empty.txt", "")
+        self.wd.checkin()
+        self.assertEquals(self.wd.front.get_blob(blob).read(), "")
+
+    def testErasedBlobsAreRemovedFromDb(self):
+        self.addWorkdirFile("a.txt", self.data)
+        self.wd.checkin()
+        self.assertEquals(self.repo.chunksdb.get_chunk_locations([md5sum(self.data[:30])]), {})
+        chunk_md5s = [md5 for offset, size, md5 in self.__chunks(self.data)]
+        self.assertEquals(len(self.repo.chunksdb.get_chunk_locations(chunk_md5s)), len(set(chunk_md5s)))
+        self.repo.chunksdb.begin()
+        self.repo.chunksdb.delete_blocks([md5sum(self.data)])
+        self.repo.chunksdb.commit()
+        self.assertEquals(self.repo.chunksdb.get_chunk_locations(chunk_md5s), {})
+
+    def testRebuildChunksDB(self):
+        blob = self.addWorkdirFile("a.txt", self.data)
+        self.wd.checkin()
+        # The blocks db and the rolling filter are not used with chunks
+        self.assertFalse(os.path.exists(os.path.join(self.repopath, repository.DERIVED_BLOCKS_SHARDS_DIR)))
+        self.assertFalse(os.path.exists(os.path.join(self.repopath, repository.DERIVED_ROLLING_FILTER)))
+        chunk_md5s = [md5 for offset, size, md5 in self.__chunks(self.data)]
+        with self.repo:
+            self.repo.chunksdb.begin()
+            self.repo.chunksdb.delete_blocks([blob])
+            self.repo.chunksdb.commit()
+            self.repo.rebuild_blocksdb()
+        self.assertEquals(len(self.repo.chunksdb.get_chunk_locations(chunk_md5s)), len(set(chunk_md5s)))
+        self.assertFalse(os.path.exists(os.path.join(self.repopath, repository.DERIVED_BLOCKS_SHARDS_DIR)))
+        blob = self.addWorkdirFile("b.txt", "X" + self.data)
+        self.wd.checkin()
+        self.assertTrue(self.repo.get_recipe(blob))
+
+    def __chunks(self, data):
+        chunk_checksum = deduplication.ChunkChecksum(1024)
+        chunk_checksum.feed_string(data)
+        return chunk_checksum.harvest()
+
+    def tearDown(self):
+        verify_repo(self.wd.get_front())
+        self.assertFalse(self.wd.get_front().repo.get_orphan_blobs())
+        for d in self.remove_at_teardown:
+            shutil.rmtree(d, ignore_errors = True)
+
 class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
     def setUp(self):
         self.remove_at_teardown = []
@@ -563,6 +944,51 @@ class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
         self.db.commit()
         self.assertEquals(list(self.db.get_block_locations("00000000000000000000000000000000")),
                           [("d41d8cd98f00b204e9800998ecf8427e", 0)])
+    def testHasBlocks(self):
+        self.db.begin()
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000")
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 1, "00000000000000000000000000000001")
+        self.db.commit()
+        self.assertEquals(self.db.has_blocks([]), set())
+        self.assertEquals(self.db.has_blocks(["00000000000000000000000000000001",
+                                              "00000000000000000000000000000002",
+                                              "00000000000000000000000000000000"]),
+                          set(["00000000000000000000000000000000", "00000000000000000000000000000001"]))
+        self.assertRaises(Exception, self.db.has_blocks, ["0000000000000000000000000000000X"])
+        self.assertTrue(self.db.has_block("00000000000000000000000000000000"))
+
+    def testLookupBlocks(self):
+        self.db.begin()
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000")
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 1, "00000000000000000000000000000001")
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 2, "00000000000000000000000000000001")
+        self.db.commit()
+        self.assertEquals(self.db.lookup_blocks([]), {})
+        self.assertEquals(self.db.lookup_blocks(["00000000000000000000000000000001",
+                                                 "00000000000000000000000000000002",
+                                                 "00000000000000000000000000000000"]),
+                          {"00000000000000000000000000000000": [("d41d8cd98f00b204e9800998ecf8427e", 0)],
+                           "00000000000000000000000000000001": [("d41d8cd98f00b204e9800998ecf8427e", 1),
+                                                                ("d41d8cd98f00b204e9800998ecf8427e", 2)]})
+        self.assertEquals(len(self.db.lookup_blocks(["00000000000000000000000000000001"], limit = 1)
+                              ["00000000000000000000000000000001"]), 1)
+        self.assertRaises(Exception, self.db.lookup_blocks, ["0000000000000000000000000000000X"])
+
+    def testFindBlockAt(self):
+        self.db.begin()
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000")
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 3, "00000000000000000000000000000001")
+        self.db.add_block("00000000000000000000000000000009", 3, "00000000000000000000000000000000")
+        self.db.commit()
+        self.assertEquals(self.db.find_block_at("00000000000000000000000000000000", []), [])
+        self.assertEquals(self.db.find_block_at("00000000000000000000000000000000",
+                                                [("00000000000000000000000000000009", 3),
+                                                 ("d41d8cd98f00b204e9800998ecf8427e", 3),
+                                                 ("d41d8cd98f00b204e9800998ecf8427e", 6),
+                                                 ("d41d8cd98f00b204e9800998ecf8427e", 0)]),
+                          [("00000000000000000000000000000009", 3), ("d41d8cd98f00b204e9800998ecf8427e", 0)])
+        self.assertRaises(Exception, self.db.find_block_at, "00000000000000000000000000000000",
+                          [("0000000000000000000000000000000X", 0)])
 
     def testBlockDuplicate(self):
         # blob, offset, md5
@@ -573,6 +999,161 @@ class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
         self.assertEquals(list(self.db.get_block_locations("00000000000000000000000000000000")),
                           [("d41d8cd98f00b204e9800998ecf8427e", 0)])
 
+    def testAddBlocks(self):
+        self.db.begin()
+        self.db.add_blocks([])
+        self.db.add_blocks([("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000"),
+                            ("d41d8cd98f00b204e9800998ecf8427e", 3, "00000000000000000000000000000001"),
+                            ("d41d8cd98f00b204e9800998ecf8427e", 3, "00000000000000000000000000000001")])
+        self.db.add_rollings([17, 4711, 17])
+        self.db.commit()
+        self.assertEquals(self.db.get_modcount(), 1)
+        self.assertEquals(self.db.get_block_locations("00000000000000000000000000000001"),
+                          [("d41d8cd98f00b204e9800998ecf8427e", 3)])
+        self.assertEquals(sorted(self.db.get_all_rolling()), [17, 4711])
+        self.db.begin()
+        self.assertRaises(Exception, self.db.add_blocks, [("d41d8cd98f00b204e9800998ecf8427e", 0, "0000000000000000000000000000000X")])
+        self.assertRaises(OverflowError, self.db.add_rollings, [2**64])
+
+    def testGetBlocksPage(self):
+        blocks = [("d41d8cd98f00b204e9800998ecf8427e", n, "%032x" % n) for n in range(0, 5)]
+        self.db.begin()
+        self.db.add_blocks(blocks)
+        self.db.commit()
+        rowid, page1 = self.db.get_blocks_page(0, 3)
+        rowid, page2 = self.db.get_blocks_page(rowid, 3)
+        self.assertEquals(page1 + page2, blocks)
+        self.assertEquals(self.db.get_blocks_page(rowid, 3), (rowid, []))
+        con = sqlite3.connect(self.dbfile)
+        con.execute("UPDATE blocks SET offset = 7 WHERE offset = 4")
+        con.commit()
+        self.assertRaises(SoftCorruptionError, self.db.get_blocks_page, 0, 10)
+
+    def testRollback(self):
+        self.db.begin()
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000")
+        self.db.rollback()
+        self.db.rollback()
+        self.assertFalse(self.db.has_block("00000000000000000000000000000000"))
+        self.assertEquals(self.db.get_modcount(), 0)
+        self.db.begin()
+        self.db.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, "00000000000000000000000000000000")
+        self.db.commit()
+        self.assertTrue(self.db.has_block("00000000000000000000000000000000"))
+
+    def testGetRollingPage(self):
+        self.db.begin()
+        self.db.add_rollings(range(0, 5))
+        self.db.commit()
+        self.assertEquals(self.db.get_rolling_count(), 5)
+        rowid, page1 = self.db.get_rolling_page(0, 3)
+        rowid, page2 = self.db.get_rolling_page(rowid, 3)
+        self.assertEquals(sorted(page1 + page2), range(0, 5))
+        self.assertEquals(self.db.get_rolling_page(rowid, 3), (rowid, []))
+        self.assertEquals([len(values) for values in self.db.get_rolling_pages(2)], [2, 2, 1])
+
+    def tearDown(self):
+        for d in self.remove_at_teardown:
+            shutil.rmtree(d, ignore_errors = True)
+
+class TestShardedBlocksDB(unittest.TestCase, WorkdirHelper):
+    def setUp(self):
+        self.remove_at_teardown = []
+        self.dbdir = self.createTmpName()
+        self.db = deduplication.ShardedBlocksDB(self.dbdir, 2**16, 4)
+        # The md5 prefixes place two blocks in every shard
+        self.blocks = [("d41d8cd98f00b204e9800998ecf8427e", n, "%04x" % n + "0" * 28) for n in range(0, 8)]
+
+    def testShards(self):
+        self.db.begin()
+        self.db.add_blocks(self.blocks)
+        self.db.add_rollings(range(0, 8))
+        self.db.commit()
+        self.assertEquals(self.db.get_modcount(), 4)
+        for shard in self.db.shards:
+            self.assertEquals(len(shard.get_blocks_page()[1]), 2)
+            self.assertEquals(len(shard.get_all_rolling()), 2)
+        md5s = [md5 for blob, offset, md5 in self.blocks]
+        self.assertEquals(self.db.lookup_blocks(md5s + ["f" * 32]),
+                          dict([(md5, [(blob, offset)]) for blob, offset, md5 in self.blocks]))
+        self.assertEquals(self.db.has_blocks(md5s + ["f" * 32]), set(md5s))
+        self.assertEquals(self.db.find_block_at(md5s[5], [("d41d8cd98f00b204e9800998ecf8427e", 4),
+                                                          ("d41d8cd98f00b204e9800998ecf8427e", 5)]),
+                          [("d41d8cd98f00b204e9800998ecf8427e", 5)])
+        self.assertEquals(sorted(self.db.get_all_rolling()), range(0, 8))
+        self.assertEquals(self.db.get_rolling_count(), 8)
+        self.assertEquals(sorted(sum(self.db.get_rolling_pages(1), [])), range(0, 8))
+        self.db.begin()
+        self.db.add_block("00000000000000000000000000000009", 0, md5s[0])
+        self.db.commit()
+        self.assertEquals(self.db.get_modcount(), 5)
+        self.assertEquals(len(self.db.get_block_locations(md5s[0])), 2)
+        self.db.begin()
+        self.db.delete_blocks(["d41d8cd98f00b204e9800998ecf8427e"])
+        self.db.commit()
+        self.assertEquals(self.db.has_blocks(md5s), set([md5s[0]]))
+
+    def testParallelLookup(self):
+        db = deduplication.ShardedBlocksDB(self.dbdir, 2**16, 4, lookup_threads = 3)
+        db.begin()
+        db.add_blocks(self.blocks)
+        db.commit()
+        md5s = [md5 for blob, offset, md5 in self.blocks]
+        self.assertEquals(db.has_blocks(md5s + ["f" * 32]), set(md5s))
+        self.assertEquals(db.lookup_blocks(md5s + ["f" * 32]),
+                          dict([(md5, [(blob, offset)]) for blob, offset, md5 in self.blocks]))
+        class FailingShard:
+            def has_blocks(self, md5s):
+                raise ValueError("Simulated lookup failure")
+        db.shards[1] = FailingShard()
+        self.assertRaises(ValueError, db.has_blocks, md5s)
+
+    def testFailedCommit(self):
+        class FailingShard:
+            def __init__(self, shard):
+                self.shard = shard
+            def commit(self):
+                raise Exception("Simulated commit failure")
+            def __getattr__(self, name):
+                return getattr(self.shard, name)
+        real_shard = self.db.shards[2]
+        self.db.shards[2] = FailingShard(real_shard)
+        self.db.begin()
+        self.db.add_blocks(self.blocks)
+        self.assertRaises(Exception, self.db.commit)
+        self.db.shards[2] = real_shard
+        # The shards before the failing one are committed, the rest are rolled back
+        self.assertEquals(self.db.has_blocks([md5 for blob, offset, md5 in self.blocks]),
+                          set([md5 for blob, offset, md5 in self.blocks[0:2] + self.blocks[4:6]]))
+        self.db.begin()
+        self.db.add_blocks(self.blocks)
+        self.db.commit()
+        self.assertEquals(len(self.db.has_blocks([md5 for blob, offset, md5 in self.blocks])), 8)
+
+    def testShardMismatch(self):
+        del self.db
+        self.assertRaises(SoftCorruptionError, deduplication.ShardedBlocksDB, self.dbdir, 2**16, 8)
+        os.remove(os.path.join(self.dbdir, "blocks-02.db"))
+        self.assertRaises(SoftCorruptionError, deduplication.ShardedBlocksDB, self.dbdir, 2**16, 4)
+
+    def testCopyBlocksDB(self):
+        source_dir = self.createTmpName()
+        os.mkdir(source_dir)
+        source = BlocksDB(os.path.join(source_dir, "blocks.db"), 2**16)
+        source.begin()
+        source.add_blocks(self.blocks)
+        source.add_rollings([17, 4711])
+        source.commit()
+        old_page_size = deduplication.BLOCKSDB_PAGE_SIZE
+        deduplication.BLOCKSDB_PAGE_SIZE = 3
+        try:
+            deduplication.copy_blocksdb(source, self.db)
+        finally:
+            deduplication.BLOCKSDB_PAGE_SIZE = old_page_size
+        self.assertEquals(self.db.lookup_blocks([md5 for blob, offset, md5 in self.blocks]),
+                          dict([(md5, [(blob, offset)]) for blob, offset, md5 in self.blocks]))
+        self.assertEquals(sorted(self.db.get_all_rolling()), [17, 4711])
+
     def tearDown(self):
         for d in self.remove_at_teardown:
             shutil.rmtree(d, ignore_errors = True)
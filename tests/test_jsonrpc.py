@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+import sys, os, unittest, threading
+from StringIO import StringIO
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonrpc
+from boar_exceptions import UserError
+
+class CountingClient(jsonrpc.BoarMessageClient):
+    """A transport that remembers the largest number of messages that
+    were awaiting a response at the same time."""
+    def __init__(self, s_in, s_out):
+        jsonrpc.BoarMessageClient.__init__(self, s_in, s_out)
+        self.max_outstanding = 0
+
+    def send(self, string, datasource = None):
+        jsonrpc.BoarMessageClient.send(self, string, datasource)
+        self.max_outstanding = max(self.max_outstanding, self.outstanding_responses)
+
+class TestPipelining(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        handler = jsonrpc.RpcHandler()
+        handler.register_function(self.record, "record")
+        handler.register_function(self.failing, "failing")
+        handler.register_function(self.upload, "upload")
+        to_server_r, to_server_w = os.pipe()
+        from_server_r, from_server_w = os.pipe()
+        self.server = jsonrpc.BoarMessageServer(os.fdopen(to_server_r, "rb"), os.fdopen(from_server_w, "wb"), handler)
+        self.server_thread = threading.Thread(target = self.server.serve)
+        self.server_thread.start()
+        self.transport = CountingClient(os.fdopen(from_server_r, "rb"), os.fdopen(to_server_w, "wb"))
+        self.proxy = jsonrpc.ServerProxy(self.transport, [UserError])
+        self.old_limits = jsonrpc.MAX_BATCH_SIZE, jsonrpc.MAX_PENDING_BATCHES
+
+    def tearDown(self):
+        jsonrpc.MAX_BATCH_SIZE, jsonrpc.MAX_PENDING_BATCHES = self.old_limits
+        self.transport.close()
+        self.server_thread.join()
+
+    def record(self, value):
+        self.calls.append(value)
+        return len(self.calls)
+
+    def failing(self, message):
+        raise UserError(message)
+
+    def upload(self, datasource):
+        return len(datasource.read())
+
+    def testBatchResponses(self):
+        pipelined_record = jsonrpc.pipelined(self.proxy.record)
+        self.assertEquals(pipelined_record("a"), None)
+        self.assertEquals(pipelined_record("b"), None)
+        self.assertEquals(self.calls, []) # Not sent yet
+        self.assertEquals(self.proxy.record("c"), 3)
+        self.assertEquals(self.calls, ["a", "b", "c"])
+        self.assertEquals(self.transport.outstanding_responses, 0)
+
+    def testLocalObjectsAreNotPipelined(self):
+        self.assertEquals(jsonrpc.pipelined(self.record)("a"), 1)
+
+    def testDeferredError(self):
+        jsonrpc.pipelined(self.proxy.record)("a")
+        jsonrpc.pipelined(self.proxy.failing)("Pipelined failure")
+        jsonrpc.pipelined(self.proxy.record)("b")
+        self.assertRaises(UserError, self.proxy.record, "c")
+        # The batch stops at the first failure, and the server hangs up
+        self.assertEquals(self.calls, ["a"])
+        self.server_thread.join()
+
+    def testDeferredErrorFromEarlierBatch(self):
+        jsonrpc.MAX_BATCH_SIZE, jsonrpc.MAX_PENDING_BATCHES = 2, 1
+        pipelined_record = jsonrpc.pipelined(self.proxy.record)
+        jsonrpc.pipelined(self.proxy.failing)("Pipelined failure")
+        pipelined_record("a") # Sends the first batch
+        pipelined_record("b")
+        # Sending the second batch means that there are too many
+        # pending batches, and the first one must be read
+        self.assertRaises(UserError, pipelined_record, "c")
+        self.assertEquals(self.calls, [])
+
+    def testFlowControl(self):
+        jsonrpc.MAX_BATCH_SIZE, jsonrpc.MAX_PENDING_BATCHES = 3, 2
+        pipelined_record = jsonrpc.pipelined(self.proxy.record)
+        for n in range(50):
+            pipelined_record(n)
+        self.assertEquals(self.proxy.record("last"), 51)
+        self.assertEquals(self.calls, range(50) + ["last"])
+        # The final ordinary call may be sent after the pending batches
+        self.assertEquals(self.transport.max_outstanding, jsonrpc.MAX_PENDING_BATCHES + 2)
+
+    def testUploadAfterPipelinedCalls(self):
+        jsonrpc.pipelined(self.proxy.record)("a")
+        data = "x" * 100000
+        datasource = jsonrpc.StreamDataSource(StringIO(data), len(data))
+        self.assertEquals(self.proxy.upload(datasource = datasource), len(data))
+        self.assertEquals(self.calls, ["a"])
+
+    def testUploadAfterFailedPipelinedCall(self):
+        # The upload is larger than the pipe buffer, so it would fail
+        # with a broken pipe if it were sent to a server that has
+        # already hung up.
+        jsonrpc.pipelined(self.proxy.failing)("Pipelined failure")
+        data = "x" * 1000000
+        datasource = jsonrpc.StreamDataSource(StringIO(data), len(data))
+        try:
+            self.proxy.upload(datasource = datasource)
+            self.fail("Expected an error")
+        except UserError, e:
+            self.assertEquals(str(e), "Pipelined failure")
+        self.assertEquals(datasource.bytes_left(), len(data))
+
+class TestBatchHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = jsonrpc.RpcHandler()
+        self.handler.register_function(lambda x: x * 2, "double")
+        self.handler.register_function(lambda: 1/0, "divide_by_zero")
+
+    def testBatch(self):
+        batch = "[" + ",".join([jsonrpc.JsonRpc20.dumps_request("double", [n]) for n in (1, 2, 3)]) + "]"
+        response = self.handler.handle(batch, None, None)
+        self.assertEquals(jsonrpc.JsonRpc20.loads_batch_response(response, [], 3), [2, 4, 6])
+        self.assertFalse(self.handler.dead)
+
+    def testBatchStopsAtFirstError(self):
+        batch = "[" + ",".join([jsonrpc.JsonRpc20.dumps_request("double", [1]),
+                                jsonrpc.JsonRpc20.dumps_request("divide_by_zero", []),
+                                jsonrpc.JsonRpc20.dumps_request("double", [2])]) + "]"
+        response = self.handler.handle(batch, None, None)
+        self.assertTrue(self.handler.dead)
+        self.assertEquals(len(jsonrpc.json.loads(response)), 2)
+        self.assertRaises(ZeroDivisionError, jsonrpc.JsonRpc20.loads_batch_response, response, [ZeroDivisionError], 3)
+
+    def testBatchResponseCountMismatch(self):
+        response = "[" + jsonrpc.JsonRpc20.dumps_response(2) + "]"
+        self.assertRaises(jsonrpc.RPCInvalidRPC, jsonrpc.JsonRpc20.loads_batch_response, response, [], 2)
+
+if __name__ == '__main__':
+    unittest.main()
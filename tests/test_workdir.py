@@ -18,7 +18,7 @@
 from __future__ import with_statement
 import sys, os, unittest, tempfile, shutil
 from copy import copy
-import socket, errno
+import socket, errno, time
 import base64
 
 DATA1 = "tjosan"
@@ -37,8 +37,8 @@ if __name__ == '__main__':
 import workdir
 from blobrepo import repository
 from common import get_tree, my_relpath, convert_win_path_to_unix, md5sum, DevNull
-from boar_exceptions import UserError
-from front import Front
+from boar_exceptions import UserError, CorruptionError
+from front import Front, verify_repo
 from wdtools import read_tree, write_tree, WorkdirHelper, boar_dirs, write_file
 
 class TestFront(unittest.TestCase, WorkdirHelper):
@@ -55,6 +55,53 @@ class TestFront(unittest.TestCase, WorkdirHelper):
         id = self.wd.get_front().mksession(u"TestSession")
         assert id == 1
 
+    def testParallelVerify(self):
+        blobs = []
+        for n in range(0, 10):
+            blobs.append(self.addWorkdirFile("file%s.txt" % n, "contents %s" % n))
+        self.wd.checkin()
+        self.assertTrue(verify_repo(self.front, jobs = 3))
+        with open(repository.Repo(self.repopath).get_blob_path(blobs[5]), "wb") as f:
+            f.write("corrupted")
+        self.assertRaises(CorruptionError, verify_repo, self.front, jobs = 3)
+
+    def testIncrementalVerify(self):
+        blobs = []
+        for n in range(0, 5):
+            blobs.append(self.addWorkdirFile("file%s.txt" % n, "contents %s" % n))
+        self.wd.checkin()
+        self.assertEqual(self.front.init_verify_blobs(since = 3600), 5)
+        self.assertEqual(sorted(self.front.verify_some_blobs()), sorted(blobs))
+        # All blobs are recently verified now
+        self.assertEqual(self.front.init_verify_blobs(since = 3600), 0)
+        self.assertEqual(self.front.init_verify_blobs(), 5)
+        self.assertEqual(len(self.front.verify_some_blobs()), 5)
+        # An exhausted budget verifies nothing
+        self.assertTrue(verify_repo(self.front, budget = 0))
+        # A modified blob must be verified again
+        with open(repository.Repo(self.repopath).get_blob_path(blobs[2]), "wb") as f:
+            f.write("corrupted")
+        self.assertEqual(self.front.init_verify_blobs(since = 3600), 1)
+        self.assertRaises(CorruptionError, self.front.verify_some_blobs)
+
+    def testVerifyMissingBlob(self):
+        blob = self.addWorkdirFile("file.txt", "contents")
+        self.wd.checkin()
+        blob_path = repository.Repo(self.repopath).get_blob_path(blob)
+        shard_dir = os.path.dirname(blob_path)
+        # Remove the blob without changing the shard mtime, so that
+        # the blob catalog does not notice
+        os.utime(shard_dir, (1000000000, 1000000000))
+        self.assertEqual(self.front.init_verify_blobs(), 1)
+        self.front.verify_some_blobs()
+        os.remove(blob_path)
+        os.utime(shard_dir, (1000000000, 1000000000))
+        try:
+            self.front.init_verify_blobs()
+            self.fail("Expected a CorruptionError")
+        except CorruptionError, e:
+            self.assertTrue(blob in str(e))
+
     def testGetIgnoreDefault(self):
         got_list = self.front.get_session_ignore_list(u"TestSession")
         self.assertEquals(got_list, [])
@@ -453,6 +500,67 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
             write_tree(wd.root, {'file.txt': 'content 2'}, False, overwrite=True)
             self.assertEqual(wd.cached_md5sum(u"file.txt"), "6685cd62b95f2c58818cb20e7292168b")
 
+    def testScanJournal(self):
+        self.mkdir("subdir")
+        self.addWorkdirFile("subdir/a.txt", "a")
+        self.addWorkdirFile("b.txt", "b")
+        self.wd.checkin()
+        open(os.path.join(self.workdir, workdir.METADIR, workdir.SCAN_JOURNAL_ENABLE_FILE), "w").close()
+        for d in ("", "subdir"):
+            os.utime(os.path.join(self.workdir, d), (time.time() - 100, time.time() - 100))
+        wd = workdir.init_workdir(self.workdir)
+        wd.use_progress_printer(False)
+        self.assertEqual(map(sorted, wd.get_changes()), [["b.txt", "subdir/a.txt"], [], [], [], []])
+        self.assertEqual(sorted(wd.scan_journal.load().keys()), [u"", u"subdir"])
+        # The journal must be persistent
+        journal = workdir.ScanJournal(os.path.join(self.workdir, workdir.METADIR, workdir.SCAN_JOURNAL_FILE))
+        self.assertEqual(journal.load(), wd.scan_journal.load())
+        self.addWorkdirFile("subdir/a.txt", "modified")
+        self.addWorkdirFile("subdir/c.txt", "new")
+        self.assertEqual(map(sorted, wd.get_changes()), [["b.txt"], ["subdir/c.txt"], ["subdir/a.txt"], [], []])
+
+    def testParallelChecksums(self):
+        tree = {}
+        for n in range(0, 250):
+            tree[u"dir%s/file%s.txt" % (n % 7, n)] = "content %s" % n * (n % 13)
+        wd = self.createWorkdir(self.repoUrl, tree)
+        for threads in (1, 4):
+            wd.checksum_threads = threads
+            wd.sqlcache = workdir.ChecksumCache(":memory:")
+            unchanged_files, new_files, modified_files, deleted_files, ignored_files = wd.get_changes()
+            self.assertEqual(set(new_files), set(tree.keys()))
+            for fn in tree.keys():
+                key = workdir.checksum_cache_key(os.stat(wd.wd_abspath(fn)))
+                self.assertEqual(wd.sqlcache.get(fn, key), md5sum(tree[fn]))
+
+    def testChecksumCache(self):
+        cache = workdir.ChecksumCache(":memory:")
+        cache.set_many([(u"a.txt", (1000.5, 10, 17, 1001.25), DATA1_MD5),
+                        (u"b.txt", (2000, 20, 18, 2000), DATA2_MD5)])
+        for preload in (False, True):
+            if preload:
+                cache.load_all()
+            self.assertEqual(cache.get(u"a.txt", (1000.5, 10, 17, 1001.25)), DATA1_MD5)
+            self.assertEqual(cache.get(u"b.txt", (2000, 20, 18, 2000)), DATA2_MD5)
+            # Any change of the key invalidates the entry
+            self.assertEqual(cache.get(u"a.txt", (1000.5, 11, 17, 1001.25)), None)
+            self.assertEqual(cache.get(u"a.txt", (1000.5, 10, 99, 1001.25)), None)
+            self.assertEqual(cache.get(u"a.txt", (1000.5, 10, 17, 1002)), None)
+            self.assertEqual(cache.get(u"c.txt", (1000.5, 10, 17, 1001.25)), None)
+        cache.set(u"a.txt", (3000, 30, 17, 3000), DATA2_MD5)
+        self.assertEqual(cache.get(u"a.txt", (3000, 30, 17, 3000)), DATA2_MD5)
+        self.assertEqual(cache.get(u"a.txt", (1000.5, 10, 17, 1001.25)), None)
+
+    def testChecksumCacheCorruption(self):
+        cache = workdir.ChecksumCache(":memory:")
+        cache.set_many([(u"a.txt", (1000.5, 10, 17, 1001.25), DATA1_MD5),
+                        (u"b.txt", (2000, 20, 18, 2000), DATA2_MD5)])
+        cache.conn.execute("UPDATE checksums SET md5 = ? WHERE path = ?", (DATA1_MD5, u"b.txt"))
+        self.assertEqual(cache.get(u"a.txt", (1000.5, 10, 17, 1001.25)), DATA1_MD5)
+        self.assertRaises(AssertionError, cache.get, u"b.txt", (2000, 20, 18, 2000))
+        # Every row is verified when the entries are loaded
+        self.assertRaises(AssertionError, cache.load_all)
+
     def testIncludeModifications(self):
         """Expected behavior is that modifications of previously
         committed (but now ignored) files should be ignored. But they
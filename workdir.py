@@ -23,7 +23,7 @@ from treecomp import TreeComparer
 from common import *
 from boar_exceptions import *
 from boar_common import *
-from jsonrpc import FileDataSource
+from jsonrpc import FileDataSource, pipelined
 
 import client
 
@@ -37,6 +37,8 @@ import tempfile
 import fnmatch
 import sqlite3
 import atexit
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 json = get_json_module()
 
@@ -44,6 +46,28 @@ VERSION_FILE = "wd_version.txt"
 CURRENT_VERSION = 3
 METADIR = ".boar"
 CCACHE_FILE = "ccache.db"
+SCAN_JOURNAL_FILE = "scanjournal.db"
+# The scan journal is only used if this file exists in the metadir
+SCAN_JOURNAL_ENABLE_FILE = "ENABLE_SCAN_JOURNAL"
+
+# The number of files that are checksummed concurrently when scanning
+# a workdir. Both the reads and the hashing release the GIL, so
+# threads are enough to keep several cores and disk requests busy.
+try:
+    CHECKSUM_THREADS = max(2, min(8, multiprocessing.cpu_count()))
+except NotImplementedError:
+    CHECKSUM_THREADS = 2
+
+# Checksums are written to the checksum cache in batches of this size
+CHECKSUM_CACHE_BATCH_SIZE = 100
+
+# The number of directories that are listed in parallel when scanning
+# a workdir. Listing in parallel only pays off on file systems with
+# high latency, such as network file systems, so it is off by default.
+try:
+    SCAN_THREADS = max(1, int(os.getenv("BOAR_SCAN_THREADS", "1")))
+except ValueError:
+    SCAN_THREADS = 1
 
 class Workdir:
     def __init__(self, repoUrl, sessionName, offset, revision, root, front = None):
@@ -80,11 +104,18 @@ class Workdir:
         else:
             self.sqlcache = ChecksumCache(":memory:")
 
+        self.scan_journal = None
+        if os.path.exists(os.path.join(self.metadir, SCAN_JOURNAL_ENABLE_FILE)):
+            self.scan_journal = ScanJournal(os.path.join(self.metadir, SCAN_JOURNAL_FILE))
+
         assert self.revision == None or self.revision > 0
         self.revision_fronts = {}
         self.tree_csums = None
         self.tree = None
+        self.tree_stats = None
         self.output = encoded_stdout()
+        self.checksum_threads = CHECKSUM_THREADS
+        self.scan_threads = SCAN_THREADS
 
     def __upgrade(self):
         v0_metadir = os.path.join(self.root, ".meta")
@@ -115,10 +146,14 @@ class Workdir:
     def __reload_tree(self):
         progress = self.ScanProgressPrinter()
         try:
-            self.tree = get_tree(self.root, skip = [METADIR], absolute_paths = False, \
-                                     progress_printer = progress)
-            if os.name == 'nt':
-                self.tree = [fn.replace("\\", "/") for fn in self.tree]
+            journal = None
+            if self.scan_journal:
+                journal = self.scan_journal.load()
+            self.tree_stats = scan_tree(self.root, skip = [METADIR], progress_printer = progress,
+                                        threads = self.scan_threads, journal = journal)
+            if self.scan_journal:
+                self.scan_journal.save(journal)
+            self.tree = sorted(self.tree_stats.keys())
         except UndecodableFilenameException, e:
             raise UserError("Found a filename that is illegal under the current file system encoding (%s): '%s'" %
                             (sys.getfilesystemencoding(), e.human_readable_name))
@@ -450,14 +485,21 @@ class Workdir:
         except FileMutex.MutexLocked, e:
             raise UserError("The session '%s' is in use (lockfile %s)" % (self.sessionName, e.mutex_file))
 
+        expected_md5sums = {}
+        for sessionpath in files:
+            wd_path = strip_path_offset(self.offset, sessionpath)
+            expected_md5sums[sessionpath] = self.cached_md5sum(wd_path)
+        # Find out which blobs must be sent with a single call
+        missing_blobs = set(front.has_blobs(list(set(expected_md5sums.values()))))
+
         for sessionpath in sorted(files):
             wd_path = strip_path_offset(self.offset, sessionpath)
             abspath = self.abspath(sessionpath)
-            expected_md5sum = self.cached_md5sum(wd_path)
+            expected_md5sum = expected_md5sums[sessionpath]
             if sessionpath in self.manifest and self.manifest[sessionpath] != expected_md5sum:
                 raise UserError("File %s contents conflicts with manifest" % wd_path)
             try:
-                check_in_file(front, abspath, sessionpath, expected_md5sum, log = self.output)
+                check_in_file(front, abspath, sessionpath, expected_md5sum, log = self.output, missing_blobs = missing_blobs)
             except ContentViolation:
                 raise UserError("File changed during commit: %s" % wd_path)
             except EnvironmentError, e:
@@ -469,7 +511,7 @@ class Workdir:
 
         for f in deleted_files:
             print >>self.output, "Deleting", f
-            front.remove(f)
+            pipelined(front).remove(f)
 
         pp = SimpleProgressPrinter(self.output, label="Verifying and integrating commit")
         self.revision = front.commit(session_name=self.sessionName, log_message=log_message, progress_callback=pp.update)
@@ -494,6 +536,7 @@ class Workdir:
             self.__reload_tree()
         if self.tree_csums == None:
             self.tree_csums = set()
+            self.sqlcache.load_all()
             for f in self.tree:
                 self.tree_csums.add(self.cached_md5sum(f))
         return csum in self.tree_csums
@@ -514,8 +557,10 @@ class Workdir:
         assert not os.path.isabs(relative_path), "Path must be relative to the workdir. Was: "+relative_path
         assert self.sqlcache
         abspath = self.wd_abspath(relative_path)
-        stat = os.stat(abspath)
-        sums = self.sqlcache.get(relative_path, stat.st_mtime)
+        return self.__lookup_cached_md5sum(relative_path, os.stat(abspath))
+
+    def __lookup_cached_md5sum(self, relative_path, stat):
+        sums = self.sqlcache.get(relative_path, checksum_cache_key(stat))
         recent_change = abs(time.time() - stat.st_mtime) < 5.0
         if sums and not recent_change:
             return sums
@@ -531,7 +576,7 @@ class Workdir:
             abspath = self.wd_abspath(relative_path)
             stat = os.stat(abspath)
             md5, = checksum_file(abspath, ("md5",))
-            self.sqlcache.set(relative_path, stat.st_mtime, md5)
+            self.sqlcache.set(relative_path, checksum_cache_key(stat), md5)
         assert is_md5sum(md5)
         return md5
 
@@ -592,11 +637,13 @@ class Workdir:
 
         files_to_checksum = []
         files_to_checksum_sizes = {}
+        self.sqlcache.load_all()
         for fn in existing_files_list:
-            md5 = self.get_cached_md5sum(fn)
+            stat = self.tree_stats[fn]
+            md5 = self.__lookup_cached_md5sum(fn, stat)
             if md5 == None:
                 files_to_checksum.append(fn)
-                files_to_checksum_sizes[fn] = os.path.getsize(self.wd_abspath(fn))
+                files_to_checksum_sizes[fn] = stat.st_size
             else:
                 filelist[prefix + fn] = md5
             scan_progress.update()
@@ -610,18 +657,36 @@ class Workdir:
         progress = self.ChecksumProgressPrinter()
         progress.update(total_files, remaining_files, total_bytes, remaining_bytes)
 
-        for fn in files_to_checksum:
-            f = prefix + fn
-            try:
-                filelist[f] = self.cached_md5sum(fn)
-            except EnvironmentError, e:
-                if ignore_errors:
-                    warn("Ignoring unreadable file: %s" % f)
+        abspaths = [(fn, self.wd_abspath(fn)) for fn in files_to_checksum]
+        cache_batch = []
+        pool = None
+        if self.checksum_threads > 1 and len(abspaths) > 1:
+            pool = ThreadPool(min(self.checksum_threads, len(abspaths)))
+            results = pool.imap_unordered(_checksum_worker, abspaths)
+        else:
+            results = (_checksum_worker(item) for item in abspaths)
+        try:
+            for fn, key, md5, error in results:
+                f = prefix + fn
+                if error:
+                    if ignore_errors:
+                        warn("Ignoring unreadable file: %s" % f)
+                    else:
+                        raise UserError("Unreadable file: %s" % f)
                 else:
-                    raise UserError("Unreadable file: %s" % f)
-            remaining_files -= 1
-            remaining_bytes -= files_to_checksum_sizes[fn]
-            progress.update(total_files, remaining_files, total_bytes, remaining_bytes)
+                    filelist[f] = md5
+                    cache_batch.append((fn, key, md5))
+                    if len(cache_batch) >= CHECKSUM_CACHE_BATCH_SIZE:
+                        self.sqlcache.set_many(cache_batch)
+                        cache_batch = []
+                remaining_files -= 1
+                remaining_bytes -= files_to_checksum_sizes[fn]
+                progress.update(total_files, remaining_files, total_bytes, remaining_bytes)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.sqlcache.set_many(cache_batch)
 
         progress.finished()
 
@@ -707,12 +772,29 @@ def fnmatch_multi(patterns, filename):
             return True
     return False
 
-def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile()):
+def _checksum_worker(item):
+    """Calculates the md5 sum of a workdir file. Returns a tuple
+    (wd_path, key, md5, error), where key is the checksum cache key of
+    the file and error is the exception if the file could not be
+    read. Called from the checksum thread pool."""
+    wd_path, abspath = item
+    try:
+        key = checksum_cache_key(os.stat(abspath))
+        md5, = checksum_file(abspath, ("md5",))
+    except EnvironmentError, e:
+        return wd_path, None, None, e
+    return wd_path, key, md5, None
+
+def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile(), missing_blobs = None):
     """ Checks in the file found at the given "abspath" into the
     active "front" with the path in the session given as
     "sessionpath". The md5sum of the file has to be provided. The
     checksum is compared to the file while it is read, to ensure it is
-    consistent."""
+    consistent. Calls that do not return anything are pipelined, to
+    reduce the number of round trips to a remote repository. If
+    "missing_blobs" is given, it must be a set of the blobs that the
+    front does not yet have (see Front.has_blobs()). It is then used
+    instead of asking the front, and is updated as blobs are sent."""
     assert os.path.isabs(abspath), \
         "abspath must be absolute. Was: '%s'" % (abspath)
     assert ".." not in sessionpath.split("/"), \
@@ -720,22 +802,29 @@ def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile()
     assert "\\" not in sessionpath, "Was: '%s'" % (sessionpath)
     assert os.path.exists(abspath), "Tried to check in file that does not exist: " + abspath
     blobinfo = create_blobinfo(abspath, sessionpath, expected_md5sum)
+    pipelined_front = pipelined(front)
     pp = SimpleProgressPrinter(log, u"Sending %s" % sessionpath)
-    if not front.has_blob(expected_md5sum) and not front.new_snapshot_has_blob(expected_md5sum):
+    if missing_blobs != None:
+        must_send = expected_md5sum in missing_blobs
+    else:
+        must_send = not front.has_blob(expected_md5sum) and not front.new_snapshot_has_blob(expected_md5sum)
+    if must_send:
         # File does not exist in repo or previously in this new snapshot. Upload it.
         _send_file_hook(abspath) # whitebox testing
         with open_raw(abspath) as f:
             #t0 = time.time()
-            front.init_new_blob(expected_md5sum, blobinfo["size"])
+            pipelined_front.init_new_blob(expected_md5sum, blobinfo["size"])
             #print "check_in_file: front.init_new_blob()", expected_md5sum, time.time() - t0
             datasource = FileDataSource(f, os.path.getsize(abspath), progress_callback = pp.update)
             front.add_blob_data_streamed(blob_md5 = expected_md5sum, datasource = datasource)
             #print "check_in_file: front.add_blob_data_streamed()", expected_md5sum, time.time() - t0
-            front.blob_finished(expected_md5sum)
+            pipelined_front.blob_finished(expected_md5sum)
             #print "check_in_file: front.blob_finished()", expected_md5sum, time.time() - t0
+        if missing_blobs != None:
+            missing_blobs.discard(expected_md5sum)
     pp.finished()
 
-    front.add(blobinfo)
+    pipelined_front.add(blobinfo)
 
 def init_workdir(path):
     """ Tries to find a workdir root directory at the given path or
@@ -910,12 +999,68 @@ class DummyChecksumProgressPrinter:
     def update(self, total_files, remaining_files, total_bytes, remaining_bytes): pass
     def finished(self): pass
 
+class ScanJournal:
+    """Records the directory listings from the last scan of a workdir,
+    so that directories that have not changed since then do not need
+    to be listed again. See common.scan_tree()."""
+    def __init__(self, dbpath):
+        assert os.path.isabs(dbpath)
+        self.dbpath = dbpath
+        self.recorded = {}
+        try:
+            self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, ctime REAL, inode INT, listing TEXT)")
+            self.conn.commit()
+        except sqlite3.DatabaseError, e:
+            raise
+
+    def load(self):
+        """Returns the recorded listings as a dict on the form expected
+        by scan_tree()."""
+        try:
+            rows = self.conn.execute("SELECT path, mtime, ctime, inode, listing FROM dirs").fetchall()
+        except sqlite3.DatabaseError, e:
+            raise
+        journal = {}
+        for path, mtime, ctime, inode, listing in rows:
+            listing = json.loads(listing)
+            journal[path] = ((mtime, ctime, inode), listing['dirs'], listing['files'])
+        self.recorded = dict(journal)
+        return journal
+
+    def save(self, journal):
+        """Replaces the recorded listings with the given ones. Only the
+        changed listings are written."""
+        changed = []
+        for path, entry in journal.iteritems():
+            if self.recorded.get(path, None) != entry:
+                (mtime, ctime, inode), dirs, files = entry
+                changed.append((path, mtime, ctime, inode, json.dumps({'dirs': dirs, 'files': files})))
+        removed = [(path,) for path in self.recorded if path not in journal]
+        try:
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", removed)
+            self.conn.executemany("REPLACE INTO dirs (path, mtime, ctime, inode, listing) VALUES (?, ?, ?, ?, ?)", changed)
+            self.conn.commit()
+        except sqlite3.DatabaseError, e:
+            raise
+        self.recorded = dict(journal)
+
+def checksum_cache_key(st):
+    """Returns the file attributes, given as a stat result, that must
+    be unchanged for a cached checksum of the file to be valid."""
+    return st.st_mtime, st.st_size, st.st_ino, st.st_ctime
+
 class ChecksumCache:
+    """A persistent mapping from workdir paths to the md5 sums of the
+    files. An entry is only valid as long as the modification time,
+    size, inode number and change time of the file are unchanged. See
+    checksum_cache_key()."""
     def __init__(self, dbpath):
         assert dbpath == ":memory:" or os.path.isabs(dbpath)
         assert dbpath == ":memory:" or os.path.exists(os.path.dirname(dbpath))
         self.dbpath = dbpath
         self.conn = None
+        self.entries = None
         self.__init_db()
         atexit.register(self.sync)
         self.rate_limiter = RateLimiter(hz = 1.0/60.0)
@@ -925,8 +1070,9 @@ class ChecksumCache:
             return
         try:
             self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
-            self.conn.execute("CREATE TABLE IF NOT EXISTS ccache (path text, mtime unsigned int, md5 char(32), row_md5 char(32))")
-            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ccache_index ON ccache (path, mtime)")
+            # The old cache format was keyed on path and mtime only
+            self.conn.execute("DROP TABLE IF EXISTS ccache")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, mtime REAL, size INT, inode INT, ctime REAL, md5 CHAR(32), row_md5 CHAR(32))")
             self.conn.commit()
             # Exclusive mode seems to make operations a lot faster
             self.conn.execute("PRAGMA locking_mode = EXCLUSIVE")
@@ -934,31 +1080,74 @@ class ChecksumCache:
         except sqlite3.DatabaseError, e:
             raise
 
-    def set(self, path, mtime, md5):
-        assert type(path) == unicode
-        md5_row = md5sum(path.encode("utf8") + "!" + str(mtime) + "!" + md5)
+    def __row_md5(self, path, key, md5):
+        mtime, size, inode, ctime = key
+        # The times are stored as REAL, so they must be hashed the way
+        # they are read back
+        return md5sum("!".join((path.encode("utf8"), str(float(mtime)), str(size), str(inode), str(float(ctime)), md5)))
+
+    def __verified_entry(self, path, mtime, size, inode, ctime, md5, row_md5):
+        """Returns a (key, md5) tuple for the given database row."""
+        key = (mtime, size, inode, ctime)
+        md5 = str(md5)
+        # TODO: use a nice exception for cache corruption
+        assert str(row_md5) == self.__row_md5(path, key, md5), "Workdir cache corrupted"
+        return key, md5
+
+    def load_all(self):
+        """Reads and verifies all entries into memory, so that later
+        calls to get() can be answered without any database queries."""
+        if self.entries != None:
+            return
         try:
-            self.conn.execute("REPLACE INTO ccache (path, mtime, md5, row_md5) VALUES (?, ?, ?, ?)", (path, mtime, md5, md5_row))
+            rows = self.conn.execute("SELECT path, mtime, size, inode, ctime, md5, row_md5 FROM checksums").fetchall()
+        except sqlite3.DatabaseError, e:
+            raise
+        entries = {}
+        for row in rows:
+            entries[row[0]] = self.__verified_entry(*row)
+        self.entries = entries
+
+    def set(self, path, key, md5):
+        self.set_many([(path, key, md5)])
+
+    def set_many(self, entries):
+        """Stores the given list of (path, key, md5) tuples, where key
+        is given by checksum_cache_key()."""
+        rows = []
+        for path, key, md5 in entries:
+            assert type(path) == unicode
+            assert len(key) == 4
+            row_md5 = self.__row_md5(path, key, md5)
+            rows.append((path,) + tuple(key) + (md5, row_md5))
+            if self.entries != None:
+                self.entries[path] = (tuple(key), md5)
+        try:
+            self.conn.executemany("REPLACE INTO checksums (path, mtime, size, inode, ctime, md5, row_md5) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
             if self.rate_limiter.ready():
                 self.sync()
         except sqlite3.DatabaseError, e:
             raise
 
-    def get(self, path, mtime):
+    def get(self, path, key):
+        """Returns the cached md5 sum of the given path, or None if
+        there is no entry for the path with the given key."""
         assert type(path) == unicode
-        try:
-            c = self.conn.cursor()
-            c.execute("SELECT md5, row_md5 FROM ccache WHERE path = ? AND mtime = ?", (path, mtime))
-            rows = c.fetchall()
-        except sqlite3.DatabaseError, e:
-            raise
-        if not rows:
+        if self.entries != None:
+            entry = self.entries.get(path, None)
+        else:
+            try:
+                rows = self.conn.execute("SELECT mtime, size, inode, ctime, md5, row_md5 FROM checksums WHERE path = ?", (path,)).fetchall()
+            except sqlite3.DatabaseError, e:
+                raise
+            entry = None
+            if rows:
+                entry = self.__verified_entry(path, *rows[0])
+        if not entry:
+            return None
+        stored_key, md5 = entry
+        if stored_key != tuple(key):
             return None
-        assert len(rows) == 1
-        md5, row_md5 = rows[0]
-        expected_md5_row = md5sum(path.encode("utf8") + "!" + str(mtime) + "!" + md5.encode("utf8"))
-        # TODO: use a nice exception for cache corruption
-        assert row_md5 == expected_md5_row, "Workdir cache corrupted"
         return md5
 
     def sync(self):